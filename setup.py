@@ -37,6 +37,7 @@ setup(
     zip_safe=False,
     extras_require={
         'dev': ['pycodestyle', 'pyflakes'],
+        'sign': ['cryptography'],
     },
     install_requires=[],
     entry_points={
@@ -4,8 +4,11 @@ import logging
 import os
 import shutil
 import sys
+import verity_squash_root.cmdline as cmdline
 import verity_squash_root.encrypt as encrypt
 from configparser import ConfigParser
+from pathlib import Path
+from verity_squash_root.bench import bench_squashfs, format_results
 from verity_squash_root.config import read_config, LOG_FILE, \
     check_config_and_system, config_str_to_stripped_arr, TMPDIR, CONFIG_FILE
 from verity_squash_root.decrypt import DecryptKeys
@@ -14,12 +17,16 @@ from verity_squash_root.distributions.base import DistributionConfig, \
 from verity_squash_root.distributions.autodetect import autodetect_distribution
 from verity_squash_root.initramfs.autodetect import InitramfsBuilder, \
     autodetect_initramfs
+from verity_squash_root.file_op import read_text_from
 from verity_squash_root.file_names import iterate_kernel_variants, \
     kernel_is_ignored
+from verity_squash_root.image import squashfs_profile_names
 from verity_squash_root.main import create_image_and_sign_kernel, \
     backup_and_sign_extra_files
 from verity_squash_root.mount import TmpfsMount
+from verity_squash_root.prescan import format_size_report, prescan_root
 from verity_squash_root.setup import add_kernels_to_uefi, setup_systemd_boot
+from verity_squash_root.verify import verify_build
 
 
 def list_distribution_efi(config: ConfigParser,
@@ -50,6 +57,14 @@ def warn_check_system_config(config: ConfigParser,
     return len(warnings) > 0
 
 
+def positive_int(value: str) -> int:
+    result = int(value)
+    if result < 1:
+        raise argparse.ArgumentTypeError(
+            "{} is not a positive number".format(value))
+    return result
+
+
 def configure_logger(verbose: bool) -> None:
     loglevel = logging.INFO if not verbose else logging.DEBUG
     logging.basicConfig(
@@ -100,9 +115,14 @@ def parse_params_and_run():
                           help="Check the system and print warnings if "
                                "the\nconfiguration does not match the "
                                "recommendation.")
-    cmd_parser.add_parser("build",
-                          help="Build squashfs, verity-info, efi binaries "
-                               "and sign\nthem.")
+    build_parser = cmd_parser.add_parser("build",
+                                         help="Build squashfs, verity-info, "
+                                              "efi binaries and sign\nthem.")
+    build_parser.add_argument("--jobs",
+                              type=positive_int,
+                              default=1,
+                              help="Number of kernels/presets to build in "
+                                   "parallel")
     setup_parser = cmd_parser.add_parser("setup",
                                          formatter_class=(
                                              argparse.RawTextHelpFormatter),
@@ -128,6 +148,35 @@ def parse_params_and_run():
     cmd_parser.add_parser("sign-extra-files",
                           help="Sign all files specified in the EXTRA_SIGN "
                                "section in the config file.")
+    verify_parser = cmd_parser.add_parser("verify-build",
+                                          help="Rebuild the squashfs image "
+                                               "and check that it equals "
+                                               "the\nimage of the slot, "
+                                               "otherwise list the "
+                                               "differing files.")
+    verify_parser.add_argument("--slot",
+                               choices=["a", "b"],
+                               help="Slot of the image, default is the "
+                                    "slot of the last build")
+    verify_parser.add_argument("--jobs",
+                               type=positive_int,
+                               default=os.cpu_count() or 1,
+                               help="Number of threads to hash and compare "
+                                    "files")
+    cmd_parser.add_parser("size-report",
+                          help="Show the uncompressed size of the files in "
+                               "the image per\ntop-level directory and the "
+                               "size excluded by every pattern.")
+    bench_parser = cmd_parser.add_parser("bench-squashfs",
+                                         help="Build the squashfs image with "
+                                              "different profiles and show "
+                                              "the\nbuild time, size and "
+                                              "read speed of the verity "
+                                              "device.")
+    bench_parser.add_argument("profiles",
+                              nargs="*",
+                              help="Squashfs profiles to compare, default "
+                                   "are all configured profiles")
     args = parser.parse_args()
     configure_logger(args.verbose)
 
@@ -161,11 +210,29 @@ def parse_params_and_run():
             with TmpfsMount(TMPDIR):
                 with DecryptKeys(config):
                     create_image_and_sign_kernel(config, distribution,
-                                                 initramfs)
+                                                 initramfs, args.jobs)
         elif args.command == "sign-extra-files":
             with TmpfsMount(TMPDIR):
                 with DecryptKeys(config):
                     backup_and_sign_extra_files(config)
+        elif args.command == "verify-build":
+            slot = args.slot or cmdline.unused_slot(
+                read_text_from(Path("/proc/cmdline")))
+            with TmpfsMount(TMPDIR):
+                differences = verify_build(config, slot, args.jobs)
+            if len(differences) == 0:
+                print("Image of slot {} is reproducible".format(slot))
+            for line in differences:
+                print(line)
+        elif args.command == "size-report":
+            for line in format_size_report(prescan_root(config)):
+                print(line)
+        elif args.command == "bench-squashfs":
+            profiles = args.profiles or squashfs_profile_names(config)
+            with TmpfsMount(TMPDIR):
+                results = bench_squashfs(config, profiles)
+            for line in format_results(results):
+                print(line)
     except BaseException as e:
         logging.error("Error: {}".format(e))
         logging.debug(e, exc_info=1)
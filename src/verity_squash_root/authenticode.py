@@ -0,0 +1,243 @@
+import hashlib
+import struct
+from pathlib import Path
+from typing import BinaryIO, List, Tuple
+from verity_squash_root.pe import PEFormatError, PEImage, \
+    SECURITY_DIRECTORY, align, read_pe_image
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+
+CHUNK_SIZE = 1024 * 1024
+CHECKSUM_MODULUS = 0xffff
+WIN_CERT_REVISION_2_0 = 0x0200
+WIN_CERT_TYPE_PKCS_SIGNED_DATA = 0x0002
+OID_SIGNED_DATA = "1.2.840.113549.1.7.2"
+OID_SHA256 = "2.16.840.1.101.3.4.2.1"
+OID_RSA_ENCRYPTION = "1.2.840.113549.1.1.1"
+OID_CONTENT_TYPE = "1.2.840.113549.1.9.3"
+OID_MESSAGE_DIGEST = "1.2.840.113549.1.9.4"
+OID_SPC_INDIRECT_DATA = "1.3.6.1.4.1.311.2.1.4"
+OID_SPC_SP_OPUS_INFO = "1.3.6.1.4.1.311.2.1.12"
+OID_SPC_PE_IMAGE_DATA = "1.3.6.1.4.1.311.2.1.15"
+
+
+def der(tag: int, content: bytes) -> bytes:
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    size = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(size)]) + size + content
+
+
+def der_sequence(*items: bytes) -> bytes:
+    return der(0x30, b"".join(items))
+
+
+def der_set(*items: bytes) -> bytes:
+    # DER needs the elements of a SET OF sorted by their encoding
+    return der(0x31, b"".join(sorted(items)))
+
+
+def der_int(value: int) -> bytes:
+    return der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big",
+                                    signed=True))
+
+
+def der_oid(oid: str) -> bytes:
+    parts = [int(p) for p in oid.split(".")]
+    content = bytearray()
+    for part in [parts[0] * 40 + parts[1]] + parts[2:]:
+        encoded = [part & 0x7f]
+        part >>= 7
+        while part > 0:
+            encoded.insert(0, 0x80 | (part & 0x7f))
+            part >>= 7
+        content += bytes(encoded)
+    return der(0x06, bytes(content))
+
+
+def der_algorithm(oid: str) -> bytes:
+    return der_sequence(der_oid(oid), der(0x05, b""))
+
+
+def der_attribute(oid: str, value: bytes) -> bytes:
+    return der_sequence(der_oid(oid), der_set(value))
+
+
+def der_content(content: bytes) -> bytes:
+    # Skip tag and length
+    length = content[1]
+    if length & 0x80:
+        return content[2 + (length & 0x7f):]
+    return content[2:]
+
+
+def spc_indirect_data_content(digest: bytes) -> bytes:
+    obsolete = "<<<Obsolete>>>".encode("utf-16-be")
+    # SpcPeImageData: no flags, file: SpcLink.file: SpcString.unicode
+    pe_image_data = der_sequence(
+        der(0x03, b"\0"),
+        der(0xa0, der(0xa2, der(0x80, obsolete))))
+    return der_sequence(
+        der_sequence(der_oid(OID_SPC_PE_IMAGE_DATA), pe_image_data),
+        der_sequence(der_algorithm(OID_SHA256), der(0x04, digest)))
+
+
+def checksum_add(checksum: int, offset: int, data: bytes) -> int:
+    # The checksum sums up 16 bit words, since 2^16 = 1 mod 0xffff, this
+    # is the same as the data as little endian integer mod 0xffff.
+    value = int.from_bytes(data, "little") % CHECKSUM_MODULUS
+    if offset % 2 == 1:
+        value = value * 0x100 % CHECKSUM_MODULUS
+    return (checksum + value) % CHECKSUM_MODULUS
+
+
+def checksum_finish(checksum: int, file_size: int) -> int:
+    # The folded sum of words is never 0 for non empty files
+    return ((checksum or CHECKSUM_MODULUS) + file_size) & 0xffffffff
+
+
+def hash_ranges(image: PEImage, data_end: int) \
+        -> Tuple[List[Tuple[int, int]], int, int]:
+    if image.number_of_directories <= SECURITY_DIRECTORY:
+        raise PEFormatError("No certificate table found")
+    checksum_offset = image.optional_offset + 64
+    security_offset = image.directories_offset + 8 * SECURITY_DIRECTORY
+    ranges = [(0, checksum_offset),
+              (checksum_offset + 4, security_offset),
+              (security_offset + 8, image.size_of_headers)]
+    for s in sorted(image.sections, key=lambda s: s[4]):
+        if s[3] == 0:
+            continue
+        if s[4] < ranges[-1][1]:
+            raise PEFormatError("Sections overlap")
+        ranges.append((s[4], s[4] + s[3]))
+    if ranges[-1][1] > data_end:
+        raise PEFormatError("File is truncated")
+    ranges.append((ranges[-1][1], data_end))
+    return ranges, checksum_offset, security_offset
+
+
+class AuthenticodeSigner:
+
+    def __init__(self, key: bytes, cert: bytes):
+        private_key = serialization.load_pem_private_key(key, password=None)
+        if not isinstance(private_key, rsa.RSAPrivateKey):
+            raise ValueError("Only RSA keys are supported for signing")
+        self._key = private_key
+        certificate = x509.load_pem_x509_certificate(cert)
+        self._cert = certificate.public_bytes(serialization.Encoding.DER)
+        self._issuer_and_serial = der_sequence(
+            certificate.issuer.public_bytes(),
+            der_int(certificate.serial_number))
+
+    @classmethod
+    def from_files(cls, key_file: Path, cert_file: Path) \
+            -> "AuthenticodeSigner":
+        return cls(key_file.read_bytes(), cert_file.read_bytes())
+
+    def signature(self, digest: bytes) -> bytes:
+        content = spc_indirect_data_content(digest)
+        attributes = [
+            der_attribute(OID_CONTENT_TYPE, der_oid(OID_SPC_INDIRECT_DATA)),
+            der_attribute(OID_MESSAGE_DIGEST, der(0x04, hashlib.sha256(
+                der_content(content)).digest())),
+            der_attribute(OID_SPC_SP_OPUS_INFO, der_sequence())]
+        # The signature is calculated over the attributes as SET OF
+        signed = der_set(*attributes)
+        encrypted = self._key.sign(signed, padding.PKCS1v15(),
+                                   hashes.SHA256())
+        signer_info = der_sequence(
+            der_int(1),
+            self._issuer_and_serial,
+            der_algorithm(OID_SHA256),
+            der(0xa0, der_content(signed)),
+            der_algorithm(OID_RSA_ENCRYPTION),
+            der(0x04, encrypted))
+        signed_data = der_sequence(
+            der_int(1),
+            der_set(der_algorithm(OID_SHA256)),
+            der_sequence(der_oid(OID_SPC_INDIRECT_DATA),
+                         der(0xa0, content)),
+            der(0xa0, self._cert),
+            der_set(signer_info))
+        return der_sequence(der_oid(OID_SIGNED_DATA),
+                            der(0xa0, signed_data))
+
+    def sign_file(self, in_file: Path, out_file: Path) -> None:
+        # The input is only read once, so out_file can be untrusted
+        same = in_file.resolve() == out_file.resolve()
+        with open(in_file, "r+b" if same else "rb") as src_fd:
+            if same:
+                self._sign(src_fd, src_fd)
+            else:
+                with open(out_file, "wb") as dest_fd:
+                    self._sign(src_fd, dest_fd)
+
+    def _sign(self, src_fd: BinaryIO, dest_fd: BinaryIO) -> None:
+        src_fd.seek(0, 2)
+        data_end = src_fd.tell()
+        src_fd.seek(0)
+        image = read_pe_image(src_fd)
+        cert_offset, cert_size = image.data_directory(SECURITY_DIRECTORY)
+        if cert_size > 0:
+            # Existing signatures are replaced
+            data_end = cert_offset
+        ranges, checksum_offset, security_offset = hash_ranges(image,
+                                                               data_end)
+        digest = hashlib.sha256()
+        checksum = 0
+        position = 0
+        src_fd.seek(0)
+        while position < data_end:
+            chunk = src_fd.read(min(CHUNK_SIZE, data_end - position))
+            if len(chunk) == 0:
+                raise PEFormatError("File is truncated")
+            end = position + len(chunk)
+            for start, stop in ranges:
+                if start < end and stop > position:
+                    digest.update(chunk[max(start, position) - position:
+                                        min(stop, end) - position])
+            checksum = checksum_add(checksum, position, chunk)
+            if dest_fd is not src_fd:
+                dest_fd.write(chunk)
+            position = end
+
+        # The certificate table needs to be aligned to 8 bytes, the
+        # padding is part of the signed data
+        table_offset = align(data_end, 8)
+        padding_data = bytes(table_offset - data_end)
+        digest.update(padding_data)
+        signature = self.signature(digest.digest())
+        length = 8 + len(signature)
+        table = struct.pack("<IHH", length, WIN_CERT_REVISION_2_0,
+                            WIN_CERT_TYPE_PKCS_SIGNED_DATA) + signature
+        table += bytes(align(length, 8) - length)
+        tail = padding_data + table
+        directory = struct.pack("<II", table_offset, len(table))
+
+        headers = image.headers
+        old_checksum = headers[checksum_offset:checksum_offset + 4]
+        old_directory = headers[security_offset:security_offset + 8]
+        checksum = checksum_add(checksum, data_end, tail)
+        checksum = checksum_add(checksum, security_offset, directory)
+        # Remove the old values, which are part of the read data
+        for offset, data in [(checksum_offset, old_checksum),
+                             (security_offset, old_directory)]:
+            checksum = (checksum - checksum_add(0, offset, data)) % \
+                CHECKSUM_MODULUS
+        file_size = data_end + len(tail)
+
+        dest_fd.seek(data_end)
+        dest_fd.write(tail)
+        dest_fd.truncate()
+        dest_fd.seek(security_offset)
+        dest_fd.write(directory)
+        dest_fd.seek(checksum_offset)
+        dest_fd.write(struct.pack("<I", checksum_finish(checksum,
+                                                        file_size)))
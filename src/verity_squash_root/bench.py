@@ -0,0 +1,151 @@
+import logging
+import os
+import random
+import stat
+import time
+from configparser import ConfigParser
+from pathlib import Path
+from typing import List, Tuple
+from verity_squash_root.config import TMPDIR, KERNEL_PARAM_BASE, \
+    config_str_to_stripped_arr
+from verity_squash_root.file_op import write_str_to
+from verity_squash_root.image import mksquashfs, squashfs_profile, \
+    veritysetup_image, verity_image_path
+from verity_squash_root.mount import VerityMount
+from verity_squash_root.timing import stage
+
+BENCH_DIR = TMPDIR / "bench"
+DEVICE_NAME = "{}_bench".format(KERNEL_PARAM_BASE)
+DROP_CACHES = Path("/proc/sys/vm/drop_caches")
+SEQUENTIAL_READ_SIZE = 128 * 1024
+SEQUENTIAL_READ_LIMIT = 256 * 1024 * 1024
+RANDOM_READ_SIZE = 4096
+RANDOM_READ_COUNT = 4096
+# Every profile reads the same blocks
+RANDOM_SEED = 0
+
+
+class BenchResult:
+
+    def __init__(self, name: str, options: List[str]):
+        self.name = name
+        self.options = options
+        self.build_time = 0.0
+        self.image_size = 0
+        self.verity_time = 0.0
+        # bytes per second
+        self.sequential_read = 0.0
+        self.random_read = 0.0
+
+
+def list_files(root: Path) -> List[Tuple[Path, int]]:
+    result = []
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            path = Path(directory) / name
+            st = path.lstat()
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                result.append((path, st.st_size))
+    return result
+
+
+def drop_caches() -> None:
+    # The image is new, but the sequential read fills the page cache
+    # for the random reads
+    os.sync()
+    write_str_to(DROP_CACHES, "1")
+
+
+def sequential_read(files: List[Tuple[Path, int]], limit: int) -> float:
+    total = 0
+    start = time.monotonic()
+    for path, _ in files:
+        with open(path, "rb", buffering=0) as f:
+            while total < limit:
+                data = f.read(SEQUENTIAL_READ_SIZE)
+                if len(data) == 0:
+                    break
+                total += len(data)
+        if total >= limit:
+            break
+    return total / max(time.monotonic() - start, 1e-9)
+
+
+def random_read(files: List[Tuple[Path, int]], count: int) -> float:
+    if len(files) == 0:
+        return 0.0
+    rng = random.Random(RANDOM_SEED)
+    # Bigger files get more reads, like reads of blocks of the device
+    chosen = rng.choices(files, weights=[s for _, s in files], k=count)
+    total = 0
+    start = time.monotonic()
+    for path, size in chosen:
+        offset = rng.randrange(0, size, RANDOM_READ_SIZE)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            total += len(os.pread(fd, RANDOM_READ_SIZE, offset))
+        finally:
+            os.close(fd)
+    return total / max(time.monotonic() - start, 1e-9)
+
+
+def bench_profile(config: ConfigParser, name: str) -> BenchResult:
+    root_mount = Path(config["DEFAULT"]["ROOT_MOUNT"])
+    efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
+    exclude_dirs = config_str_to_stripped_arr(
+        config["DEFAULT"]["EXCLUDE_DIRS"])
+    profile = squashfs_profile(config, name)
+    result = BenchResult(name, profile.compression_options())
+    image = BENCH_DIR / "{}.squashfs".format(name)
+    verity = verity_image_path(image)
+    try:
+        logging.info("Creating squashfs with profile {}...".format(name))
+        with stage("mksquashfs {}".format(name)) as record:
+            mksquashfs(exclude_dirs, image, root_mount, efi_partition,
+                       profile)
+        result.build_time = record["wall"]
+        result.image_size = image.stat().st_size
+        with stage("veritysetup {}".format(name)) as record:
+            root_hash = veritysetup_image(image)
+        result.verity_time = record["wall"]
+
+        logging.info("Reading image of profile {}...".format(name))
+        mount = BENCH_DIR / "mnt"
+        with VerityMount(image, verity, root_hash, DEVICE_NAME, mount):
+            files = list_files(mount)
+            drop_caches()
+            result.sequential_read = sequential_read(files,
+                                                     SEQUENTIAL_READ_LIMIT)
+            drop_caches()
+            result.random_read = random_read(files, RANDOM_READ_COUNT)
+    finally:
+        # Images are stored in memory, only keep one at a time
+        image.unlink(missing_ok=True)
+        verity.unlink(missing_ok=True)
+    return result
+
+
+def bench_squashfs(config: ConfigParser, names: List[str]) \
+        -> List[BenchResult]:
+    # Check all profiles before spending time on building
+    for name in names:
+        squashfs_profile(config, name)
+    BENCH_DIR.mkdir(parents=True, exist_ok=True)
+    return [bench_profile(config, name) for name in names]
+
+
+def format_results(results: List[BenchResult]) -> List[str]:
+    mib = 1024 * 1024
+    rows = [["profile", "options", "build s", "size MiB", "verity s",
+             "seq MiB/s", "random MiB/s"]]
+    for r in results:
+        rows.append([r.name, " ".join(r.options) or "-",
+                     "{:.1f}".format(r.build_time),
+                     "{:.1f}".format(r.image_size / mib),
+                     "{:.1f}".format(r.verity_time),
+                     "{:.1f}".format(r.sequential_read / mib),
+                     "{:.1f}".format(r.random_read / mib)])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return ["  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+            for row in rows]
@@ -2,14 +2,19 @@ from typing import Optional
 from verity_squash_root.config import KERNEL_PARAM_BASE
 
 
-def current_slot(kernel_cmdline: str) -> Optional[str]:
-    params = kernel_cmdline.split(" ")
-    for p in params:
-        if p.startswith("{}_slot=".format(KERNEL_PARAM_BASE)):
-            return p[24:].lower()
+def kernel_param(kernel_cmdline: str, name: str) -> Optional[str]:
+    prefix = "{}_{}=".format(KERNEL_PARAM_BASE, name)
+    for p in kernel_cmdline.split():
+        if p.startswith(prefix):
+            return p[len(prefix):]
     return None
 
 
+def current_slot(kernel_cmdline: str) -> Optional[str]:
+    slot = kernel_param(kernel_cmdline, "slot")
+    return None if slot is None else slot.lower()
+
+
 def unused_slot(kernel_cmdline: str) -> str:
     curr = current_slot(kernel_cmdline)
     try:
@@ -12,6 +12,7 @@ CONFIG_DIR = Path("/etc/{}".format(KERNEL_PARAM_BASE))
 CONFIG_FILE = CONFIG_DIR / "config.ini"
 DISTRI_FILE = Path("/usr/share") / KERNEL_PARAM_BASE / "default.ini"
 LOG_FILE = Path("/var/log/{}.log".format(KERNEL_PARAM_BASE))
+REPORT_FILE = Path("/var/log/{}_report.json".format(KERNEL_PARAM_BASE))
 EFI_PATH = Path("EFI")
 EFI_KERNELS = EFI_PATH / KERNEL_PARAM_BASE
 
@@ -20,6 +21,15 @@ def config_str_to_stripped_arr(s: str) -> List[str]:
     return [i.strip() for i in s.split(",")]
 
 
+def config_str_to_bool(s: str) -> bool:
+    value = s.strip().lower()
+    if value in ["1", "yes", "true", "on"]:
+        return True
+    if value in ["0", "no", "false", "off", ""]:
+        return False
+    raise ValueError("Not a boolean value: {}".format(s))
+
+
 def read_config() -> ConfigParser:
     # defaults will be visible in EXTRA_SIGN and break
     config = ConfigParser(default_section="DO_NOT_USE_DEFAULTS")
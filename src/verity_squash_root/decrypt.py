@@ -6,7 +6,8 @@ from pathlib import Path
 from typing import List
 from verity_squash_root.config import KEY_DIR
 from verity_squash_root.exec import exec_binary
-from verity_squash_root.efi import DB_CERT_FILE, DB_KEY_FILE
+from verity_squash_root.efi import DB_CERT_FILE, DB_KEY_FILE, \
+    forget_signers
 TAR_FILE = KEY_DIR / "keys.tar"
 
 
@@ -38,4 +39,5 @@ class DecryptKeys:
         decrypt_secure_boot_keys(self._config)
 
     def __exit__(self, exc_type, exc_value, exc_tb):
+        forget_signers()
         shutil.rmtree(KEY_DIR)
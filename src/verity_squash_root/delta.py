@@ -0,0 +1,138 @@
+import logging
+import os
+import re
+import stat
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+from verity_squash_root.cmdline import current_slot, kernel_param
+from verity_squash_root.config import KERNEL_PARAM_BASE
+from verity_squash_root.file_op import read_text_from, write_str_to
+from verity_squash_root.image import verity_image_path
+from verity_squash_root.manifest import manifest_path, read_manifest_records
+
+BASE_PREFIX = "base_"
+# mksquashfs reads exclude and pseudo files line by line and interprets
+# wildcards, other names are never excluded or whited out
+SAFE_NAME = re.compile(r"[A-Za-z0-9._+,:=%~/-]*")
+Records = Dict[str, List[Any]]
+
+
+class DeltaBase:
+
+    def __init__(self, image: Path, root_hash: str, records: Records):
+        # image is the full image the running system is based on
+        self.image = image
+        self.root_hash = root_hash
+        self.records = records
+        self.name = delta_base_name(root_hash)
+
+    def cmdline(self) -> str:
+        return "{p}_base={} {p}_base_hash={}".format(
+            self.name, self.root_hash, p=KERNEL_PARAM_BASE)
+
+
+def delta_base_name(root_hash: str) -> str:
+    return "{}{}".format(BASE_PREFIX, root_hash[:16])
+
+
+def base_reference_path(image: Path) -> Path:
+    return image.with_suffix("{}.base".format(image.suffix))
+
+
+def find_delta_base(key_dir: Path, root_mount: Path,
+                    kernel_cmdline: str) -> Optional[DeltaBase]:
+    base = kernel_param(kernel_cmdline, "base")
+    if base is not None:
+        # Booted from a delta image, its base is shared
+        image = root_mount / "{}.squashfs".format(base)
+        root_hash = kernel_param(kernel_cmdline, "base_hash")
+    else:
+        slot = current_slot(kernel_cmdline)
+        root_hash = kernel_param(kernel_cmdline, "hash")
+        if slot is None:
+            logging.info("Not booted from an image, building a full image")
+            return None
+        image = root_mount / "image_{}.squashfs".format(slot)
+    if root_hash is None or not image.exists() or \
+            not verity_image_path(image).exists():
+        logging.info("Base image {} is missing, building a full image".format(
+            image.name))
+        return None
+    records = read_manifest_records(key_dir, manifest_path(image), root_hash)
+    if records is None:
+        logging.info("No manifest for base image {}, building a full "
+                     "image".format(image.name))
+        return None
+    return DeltaBase(image, root_hash, records)
+
+
+def _parent(rel: str) -> str:
+    return rel.rpartition("/")[0]
+
+
+def _is_dir(record: List[Any]) -> bool:
+    return stat.S_ISDIR(record[3])
+
+
+def compute_delta(base: Records, current: Records) \
+        -> Tuple[List[str], List[str]]:
+    # Returns the entries to exclude and the deleted entries to white out
+    changed = {rel for rel, record in current.items()
+               if base.get(rel) != record or not SAFE_NAME.fullmatch(rel)}
+    deleted = [rel for rel in base
+               if rel not in current and _parent(rel) in current]
+    # Directories with changes below are kept, all others are excluded
+    # as a whole
+    keep: Set[str] = {""}
+
+    def keep_parents(rel: str) -> None:
+        while rel not in keep:
+            keep.add(rel)
+            rel = _parent(rel)
+
+    for rel in changed:
+        keep_parents(rel if _is_dir(current[rel]) else _parent(rel))
+    for rel in deleted:
+        keep_parents(_parent(rel))
+    excludes = [rel for rel in sorted(current)
+                if rel != "" and _parent(rel) in keep and
+                rel not in keep and rel not in changed]
+    return excludes, sorted(deleted)
+
+
+def write_delta_options(excludes: List[str], whiteouts: List[str],
+                        work_dir: Path) -> Optional[List[str]]:
+    if not all(SAFE_NAME.fullmatch(rel) for rel in whiteouts):
+        logging.info("Deleted files cannot be whited out, building a full "
+                     "image")
+        return None
+    work_dir.mkdir(parents=True, exist_ok=True)
+    exclude_file = work_dir / "exclude"
+    pseudo_file = work_dir / "pseudo"
+    write_str_to(exclude_file, "".join("{}\n".format(rel)
+                                       for rel in excludes))
+    # Overlayfs hides files of lower layers below a 0/0 character device
+    write_str_to(pseudo_file, "".join("/{} c 0 0 0 0 0\n".format(rel)
+                                      for rel in whiteouts))
+    return ["-ef", str(exclude_file), "-pf", str(pseudo_file)]
+
+
+def link_base(base: DeltaBase, root_mount: Path) -> None:
+    # Hard links keep the base, when its slot gets a new image
+    dest = root_mount / "{}.squashfs".format(base.name)
+    if base.image == dest:
+        return
+    for src, dst in [(manifest_path(base.image), manifest_path(dest)),
+                     (verity_image_path(base.image), verity_image_path(dest)),
+                     (base.image, dest)]:
+        if not dst.exists():
+            os.link(src, dst)
+
+
+def remove_unused_bases(root_mount: Path) -> None:
+    used = {read_text_from(ref).strip()
+            for ref in root_mount.glob("image_*.squashfs.base")}
+    for path in root_mount.glob("{}*".format(BASE_PREFIX)):
+        if path.name.split(".")[0] not in used:
+            logging.info("Removing unused base {}".format(path.name))
+            path.unlink()
@@ -1,6 +1,17 @@
 import re
 from pathlib import Path
-from typing import List, MutableMapping
+from typing import Dict, List, MutableMapping, Optional, Tuple
+
+
+def _int_or_str(e):
+    try:
+        return int(e)
+    except ValueError:
+        return e
+
+
+def _human_sort(e):
+    return [_int_or_str(a) for a in re.split('([0-9]+)', e)]
 
 
 class DistributionConfig:
@@ -12,6 +23,9 @@ class DistributionConfig:
     def __init__(self, os_id: str, os_name: str):
         self.__os_id = os_id
         self.__os_name = os_name
+        # mtime of the modules dir, sorted kernels and their positions
+        self._kernels: Optional[Tuple[int, List[str], Dict[str, int]]] = \
+            None
 
     def kernel_to_name(self, kernel: str) -> str:
         raise NotImplementedError("Base class")
@@ -25,19 +39,33 @@ class DistributionConfig:
     def vmlinuz(self, kernel: str) -> Path:
         return self._modules_dir / kernel / "vmlinuz"
 
+    def modules_dir(self, kernel: str) -> Path:
+        return self._modules_dir / kernel
+
+    def _kernel_inventory(self) -> Tuple[List[str], Dict[str, int]]:
+        # Installing or removing a kernel changes the mtime of the
+        # modules dir, so the snapshot is read again
+        mtime = self._modules_dir.stat().st_mtime_ns
+        if self._kernels is None or self._kernels[0] != mtime:
+            kernels = sorted([k.name for k in self._modules_dir.iterdir()],
+                             reverse=True, key=_human_sort)
+            self._kernels = (mtime, kernels,
+                             {k: i for i, k in enumerate(kernels)})
+        return self._kernels[1], self._kernels[2]
+
+    def invalidate_kernels(self) -> None:
+        self._kernels = None
+
     def list_kernels(self) -> List[str]:
-        def int_or_str(e):
-            try:
-                return int(e)
-            except ValueError:
-                return e
-
-        def human_sort(e):
-            return [int_or_str(a)
-                    for a in re.split('([0-9]+)', e)]
-
-        return sorted([k.name for k in self._modules_dir.iterdir()],
-                      reverse=True, key=human_sort)
+        return list(self._kernel_inventory()[0])
+
+    def kernel_position(self, kernel: str) -> int:
+        # Position of the kernel in list_kernels
+        positions = self._kernel_inventory()[1]
+        if kernel not in positions:
+            raise ValueError("Kernel {} not found in {}".format(
+                kernel, self._modules_dir))
+        return positions[kernel]
 
     def microcode_paths(self) -> List[Path]:
         raise NotImplementedError("Base class")
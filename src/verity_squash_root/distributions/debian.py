@@ -5,8 +5,7 @@ from verity_squash_root.distributions.base import DistributionConfig
 class DebianConfig(DistributionConfig):
 
     def kernel_to_name(self, kernel: str) -> str:
-        kernels = self.list_kernels()
-        pos = kernels.index(kernel)
+        pos = self.kernel_position(kernel)
         if pos == 0:
             return "current"
         elif pos == 1:
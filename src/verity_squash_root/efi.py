@@ -1,88 +1,93 @@
 import logging
-import math
-from collections import OrderedDict
+import threading
 from configparser import ConfigParser
 from pathlib import Path
-from verity_squash_root.config import KERNEL_PARAM_BASE, TMPDIR, KEY_DIR
-from verity_squash_root.exec import exec_binary, ExecBinaryError
+from typing import Dict, List, Optional, Tuple
+from verity_squash_root.authenticode import AuthenticodeSigner, \
+    HAS_CRYPTOGRAPHY
+from verity_squash_root.config import KERNEL_PARAM_BASE, KEY_DIR
+from verity_squash_root.exec import exec_binary
 from verity_squash_root.file_op import write_str_to
+from verity_squash_root.pe import PEEmptyError, PETruncatedError, \
+    SectionData, append_sections, read_section
+from verity_squash_root.timing import stage
 
 DB_CERT_FILE = "db.crt"
 DB_KEY_FILE = "db.key"
 CMDLINE_FILE = Path("/etc/kernel/cmdline")
+SIGNERS: Dict[Path, AuthenticodeSigner] = {}
+SIGNERS_LOCK = threading.Lock()
 
 
 def file_matches_slot_or_is_broken(file: Path, slot: str):
     search_str = " {}_slot={} ".format(KERNEL_PARAM_BASE, slot)
     try:
-        result = exec_binary(["objcopy", "-O", "binary", "--dump-section",
-                              ".cmdline=/dev/fd/1", str(file), "/dev/null"])
-    except ExecBinaryError as e:
-        err = e.stderr()
-        if err.startswith("objcopy:") and err.endswith(": file truncated\n"):
-            logging.warning("Old efi file was truncated")
-            logging.debug(err)
-            return True
-        if err.startswith("objcopy: error: the input file '") and (
-                err.endswith("' is empty\n")):
-            logging.warning("Old efi file was empty")
-            logging.debug(err)
-            return True
-        raise e
-    text = result[0].decode()
-    return search_str in text
+        cmdline = read_section(file, ".cmdline")
+    except PETruncatedError as e:
+        logging.warning("Old efi file was truncated")
+        logging.debug(e)
+        return True
+    except PEEmptyError as e:
+        logging.warning("Old efi file was empty")
+        logging.debug(e)
+        return True
+    if cmdline is None:
+        return False
+    return search_str in cmdline.decode()
+
+
+def load_signer(key_dir: Path) -> Optional[AuthenticodeSigner]:
+    if not HAS_CRYPTOGRAPHY:
+        return None
+    # Load the key once while it is decrypted
+    with SIGNERS_LOCK:
+        if key_dir not in SIGNERS:
+            SIGNERS[key_dir] = AuthenticodeSigner.from_files(
+                key_dir / DB_KEY_FILE, key_dir / DB_CERT_FILE)
+        return SIGNERS[key_dir]
+
+
+def forget_signers() -> None:
+    with SIGNERS_LOCK:
+        SIGNERS.clear()
 
 
 def sign(key_dir: Path, in_file: Path, out_file: Path) -> None:
-    exec_binary([
-        "sbsign",
-        "--key", str(key_dir / DB_KEY_FILE),
-        "--cert",  str(key_dir / DB_CERT_FILE),
-        "--output", str(out_file), str(in_file)])
+    with stage("sign {}".format(out_file.name)):
+        signer = load_signer(key_dir)
+        if signer is not None:
+            signer.sign_file(in_file, out_file)
+            return
+        exec_binary([
+            "sbsign",
+            "--key", str(key_dir / DB_KEY_FILE),
+            "--cert",  str(key_dir / DB_CERT_FILE),
+            "--output", str(out_file), str(in_file)])
 
 
-def calculate_efi_stub_end(stub: Path) -> int:
-    result = exec_binary(["objdump", "-h", str(stub)])
-    lines = result[0].decode().split("\n")
-    words = lines[-3].split()
-    return int(words[2], 16) + int(words[3], 16)
-
-
-def calculate_efi_stub_alignment(stub: Path) -> int:
-    result = exec_binary(["objdump", "-p", str(stub)])
-    lines = result[0].decode().split("\n")
-    for line in lines:
-        words = line.split()
-        if len(words) == 2:
-            if words[0] == "SectionAlignment":
-                return int(words[1], 16)
-    raise ValueError("Efistub SectionAlignment not found")
+def sign_files(key_dir: Path, files: List[Tuple[Path, Path]]) -> None:
+    # files: (in_file, out_file)
+    for in_file, out_file in files:
+        sign(key_dir, in_file, out_file)
 
 
 # TODO: use systemd-ukify when Debian 13 is stable
-def create_efi_executable(stub: Path, cmdline_file: Path, linux: Path,
-                          initrd: Path, dest: Path):
-    offset = calculate_efi_stub_end(stub)
-    alignment = calculate_efi_stub_alignment(stub)
-    sections = OrderedDict()
-    sections["osrel"] = Path("/etc/os-release")
-    sections["cmdline"] = cmdline_file
-    sections["initrd"] = initrd
-    # place linux at the end so decompressing it in-place does not
-    # cause problems:
-    # https://github.com/systemd/systemd/commit/
-    # 0fa2cac4f0cdefaf1addd7f1fe0fd8113db9360b#commitcomment-84868898
-    sections["linux"] = linux
-
-    cmd = ["objcopy"]
-    for name, file in sections.items():
-        offset = alignment * math.ceil(offset / alignment)
-        size = file.stat().st_size
-        cmd += ["--add-section", ".{}={}".format(name, str(file)),
-                "--change-section-vma", ".{}={}".format(name, hex(offset))]
-        offset = offset + size
-    cmd += [str(stub), str(dest)]
-    exec_binary(cmd)
+def create_efi_executables(stub: Path, linux: Path, initrd: List[Path],
+                           variants: List[Tuple[Path, Path]]):
+    # variants: (cmdline_file, dest), only the cmdline differs
+    # initrd: microcode and initramfs images, written in a row
+    sections: List[Tuple[str, Optional[SectionData]]] = [
+        (".osrel", Path("/etc/os-release")),
+        (".cmdline", None),
+        (".initrd", initrd),
+        # place linux at the end so decompressing it in-place does not
+        # cause problems:
+        # https://github.com/systemd/systemd/commit/
+        # 0fa2cac4f0cdefaf1addd7f1fe0fd8113db9360b#commitcomment-84868898
+        (".linux", linux)]
+    names = ", ".join(dest.name for _, dest in variants)
+    with stage("assemble {}".format(names)):
+        append_sections(stub, sections, variants)
 
 
 def get_cmdline(config: ConfigParser) -> str:
@@ -95,22 +100,26 @@ def get_cmdline(config: ConfigParser) -> str:
                        "config file or in {}".format(CMDLINE_FILE))
 
 
-def build_and_sign_kernel(config: ConfigParser, vmlinuz: Path, initramfs: Path,
-                          slot: str, root_hash: str,
-                          tmp_efi_file: Path, add_cmdline: str = "") -> None:
-    # add rw, if root is mounted ro, it cannot be mounted rw later
-    cmdline = "{} rw {} {p}_slot={} {p}_hash={}".format(
-        get_cmdline(config),
-        add_cmdline,
-        slot,
-        root_hash,
-        p=KERNEL_PARAM_BASE)
-    cmdline_file = TMPDIR / "cmdline"
-    write_str_to(cmdline_file, cmdline)
-    create_efi_executable(
+def build_and_sign_kernels(config: ConfigParser, vmlinuz: Path,
+                           initramfs: List[Path], slot: str, root_hash: str,
+                           efis: List[Tuple[Path, str]]) -> None:
+    # efis: (tmp_efi_file, add_cmdline)
+    base_cmdline = get_cmdline(config)
+    variants = []
+    for tmp_efi_file, add_cmdline in efis:
+        # add rw, if root is mounted ro, it cannot be mounted rw later
+        cmdline = "{} rw {} {p}_slot={} {p}_hash={}".format(
+            base_cmdline,
+            add_cmdline,
+            slot,
+            root_hash,
+            p=KERNEL_PARAM_BASE)
+        cmdline_file = tmp_efi_file.with_suffix(".cmdline")
+        write_str_to(cmdline_file, cmdline)
+        variants.append((cmdline_file, tmp_efi_file))
+    create_efi_executables(
         Path(config["DEFAULT"]["EFI_STUB"]),
-        cmdline_file,
         vmlinuz,
         initramfs,
-        tmp_efi_file)
-    sign(KEY_DIR, tmp_efi_file, tmp_efi_file)
+        variants)
+    sign_files(KEY_DIR, [(f, f) for f, _ in efis])
@@ -0,0 +1,163 @@
+import re
+from pathlib import Path
+from typing import List, Optional, Pattern, Tuple
+
+BUILTIN_EXCLUDES = ["dev", "proc", "run", "sys", "tmp"]
+EXTGLOB_QUANTIFIER = {"@": "", "?": "?", "*": "*", "+": "+"}
+GLOB_CHARS = "*?[\\("
+
+CompiledPattern = Tuple[Pattern, ...]
+
+
+class UnsupportedPattern(ValueError):
+    pass
+
+
+def covers(directory: CompiledPattern, parts: List[str],
+           is_dir: bool = False) -> bool:
+    # The contents of directory are excluded, parts is below it. Only the
+    # contents of a directory are excluded as well, so a directory is
+    # covered by a directory on the same level.
+    if len(parts) < len(directory) or \
+            (len(parts) == len(directory) and not is_dir):
+        return False
+    for regex, part in zip(directory, parts):
+        if not is_literal(part) or regex.fullmatch(part) is None:
+            return False
+    return True
+
+
+def is_literal(component: str) -> bool:
+    return not any(c in GLOB_CHARS for c in component)
+
+
+def exclude_patterns(exclude_dirs: List[str], root_mount: Path,
+                     efi_partition: Path) -> List[str]:
+    all_excluded = BUILTIN_EXCLUDES + [
+        str(root_mount), str(efi_partition)] + exclude_dirs
+    entries: List[Tuple[str, str, Optional[CompiledPattern]]] = []
+    for d in all_excluded:
+        sd = d.strip("/")
+        if sd not in [e[0] for e in entries]:
+            entries.append((sd, d, compile_pattern(sd)))
+    # mksquashfs matches every pattern against the entries of each
+    # directory on its path, entries below an excluded directory are
+    # excluded with it and are dropped
+    result = []
+    for sd, d, _ in entries:
+        parts = [c for c in sd.split("/") if c != ""]
+        is_file = Path(d).is_file()
+        if any(c and covers(c, parts, not is_file)
+               for e, _, c in entries if e != sd):
+            continue
+        if is_file:
+            result += [sd]
+        else:
+            result += ["{}/*".format(sd)]
+            result += ["{}/.*".format(sd)]
+    return result
+
+
+def _translate_bracket(pattern: str, pos: int) -> Tuple[str, int]:
+    end = pos + 1
+    if end < len(pattern) and pattern[end] in "!^":
+        end += 1
+    if end < len(pattern) and pattern[end] == "]":
+        end += 1
+    end = pattern.find("]", end)
+    if end == -1:
+        # fnmatch treats an unterminated bracket as literal
+        return re.escape("["), pos + 1
+    content = pattern[pos + 1:end]
+    if "[:" in content or "[=" in content or "[." in content:
+        raise UnsupportedPattern(pattern)
+    negate = ""
+    if content[0] in "!^":
+        negate = "^"
+        content = content[1:]
+    content = content.replace("\\", "\\\\").replace("^", "\\^")
+    content = content.replace("[", "\\[").replace("]", "\\]")
+    return "[{}{}]".format(negate, content), end + 1
+
+
+def _translate(pattern: str, pos: int, in_group: bool) -> Tuple[str, int]:
+    regex = ""
+    while pos < len(pattern):
+        c = pattern[pos]
+        if in_group and c in "|)":
+            return regex, pos
+        if c in "@?*+!" and pattern[pos + 1:pos + 2] == "(":
+            alternatives = []
+            pos += 2
+            while True:
+                alt, pos = _translate(pattern, pos, True)
+                alternatives.append(alt)
+                if pos >= len(pattern):
+                    raise UnsupportedPattern(pattern)
+                pos += 1
+                if pattern[pos - 1] == ")":
+                    break
+            group = "(?:{})".format("|".join(alternatives))
+            if c == "!":
+                # Only exact if nothing follows the negated group
+                if in_group or pos != len(pattern):
+                    raise UnsupportedPattern(pattern)
+                regex += "(?!{}$)[^/]*".format(group)
+            else:
+                regex += group + EXTGLOB_QUANTIFIER[c]
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            bracket, pos = _translate_bracket(pattern, pos)
+            regex += bracket
+            continue
+        elif c == "\\" and pos + 1 < len(pattern):
+            pos += 1
+            regex += re.escape(pattern[pos])
+        else:
+            regex += re.escape(c)
+        pos += 1
+    return regex, pos
+
+
+def translate_component(component: str) -> Pattern:
+    regex, _ = _translate(component, 0, False)
+    if not component.startswith("."):
+        # mksquashfs matches with FNM_PERIOD, wildcards do not match
+        # a leading dot
+        regex = "(?!\\.)" + regex
+    return re.compile(regex, re.DOTALL)
+
+
+def compile_pattern(pattern: str) -> Optional[CompiledPattern]:
+    try:
+        return tuple(translate_component(c)
+                     for c in pattern.split("/") if c != "")
+    except UnsupportedPattern:
+        return None
+
+
+def compile_patterns(patterns: List[str]) -> List[CompiledPattern]:
+    # Patterns which cannot be translated exactly are dropped, so
+    # a scan sees more files than mksquashfs, but never fewer.
+    result = []
+    for p in patterns:
+        compiled = compile_pattern(p)
+        if compiled:
+            result.append(compiled)
+    return result
+
+
+def match_entry(candidates: List[CompiledPattern], depth: int, name: str) \
+        -> Tuple[bool, List[CompiledPattern]]:
+    remaining = []
+    for c in candidates:
+        if c[depth].fullmatch(name) is None:
+            continue
+        if len(c) == depth + 1:
+            return True, []
+        remaining.append(c)
+    return False, remaining
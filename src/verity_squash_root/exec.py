@@ -1,6 +1,13 @@
+import asyncio
 import logging
+import os
 import subprocess
-from typing import List, Tuple
+from functools import partial
+from pathlib import Path
+from typing import IO, Callable, List, Optional, Tuple
+from verity_squash_root.timing import add_child_usage, stage
+
+READ_SIZE = 64 * 1024
 
 
 class ExecBinaryError(ChildProcessError):
@@ -18,18 +25,145 @@ class ExecBinaryError(ChildProcessError):
             " ".join(self.__cmd), self.stderr())
 
 
-def exec_binary(cmd: List[str], expect_returncode: int = 0) \
-        -> Tuple[bytes, bytes]:
+class ExecTimeoutError(ChildProcessError):
+
+    def __init__(self, cmd: List[str], timeout: Optional[float]):
+        super().__init__("Timeout after {}s executing '{}'".format(
+            timeout, " ".join(cmd)))
+
+
+def reap(proc: subprocess.Popen) -> None:
+    # Popen.wait cannot return the resource usage, and the usage of all
+    # children would mix up parallel jobs
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    add_child_usage(rusage)
+
+
+async def wait_exit(proc: subprocess.Popen) -> None:
+    # A pidfd becomes readable when the child exits, it is reaped
+    # afterwards without blocking
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    pidfd = os.pidfd_open(proc.pid)
+
+    def on_exit() -> None:
+        if not exited.done():
+            exited.set_result(None)
+
+    try:
+        loop.add_reader(pidfd, on_exit)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+    reap(proc)
+
+
+async def read_pipe(pipe: IO[bytes],
+                    output_line: Optional[Callable[[str], None]]) -> bytes:
+    # With output_line, the output is passed on line by line and not kept
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    chunks = []
+    pending = b""
+    try:
+        while True:
+            chunk = await reader.read(READ_SIZE)
+            if chunk == b"":
+                break
+            if output_line is None:
+                chunks.append(chunk)
+                continue
+            *lines, pending = (pending + chunk).split(b"\n")
+            if len(pending) > READ_SIZE:
+                # Progress bars without newlines are not kept forever
+                lines.append(pending)
+                pending = b""
+            for line in lines:
+                output_line(line.decode(errors="replace"))
+        if output_line is not None and pending != b"":
+            output_line(pending.decode(errors="replace"))
+    finally:
+        transport.close()
+    return b"".join(chunks)
+
+
+async def exec_binary_async(cmd: List[str], expect_returncode: int = 0,
+                            timeout: Optional[float] = None,
+                            output_line: Optional[Callable[[str], None]]
+                            = None) -> Tuple[bytes, bytes]:
     if len(cmd) == 0:
         raise ChildProcessError("Cannot execute empty cmd")
-    try:
-        logging.debug("Execute {}".format(cmd))
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-    except FileNotFoundError:
-        raise ChildProcessError(
-            "Binary not found: {}, is it installed?".format(cmd[0]))
-    result = proc.communicate()
+    with stage("exec {}".format(Path(cmd[0]).name), cmd=cmd) as record:
+        try:
+            logging.debug("Execute {}".format(cmd))
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise ChildProcessError(
+                "Binary not found: {}, is it installed?".format(cmd[0]))
+        assert proc.stdout is not None and proc.stderr is not None
+        try:
+            stdout, stderr, _ = await asyncio.wait_for(asyncio.gather(
+                read_pipe(proc.stdout, output_line),
+                read_pipe(proc.stderr, None),
+                wait_exit(proc)), timeout)
+        except asyncio.TimeoutError:
+            raise ExecTimeoutError(cmd, timeout)
+        finally:
+            # Killed on timeouts and when a sibling job failed
+            if proc.returncode is None:
+                proc.kill()
+                reap(proc)
+        record.update(returncode=proc.returncode,
+                      stdout_bytes=len(stdout),
+                      stderr_bytes=len(stderr))
     if proc.returncode != expect_returncode:
-        raise ExecBinaryError(cmd, result[0], result[1])
-    return result
+        raise ExecBinaryError(cmd, stdout, stderr)
+    return stdout, stderr
+
+
+async def exec_binaries_async(cmds: List[List[str]], jobs: int,
+                              timeout: Optional[float] = None,
+                              output_line: Optional[Callable[[int, str],
+                                                             None]] = None) \
+        -> List[Tuple[bytes, bytes]]:
+    # The first failure cancels all other commands. output_line gets the
+    # index of the command and the line.
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def run(index: int, cmd: List[str]) -> Tuple[bytes, bytes]:
+        lines = None if output_line is None else partial(output_line, index)
+        async with semaphore:
+            return await exec_binary_async(cmd, timeout=timeout,
+                                           output_line=lines)
+
+    tasks = [asyncio.ensure_future(run(index, cmd))
+             for index, cmd in enumerate(cmds)]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def exec_binary(cmd: List[str], expect_returncode: int = 0,
+                timeout: Optional[float] = None,
+                output_line: Optional[Callable[[str], None]] = None) \
+        -> Tuple[bytes, bytes]:
+    return asyncio.run(exec_binary_async(cmd, expect_returncode, timeout,
+                                         output_line))
+
+
+def exec_binaries(cmds: List[List[str]], jobs: int,
+                  timeout: Optional[float] = None,
+                  output_line: Optional[Callable[[int, str], None]] = None) \
+        -> List[Tuple[bytes, bytes]]:
+    return asyncio.run(exec_binaries_async(cmds, jobs, timeout, output_line))
@@ -1,3 +1,5 @@
+import errno
+import os
 import shutil
 from pathlib import Path
 from typing import List
@@ -19,4 +21,43 @@ def merge_files(src: List[Path], dest: Path):
     with open(dest, "wb") as dest_fd:
         for s in src:
             with open(s, "rb") as src_fd:
-                shutil.copyfileobj(src_fd, dest_fd)
+                copy_file_data(src_fd.fileno(), dest_fd.fileno(),
+                               os.fstat(src_fd.fileno()).st_size)
+
+
+def move_file(src: Path, dest: Path) -> None:
+    # dest may be hard linked (delta bases). Moving across file systems
+    # would write into the shared inode, so the file is copied next to
+    # dest and renamed over it.
+    tmp = dest.with_name("{}.tmp".format(dest.name))
+    shutil.move(src, tmp)
+    os.replace(tmp, dest)
+
+
+def files_equal(a: Path, b: Path, chunk_size: int = 1024 * 1024) -> bool:
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    with open(a, "rb") as a_fd, open(b, "rb") as b_fd:
+        while True:
+            chunk = a_fd.read(chunk_size)
+            if chunk != b_fd.read(chunk_size):
+                return False
+            if len(chunk) == 0:
+                return True
+
+
+def copy_file_data(src_fd: int, dest_fd: int, count: int,
+                   offset: int = 0) -> None:
+    # Copy in the kernel, without reading the data into python
+    while count > 0:
+        try:
+            copied = os.copy_file_range(src_fd, dest_fd, count, offset)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                               errno.EOPNOTSUPP):
+                raise e
+            copied = os.sendfile(dest_fd, src_fd, offset, count)
+        if copied == 0:
+            raise EOFError("File ended {} bytes too early".format(count))
+        count -= copied
+        offset += copied
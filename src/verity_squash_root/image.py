@@ -1,30 +1,147 @@
+import logging
+import os
+import re
+from configparser import ConfigParser
 from pathlib import Path
-from typing import List
-import verity_squash_root.parsing as parsing
+from typing import List, Optional, Sequence
+from verity_squash_root.exclude import exclude_patterns
 from verity_squash_root.exec import exec_binary
+from verity_squash_root.verity import verity_hash_file
 
+PROFILE_SECTION = "SQUASHFS_PROFILE:{}"
+# Highest compression level, compressors without levels are missing
+COMPRESSION_LEVELS = {"gzip": 9, "lzo": 9, "zstd": 22}
+COMPRESSORS = ["gzip", "lz4", "lzma", "lzo", "xz", "zstd"]
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
 
-def mksquashfs(exclude_dirs: List[str], image: Path,
-               root_mount: Path, efi_partition: Path):
+
+def parse_size(value: str) -> int:
+    match = re.fullmatch("([0-9]+)([KMG]?)", value.strip().upper())
+    if match is None:
+        raise ValueError("Invalid size: {}".format(value))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+class SquashfsProfile:
+
+    def __init__(self, compressor: Optional[str] = None,
+                 compression_level: Optional[int] = None,
+                 block_size: Optional[int] = None,
+                 processors: Optional[int] = None,
+                 memory: Optional[int] = None):
+        if compressor is not None and compressor not in COMPRESSORS:
+            raise ValueError("Unknown squashfs compressor: {}".format(
+                compressor))
+        if compression_level is not None:
+            # mksquashfs uses gzip if no compressor is given
+            name = compressor or "gzip"
+            max_level = COMPRESSION_LEVELS.get(name)
+            if max_level is None:
+                raise ValueError("Compressor {} has no compression "
+                                 "level".format(name))
+            if not 1 <= compression_level <= max_level:
+                raise ValueError("Compression level of {} needs to be "
+                                 "between 1 and {}".format(name, max_level))
+        if block_size is not None and (
+                block_size & (block_size - 1) != 0 or
+                not 4096 <= block_size <= 1024 ** 2):
+            raise ValueError("Block size needs to be a power of two "
+                             "between 4K and 1M")
+        if processors is not None and processors < 1:
+            raise ValueError("Number of processors needs to be positive")
+        if memory is not None and memory < 1024 ** 2:
+            raise ValueError("Memory limit needs to be at least 1M")
+        self.compressor = compressor
+        self.compression_level = compression_level
+        self.block_size = block_size
+        self.processors = processors
+        self.memory = memory
+
+    def compression_options(self) -> List[str]:
+        # These options change the image
+        result = []
+        if self.compressor is not None:
+            result += ["-comp", self.compressor]
+        if self.compression_level is not None:
+            result += ["-Xcompression-level", str(self.compression_level)]
+        if self.block_size is not None:
+            result += ["-b", str(self.block_size)]
+        return result
+
+    def resource_options(self) -> List[str]:
+        # Images are reproducible, so these options only change the
+        # build time
+        result = []
+        if self.processors is not None:
+            result += ["-processors", str(self.processors)]
+        if self.memory is not None:
+            result += ["-mem", "{}M".format(self.memory // 1024 ** 2)]
+        return result
+
+
+def squashfs_profile_names(config: ConfigParser) -> List[str]:
+    prefix = PROFILE_SECTION.format("")
+    return [s[len(prefix):] for s in config.sections()
+            if s.startswith(prefix)]
+
+
+def squashfs_profile(config: ConfigParser,
+                     name: Optional[str] = None) -> SquashfsProfile:
+    if name is None:
+        name = config["DEFAULT"]["SQUASHFS_PROFILE"].strip()
+    section_name = PROFILE_SECTION.format(name)
+    if section_name not in config:
+        raise ValueError("Squashfs profile {} is not configured, add a "
+                         "section [{}]".format(name, section_name))
+    section = config[section_name]
+
+    def get(key: str) -> Optional[str]:
+        value = section.get(key, "").strip()
+        return value if value != "" else None
+
+    def get_int(key: str) -> Optional[int]:
+        value = get(key)
+        return int(value) if value is not None else None
+
+    def get_size(key: str) -> Optional[int]:
+        value = get(key)
+        return parse_size(value) if value is not None else None
+
+    return SquashfsProfile(
+        compressor=get("COMPRESSOR"),
+        compression_level=get_int("COMPRESSION_LEVEL"),
+        block_size=get_size("BLOCK_SIZE"),
+        processors=get_int("PROCESSORS"),
+        memory=get_size("MEMORY"))
+
+
+def mksquashfs_cmd(exclude_dirs: List[str], image: Path,
+                   root_mount: Path, efi_partition: Path,
+                   extra_options: Sequence[str] = ()) -> List[str]:
     include_dirs = ["/"]
-    all_excluded = [
-        "dev", "proc", "run", "sys", "tmp",
-        str(root_mount), str(efi_partition)] + exclude_dirs
     options = ["-reproducible", "-xattrs", "-wildcards", "-noappend",
                # prevents overlayfs corruption on updates
-               "-no-exports",
+               "-no-exports"] + list(extra_options) + [
                "-p", "{} d 0700 0 0".format(root_mount),
                "-p", "{} d 0700 0 0".format(efi_partition)]
+    # -e needs to be the last option
     cmd = ["mksquashfs"] + include_dirs + [str(image)] + options + ["-e"]
-    for d in all_excluded:
-        sd = d.strip("/")
-        p = Path(d)
-        if p.is_file():
-            cmd += [sd]
-        else:
-            cmd += ["{}/*".format(sd)]
-            cmd += ["{}/.*".format(sd)]
-    exec_binary(cmd)
+    return cmd + exclude_patterns(exclude_dirs, root_mount, efi_partition)
+
+
+def mksquashfs(exclude_dirs: List[str], image: Path,
+               root_mount: Path, efi_partition: Path,
+               profile: Optional[SquashfsProfile] = None,
+               extra_options: Sequence[str] = ()):
+    if profile is None:
+        profile = SquashfsProfile()
+    # The output is logged while mksquashfs runs, a progress bar would
+    # be one endless line
+    options = ["-no-progress"] + profile.compression_options() + \
+        profile.resource_options() + list(extra_options)
+    exec_binary(mksquashfs_cmd(exclude_dirs, image, root_mount,
+                               efi_partition, options),
+                output_line=logging.debug)
 
 
 def verity_image_path(image: Path) -> Path:
@@ -32,8 +149,6 @@ def verity_image_path(image: Path) -> Path:
 
 
 def veritysetup_image(image: Path) -> str:
-    cmd = ["veritysetup", "format", str(image), str(verity_image_path(image))]
-    result = exec_binary(cmd)
-    stdout = result[0].decode()
-    info = parsing.info_to_dict(stdout)
-    return info["Root hash"]
+    # Same result as veritysetup format, but hashed on all cores
+    return verity_hash_file(image, verity_image_path(image),
+                            os.cpu_count() or 1)
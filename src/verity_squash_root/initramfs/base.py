@@ -1,6 +1,11 @@
+import logging
 from pathlib import Path
-from typing import Generator, List, Tuple
+from typing import Dict, Generator, List, Tuple
+from verity_squash_root.config import TMPDIR
 from verity_squash_root.distributions.base import DistributionConfig
+from verity_squash_root.exec import exec_binaries
+
+WORK_DIR = TMPDIR / "initramfs"
 
 
 class InitramfsBuilder:
@@ -11,18 +16,63 @@ class InitramfsBuilder:
     def display_name(self, kernel: str, preset: str) -> str:
         raise NotImplementedError("Base class")
 
-    def build_initramfs_with_microcode(self, kernel: str,
-                                       preset: str) -> Path:
+    def initramfs_command(self, kernel: str, preset: str, work_dir: Path) \
+            -> Tuple[List[str], List[Path]]:
+        # The command generating the initramfs in work_dir and the images
+        # to put into the efi in a row
         raise NotImplementedError("Base class")
 
+    def work_dir(self, kernel: str, preset: str) -> Path:
+        return WORK_DIR / self.file_name(kernel, preset)
+
+    def build_initramfs_with_microcode(self, kernel: str,
+                                       preset: str) -> List[Path]:
+        return self.build_many([(kernel, preset)], 1)[0]
+
+    def build_many(self, kernel_presets: List[Tuple[str, str]],
+                   jobs: int) -> List[List[Path]]:
+        # Every initramfs is generated in its own directory, so up to jobs
+        # generators run at the same time
+        cmds = []
+        names = []
+        result = []
+        for kernel, preset in kernel_presets:
+            work_dir = self.work_dir(kernel, preset)
+            work_dir.mkdir(parents=True, exist_ok=True)
+            cmd, parts = self.initramfs_command(kernel, preset, work_dir)
+            cmds.append(cmd)
+            names.append(self.file_name(kernel, preset))
+            result.append(parts)
+
+        def output_line(index: int, line: str) -> None:
+            logging.debug("{}: {}".format(names[index], line))
+
+        exec_binaries(cmds, jobs, output_line=output_line)
+        return result
+
     def list_kernel_presets(self, kernel: str) -> List[str]:
         raise NotImplementedError("Base class")
 
+    def list_all_kernel_presets(self, kernels: List[str]) \
+            -> Dict[str, List[str]]:
+        return {kernel: self.list_kernel_presets(kernel)
+                for kernel in kernels}
+
+    def cache_inputs(self, kernel: str, preset: str) -> List[Path]:
+        # Files and directories the initramfs is generated from, besides
+        # the files it contains
+        raise NotImplementedError("Base class")
+
+    def list_image_files(self, image: Path) -> List[str]:
+        raise NotImplementedError("Base class")
+
 
 def iterate_distribution_efi(distribution: DistributionConfig,
                              initramfs: InitramfsBuilder) \
         -> Generator[Tuple[str, str, str], None, None]:
-    for kernel in distribution.list_kernels():
-        for preset in initramfs.list_kernel_presets(kernel):
+    kernels = distribution.list_kernels()
+    presets = initramfs.list_all_kernel_presets(kernels)
+    for kernel in kernels:
+        for preset in presets[kernel]:
             base_name = initramfs.file_name(kernel, preset)
             yield (kernel, preset, base_name)
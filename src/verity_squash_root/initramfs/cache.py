@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, List, Optional, Set, Tuple
+from verity_squash_root.file_op import merge_files
+from verity_squash_root.initramfs.base import InitramfsBuilder
+from verity_squash_root.integrity import key_mac, key_mac_matches
+
+CACHE_VERSION = 3
+CACHE_DIR_NAME = "initramfs_cache"
+
+
+def path_state(path: Path) -> List[List[Any]]:
+    # Size, mtime and mode of path and of everything below it. Inode
+    # numbers change with every booted squashfs image, so they are not
+    # used, and squashfs keeps mtimes in whole seconds only.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return [[str(path), None]]
+    result = [[str(path), st.st_size, st.st_mtime_ns // 10**9,
+               st.st_mode]]
+    stack = [str(path)] if stat.S_ISDIR(st.st_mode) else []
+    while len(stack) > 0:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            result.append([entry.path, st.st_size,
+                           st.st_mtime_ns // 10**9, st.st_mode])
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(entry.path)
+    return result
+
+
+def host_file_state(name: str) -> List[Any]:
+    # Files generated by the hooks do not exist on the host, they
+    # depend on the inputs of the builder
+    path = "/" + name.removeprefix("./").lstrip("/")
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return [path, None]
+    if stat.S_ISDIR(st.st_mode):
+        # Changes with every entry of the directory on the host
+        return [path, "directory"]
+    return [path, st.st_size, st.st_mtime_ns // 10**9, st.st_mode]
+
+
+def inputs_digest(builder: InitramfsBuilder, kernel: str, preset: str,
+                  files: List[str]) -> str:
+    digest = hashlib.sha256()
+    digest.update((json.dumps([CACHE_VERSION, type(builder).__name__,
+                               kernel, preset]) + "\n").encode())
+    for path in builder.cache_inputs(kernel, preset):
+        for state in path_state(path):
+            digest.update((json.dumps(state) + "\n").encode())
+    for name in files:
+        digest.update((json.dumps(host_file_state(name)) + "\n").encode())
+    return digest.hexdigest()
+
+
+def file_sha256(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def cache_paths(cache_dir: Path, name: str) -> Tuple[Path, Path]:
+    return (cache_dir / "{}.image".format(name),
+            cache_dir / "{}.inputs".format(name))
+
+
+def _entry_text(entry: Mapping[str, Any]) -> str:
+    return "{}:{}:{}".format(entry["version"], entry["digest"],
+                             entry["image_sha256"])
+
+
+def cached_initramfs(key_dir: Path, cache_dir: Path,
+                     builder: InitramfsBuilder, kernel: str, preset: str,
+                     name: str) -> Optional[Path]:
+    image, inputs = cache_paths(cache_dir, name)
+    try:
+        with open(inputs, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        valid = entry["version"] == CACHE_VERSION and \
+            key_mac_matches(key_dir, _entry_text(entry), entry["mac"])
+        files = [str(f) for f in entry["files"]]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError):
+        valid = False
+    if not valid:
+        logging.warning("Ignoring invalid initramfs cache {}".format(inputs))
+        return None
+    if inputs_digest(builder, kernel, preset, files) != entry["digest"]:
+        return None
+    # The image is on the root partition, so it is authenticated as well.
+    # Files to sign are kept on trusted tmpfs, the copy is checked and used.
+    work_dir = builder.work_dir(kernel, preset)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    copy = work_dir / image.name
+    try:
+        shutil.copyfile(image, copy)
+    except FileNotFoundError:
+        return None
+    if file_sha256(copy) != entry["image_sha256"]:
+        logging.warning("Ignoring invalid initramfs cache {}".format(image))
+        copy.unlink()
+        return None
+    return copy
+
+
+def store_initramfs(key_dir: Path, cache_dir: Path,
+                    builder: InitramfsBuilder, kernel: str, preset: str,
+                    name: str, parts: List[Path]) -> None:
+    cache_dir.mkdir(exist_ok=True)
+    cached, inputs = cache_paths(cache_dir, name)
+    # The inputs must never describe another image
+    inputs.unlink(missing_ok=True)
+    tmp = cached.with_suffix(".tmp")
+    merge_files(parts, tmp)
+    files = builder.list_image_files(tmp)
+    entry = {
+        "version": CACHE_VERSION,
+        "digest": inputs_digest(builder, kernel, preset, files),
+        "image_sha256": file_sha256(tmp),
+        "files": files,
+    }
+    entry["mac"] = key_mac(key_dir, _entry_text(entry))
+    tmp.replace(cached)
+    with open(inputs, "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+        f.write("\n")
+
+
+def remove_unused_initramfs(cache_dir: Path, names: List[str]) -> None:
+    if not cache_dir.exists():
+        return
+    keep: Set[str] = set()
+    for name in names:
+        keep.update(p.name for p in cache_paths(cache_dir, name))
+    for path in cache_dir.iterdir():
+        if path.name not in keep:
+            logging.debug("Remove unused cached initramfs {}".format(path))
+            path.unlink()
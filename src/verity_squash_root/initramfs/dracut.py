@@ -1,10 +1,12 @@
+import re
 from pathlib import Path
-from typing import List
-from verity_squash_root.config import TMPDIR
+from typing import List, Tuple
 from verity_squash_root.exec import exec_binary
 from verity_squash_root.distributions.base import DistributionConfig
 from verity_squash_root.initramfs.base import InitramfsBuilder
 
+LISTING_FILE = re.compile("[-l][-rwxsStT]{9}$")
+
 
 class Dracut(InitramfsBuilder):
 
@@ -21,13 +23,32 @@ class Dracut(InitramfsBuilder):
             self._distribution.display_name(),
             kernel_name.capitalize())
 
-    def build_initramfs_with_microcode(self, kernel: str,
-                                       preset: str) -> Path:
-        merged_initramfs = TMPDIR / "{}-{}.image".format(kernel, preset)
-        exec_binary(["dracut", "--kver", kernel, "--no-uefi",
-                     "--early-microcode", "--add", "verity-squash-root",
-                     str(merged_initramfs)])
-        return merged_initramfs
+    def initramfs_command(self, kernel: str, preset: str, work_dir: Path) \
+            -> Tuple[List[str], List[Path]]:
+        merged_initramfs = work_dir / "initramfs.image"
+        return (["dracut", "--kver", kernel, "--no-uefi",
+                 "--early-microcode", "--add", "verity-squash-root",
+                 "--tmpdir", str(work_dir), str(merged_initramfs)],
+                [merged_initramfs])
 
     def list_kernel_presets(self, kernel: str) -> List[str]:
         return [""]
+
+    def cache_inputs(self, kernel: str, preset: str) -> List[Path]:
+        return [self._distribution.modules_dir(kernel),
+                Path("/etc/dracut.conf"),
+                Path("/etc/dracut.conf.d"),
+                Path("/usr/lib/dracut"),
+                # --early-microcode
+                Path("/usr/lib/firmware/amd-ucode"),
+                Path("/usr/lib/firmware/intel-ucode")]
+
+    def list_image_files(self, image: Path) -> List[str]:
+        stdout = exec_binary(["lsinitrd", str(image)])[0]
+        result = []
+        for line in stdout.decode(errors="surrogateescape").splitlines():
+            # Listed like ls -l, other file types have no host file
+            fields = line.split(None, 8)
+            if len(fields) == 9 and LISTING_FILE.match(fields[0]):
+                result.append(fields[8].split(" -> ")[0])
+        return result
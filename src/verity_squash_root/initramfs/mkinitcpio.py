@@ -1,13 +1,23 @@
 from collections.abc import Mapping
 from pathlib import Path
-from typing import List
-from verity_squash_root.config import TMPDIR, NAME_DASH
+from typing import Dict, List, Optional, Tuple
+from verity_squash_root.config import NAME_DASH
 from verity_squash_root.exec import exec_binary
 from verity_squash_root.file_op import read_text_from, write_str_to
-from verity_squash_root.initramfs import merge_initramfs_images
+from verity_squash_root.initramfs import initramfs_parts
 from verity_squash_root.distributions.base import DistributionConfig
 from verity_squash_root.initramfs.base import InitramfsBuilder
 
+PRESET_DIR = Path("/etc/mkinitcpio.d")
+LIST_PRESETS = "/usr/lib/verity-squash-root/mkinitcpio_list_presets"
+
+
+def preset_mtime(name: str) -> Optional[int]:
+    try:
+        return (PRESET_DIR / "{}.preset".format(name)).stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
 
 class Mkinitcpio(InitramfsBuilder):
     _preset_map: Mapping[str, str] = {"default": ""}
@@ -15,6 +25,8 @@ class Mkinitcpio(InitramfsBuilder):
 
     def __init__(self, distribution: DistributionConfig):
         self._distribution = distribution
+        # preset name => mtime of the preset file, presets
+        self._presets: Dict[str, Tuple[Optional[int], List[str]]] = {}
 
     def file_name(self, kernel: str, preset: str) -> str:
         preset_name = self._preset_map.get(preset, preset)
@@ -35,33 +47,65 @@ class Mkinitcpio(InitramfsBuilder):
             kernel_name.capitalize(),
             preset_name)
 
-    def build_initramfs_with_microcode(self, kernel: str,
-                                       preset: str) -> Path:
+    def initramfs_command(self, kernel: str, preset: str, work_dir: Path) \
+            -> Tuple[List[str], List[Path]]:
         name = self._distribution.kernel_to_name(kernel)
-        config = read_text_from(
-            Path("/etc/mkinitcpio.d") / "{}.preset".format(name))
-        base_path = TMPDIR / "{}-{}".format(name, preset)
-        initcpio_image = Path("{}.initcpio".format(base_path))
-        preset_path = base_path.with_suffix(".preset")
+        config = read_text_from(PRESET_DIR / "{}.preset".format(name))
+        initcpio_image = work_dir / "{}.initcpio".format(preset)
+        preset_path = work_dir / "{}.preset".format(preset)
+        # -t puts the build root of mkinitcpio into work_dir
         write_config = ("{}\n"
                         "PRESETS=('{p}')\n"
                         "{p}_image={}\n"
-                        "{p}_options=\"${{{p}_options}} -A {}\"\n").format(
+                        "{p}_options=\"${{{p}_options}} -A {} -t {}\"\n"
+                        ).format(
             config,
             initcpio_image,
             NAME_DASH,
+            work_dir,
             p=preset)
         write_str_to(preset_path, write_config)
-        exec_binary(["mkinitcpio", "-p", str(preset_path)])
-
-        merged_initramfs = base_path.with_suffix(".image")
-        merge_initramfs_images(initcpio_image,
-                               self._distribution.microcode_paths(),
-                               merged_initramfs)
-        return merged_initramfs
+        return (["mkinitcpio", "-p", str(preset_path)],
+                initramfs_parts(initcpio_image,
+                                self._distribution.microcode_paths()))
 
     def list_kernel_presets(self, kernel: str) -> List[str]:
+        return self.list_all_kernel_presets([kernel])[kernel]
+
+    def list_all_kernel_presets(self, kernels: List[str]) \
+            -> Dict[str, List[str]]:
+        names = {k: self._distribution.kernel_to_name(k) for k in kernels}
+        presets = self._list_presets(list(dict.fromkeys(names.values())))
+        return {k: presets[name] for k, name in names.items()}
+
+    def _list_presets(self, names: List[str]) -> Dict[str, List[str]]:
+        # Sourcing the preset files needs bash, so the presets are cached
+        # until the preset file changes. All presets missing in the cache
+        # are listed by one call.
+        mtimes = {name: preset_mtime(name) for name in names}
+        missing = [name for name in names
+                   if mtimes[name] is None or name not in self._presets or
+                   self._presets[name][0] != mtimes[name]]
+        if len(missing) > 0:
+            listed: Dict[str, List[str]] = {name: [] for name in missing}
+            stdout = exec_binary([LIST_PRESETS] + missing)[0].decode()
+            for line in stdout.splitlines():
+                name, preset = line.rsplit(" ", 1)
+                listed[name].append(preset)
+            for name in missing:
+                self._presets[name] = (mtimes[name], listed[name])
+        return {name: self._presets[name][1] for name in names}
+
+    def cache_inputs(self, kernel: str, preset: str) -> List[Path]:
         name = self._distribution.kernel_to_name(kernel)
-        run = "/usr/lib/verity-squash-root/mkinitcpio_list_presets"
-        presets_str = exec_binary([run, name])[0].decode()
-        return presets_str.strip().split("\n")
+        return [self._distribution.modules_dir(kernel),
+                Path("/etc/mkinitcpio.conf"),
+                Path("/etc/mkinitcpio.conf.d"),
+                PRESET_DIR / "{}.preset".format(name),
+                Path("/etc/initcpio"),
+                Path("/usr/lib/initcpio")] + \
+            self._distribution.microcode_paths()
+
+    def list_image_files(self, image: Path) -> List[str]:
+        stdout = exec_binary(["lsinitcpio", str(image)])[0]
+        return stdout.decode(errors="surrogateescape").splitlines()
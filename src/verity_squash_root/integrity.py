@@ -0,0 +1,16 @@
+import hmac
+from pathlib import Path
+from verity_squash_root.efi import DB_KEY_FILE
+from verity_squash_root.file_op import read_from
+
+
+def key_mac(key_dir: Path, text: str) -> str:
+    # Files stored outside of the image (e.g. on the root partition) can
+    # be modified by an attacker, so they are authenticated with the
+    # secure boot signing key.
+    key = read_from(key_dir / DB_KEY_FILE)
+    return hmac.new(key, text.encode(), "sha256").hexdigest()
+
+
+def key_mac_matches(key_dir: Path, text: str, mac: str) -> bool:
+    return hmac.compare_digest(key_mac(key_dir, text), mac)
@@ -1,23 +1,49 @@
 import logging
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from configparser import ConfigParser
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
 import verity_squash_root.cmdline as cmdline
 import verity_squash_root.efi as efi
 from verity_squash_root.config import TMPDIR, KERNEL_PARAM_BASE, KEY_DIR, \
-    EFI_KERNELS, config_str_to_stripped_arr
+    EFI_KERNELS, REPORT_FILE, config_str_to_stripped_arr, config_str_to_bool
+from verity_squash_root.delta import DeltaBase, base_reference_path, \
+    compute_delta, find_delta_base, link_base, remove_unused_bases, \
+    write_delta_options
 from verity_squash_root.distributions.base import DistributionConfig
 from verity_squash_root.initramfs.base import InitramfsBuilder, \
     iterate_distribution_efi
+from verity_squash_root.initramfs.cache import CACHE_DIR_NAME, \
+    cached_initramfs, remove_unused_initramfs, store_initramfs
 from verity_squash_root.file_names import backup_file, tmpfs_file, tmpfs_label
-from verity_squash_root.file_op import read_text_from
-from verity_squash_root.image import mksquashfs, veritysetup_image, \
-    verity_image_path
+from verity_squash_root.file_op import files_equal, move_file, \
+    read_text_from, write_str_to
+from verity_squash_root.exclude import exclude_patterns
+from verity_squash_root.image import mksquashfs, mksquashfs_cmd, \
+    squashfs_profile, veritysetup_image, verity_image_path
+from verity_squash_root.manifest import manifest_path, read_scan_records, \
+    store_manifest, unchanged_image_root_hash, write_scan
+from verity_squash_root.prescan import format_size, prescan_root
+from verity_squash_root.timing import build_report, stage
+
+# kernel, preset, vmlinuz, base_name, display name
+KernelJob = Tuple[str, str, Path, str, str]
+# Image path in the mksquashfs settings of manifests
+SETTINGS_IMAGE = Path("image.squashfs")
 
 
 def move_kernel_to(src: Path, dst: Path, slot: str,
                    dst_backup: Union[Path, None]) -> None:
+    # Building and signing is reproducible, so an unchanged kernel does
+    # not need to be written to the efi partition again
+    if dst.exists() and files_equal(src, dst):
+        logging.info("Efi {} is unchanged".format(dst.name))
+        src.unlink()
+        return
+    # Copy to the efi partition first, so dst can be replaced atomically
+    tmp_dst = dst.with_name("{}.tmp".format(dst.name))
+    shutil.move(src, tmp_dst)
     if dst.exists():
         overwrite_file = efi.file_matches_slot_or_is_broken(dst, slot)
         if overwrite_file or dst_backup is None:
@@ -26,12 +52,11 @@ def move_kernel_to(src: Path, dst: Path, slot: str,
                 logging.debug("Backup ignored")
             elif overwrite_file:
                 logging.debug("Backup slot kept as is")
-            dst.unlink()
         else:
             logging.info("Moving old efi to backup")
             logging.debug("Path: {}".format(dst_backup))
             dst.replace(dst_backup)
-    shutil.move(src, dst)
+    tmp_dst.replace(dst)
 
 
 def create_squashfs_return_verity_hash(config: ConfigParser, image: Path) \
@@ -41,34 +66,166 @@ def create_squashfs_return_verity_hash(config: ConfigParser, image: Path) \
     efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
     exclude_dirs = config_str_to_stripped_arr(
         config["DEFAULT"]["EXCLUDE_DIRS"])
+    profile = squashfs_profile(config)
     logging.info("Creating squashfs...")
-    mksquashfs(exclude_dirs, image, root_mount, efi_partition)
+    with stage("mksquashfs"):
+        mksquashfs(exclude_dirs, image, root_mount, efi_partition, profile)
     logging.info("Setup device verity")
-    root_hash = veritysetup_image(image)
+    with stage("veritysetup"):
+        root_hash = veritysetup_image(image)
     return root_hash
 
 
-def build_and_move_kernel(config: ConfigParser,
-                          vmlinuz: Path, initramfs: Path,
-                          use_slot: str, root_hash: str, cmdline_add: str,
-                          base_name: str, out_dir: Path,
-                          label: str,
-                          ignore_efis: List[str]):
-    if base_name in ignore_efis:
-        return
-    logging.info("Processing {}".format(label))
+def create_delta_squashfs_return_verity_hash(config: ConfigParser,
+                                             image: Path, scan: Path,
+                                             base: DeltaBase) -> Optional[str]:
+    root_mount = Path(config["DEFAULT"]["ROOT_MOUNT"])
+    efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
+    exclude_dirs = config_str_to_stripped_arr(
+        config["DEFAULT"]["EXCLUDE_DIRS"])
+    excludes, whiteouts = compute_delta(base.records, read_scan_records(scan))
+    options = write_delta_options(excludes, whiteouts, TMPDIR / "delta")
+    if options is None:
+        return None
+    logging.info("Creating delta squashfs against {}...".format(
+        base.image.name))
+    with stage("mksquashfs delta"):
+        mksquashfs(exclude_dirs, image, root_mount, efi_partition,
+                   squashfs_profile(config), options)
+    logging.info("Setup device verity")
+    with stage("veritysetup"):
+        root_hash = veritysetup_image(image)
+    return root_hash
+
+
+def scan_root_return_digest(config: ConfigParser, scan: Path) -> str:
+    root_mount = Path(config["DEFAULT"]["ROOT_MOUNT"])
+    efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
+    exclude_dirs = config_str_to_stripped_arr(
+        config["DEFAULT"]["EXCLUDE_DIRS"])
+    # mksquashfs options are part of the digest, so changing them
+    # results in a new image. Where the image is staged does not change
+    # it, so a fixed path is used.
+    settings = mksquashfs_cmd(exclude_dirs, SETTINGS_IMAGE, root_mount,
+                              efi_partition,
+                              squashfs_profile(config).compression_options())
+    patterns = exclude_patterns(exclude_dirs, root_mount, efi_partition)
+    logging.info("Scanning root for changes...")
+    with stage("scan"):
+        return write_scan(Path("/"), patterns, settings, scan)
+
+
+def move_kernel(tmp_efi_file: Path, use_slot: str, base_name: str,
+                out_dir: Path, ignore_efis: List[str]) -> None:
     out = out_dir / "{}.efi".format(base_name)
     backup_out = None
     backup_base_name = backup_file(base_name)
     if backup_base_name not in ignore_efis:
         backup_out = out_dir / "{}.efi".format(backup_base_name)
     logging.debug("Write efi to {}".format(out))
-    # Store files to sign on trusted tmpfs
-    tmp_efi_file = TMPDIR / "tmp.efi"
-    efi.build_and_sign_kernel(config, vmlinuz, initramfs, use_slot,
-                              root_hash, tmp_efi_file,
-                              cmdline_add)
-    move_kernel_to(tmp_efi_file, out, use_slot, backup_out)
+    with stage("move {}".format(out.name)):
+        move_kernel_to(tmp_efi_file, out, use_slot, backup_out)
+
+
+def build_initramfs_images(initramfs: InitramfsBuilder,
+                           kernel_jobs: List[KernelJob], jobs: int,
+                           cache_dir: Optional[Path] = None) \
+        -> List[List[Path]]:
+    result: List[List[Path]] = []
+    missing = []
+    for index, (kernel, preset, _, base_name, display) in \
+            enumerate(kernel_jobs):
+        cached: Optional[Path] = None
+        if cache_dir is not None:
+            with stage("check cached initramfs {}".format(display)):
+                cached = cached_initramfs(KEY_DIR, cache_dir, initramfs,
+                                          kernel, preset, base_name)
+        if cached is not None:
+            logging.info("Reusing initramfs for {}".format(display))
+            result.append([cached])
+            continue
+        logging.info("Create initramfs for {}".format(display))
+        missing.append(index)
+        result.append([])
+    if len(missing) == 0:
+        return result
+    with stage("initramfs", count=len(missing)):
+        built = initramfs.build_many(
+            [(kernel_jobs[i][0], kernel_jobs[i][1]) for i in missing], jobs)
+    for index, parts in zip(missing, built):
+        kernel, preset, _, base_name, display = kernel_jobs[index]
+        result[index] = parts
+        if cache_dir is not None:
+            with stage("cache initramfs {}".format(display)):
+                store_initramfs(KEY_DIR, cache_dir, initramfs, kernel,
+                                preset, base_name, parts)
+    return result
+
+
+def build_kernel_efis(config: ConfigParser, job: KernelJob,
+                      initramfs: List[Path], use_slot: str, root_hash: str,
+                      ignore_efis: List[str], extra_cmdline: str = "") \
+        -> List[Tuple[Path, str]]:
+    kernel, preset, vmlinuz, base_name, display = job
+    # Every job gets its own directory, so jobs can run in parallel
+    work_dir = TMPDIR / "efi" / base_name
+    create_directory(work_dir)
+    result = []
+    efis = []
+    for (bn, label, cmdline_add) in [
+            (base_name, display, ""),
+            (tmpfs_file(base_name), tmpfs_label(display),
+             "{}_volatile".format(KERNEL_PARAM_BASE))]:
+        if bn in ignore_efis:
+            continue
+        logging.info("Processing {}".format(label))
+        # Store files to sign on trusted tmpfs
+        tmp_efi_file = work_dir / "{}.efi".format(bn)
+        efis.append((tmp_efi_file, " ".join(
+            c for c in [cmdline_add, extra_cmdline] if c != "")))
+        result.append((tmp_efi_file, bn))
+    if len(efis) > 0:
+        # Both variants share the kernel and initramfs, so they are
+        # assembled together
+        efi.build_and_sign_kernels(config, vmlinuz, initramfs,
+                                   use_slot, root_hash, efis)
+    return result
+
+
+def remove_image(image: Path) -> None:
+    image.unlink(missing_ok=True)
+    verity_image_path(image).unlink(missing_ok=True)
+
+
+def list_kernel_jobs(distribution: DistributionConfig,
+                     initramfs: InitramfsBuilder,
+                     ignore_efis: List[str]) -> List[KernelJob]:
+    result = []
+    for [kernel, preset, base_name] in iterate_distribution_efi(distribution,
+                                                                initramfs):
+        vmlinuz = distribution.vmlinuz(kernel)
+        base_name = initramfs.file_name(kernel, preset)
+        base_name_tmpfs = tmpfs_file(base_name)
+        display = initramfs.display_name(kernel, preset)
+
+        if base_name in ignore_efis and base_name_tmpfs in ignore_efis:
+            logging.info("skipping due to ignored kernels")
+            continue
+        result.append((kernel, preset, vmlinuz, base_name, display))
+    return result
+
+
+def stage_image_on_root(config: ConfigParser) -> bool:
+    value = config["DEFAULT"]["STAGE_IMAGE_ON_ROOT_MOUNT"]
+    if value.strip().lower() != "auto":
+        return config_str_to_bool(value)
+    with stage("prescan"):
+        content = prescan_root(config).total()
+    free = shutil.disk_usage(TMPDIR).free
+    logging.info("Image content: {}, {:.1f} MiB free in {}".format(
+        format_size(content), free / 1024 ** 2, TMPDIR))
+    # The content is uncompressed, so the image is smaller
+    return content.bytes > free
 
 
 def create_directory(path: Path):
@@ -77,7 +234,17 @@ def create_directory(path: Path):
 
 def create_image_and_sign_kernel(config: ConfigParser,
                                  distribution: DistributionConfig,
-                                 initramfs: InitramfsBuilder):
+                                 initramfs: InitramfsBuilder,
+                                 jobs: int = 1):
+    # Wall time, cpu time and peak memory of all stages are written to
+    # a json report, also when the build fails
+    with build_report(REPORT_FILE):
+        build_image_and_sign_kernel(config, distribution, initramfs, jobs)
+
+
+def build_image_and_sign_kernel(config: ConfigParser,
+                                distribution: DistributionConfig,
+                                initramfs: InitramfsBuilder, jobs: int = 1):
     kernel_cmdline = read_text_from(Path("/proc/cmdline"))
     use_slot = cmdline.unused_slot(kernel_cmdline)
     efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
@@ -87,53 +254,112 @@ def create_image_and_sign_kernel(config: ConfigParser,
     logging.info("Using slot {} for new image".format(use_slot))
     root_mount = Path(config["DEFAULT"]["ROOT_MOUNT"])
     image = root_mount / "image_{}.squashfs".format(use_slot)
-    tmp_image = TMPDIR / "tmp.squashfs"
-    root_hash = create_squashfs_return_verity_hash(config, tmp_image)
-    logging.debug("Calculated root hash: {}".format(root_hash))
+    # On ROOT_MOUNT, the image does not need memory and is renamed to
+    # its destination instead of copied
+    stage_on_root = stage_image_on_root(config)
+    tmp_image = (root_mount if stage_on_root else TMPDIR) / "tmp.squashfs"
+    tmp_scan = TMPDIR / "tmp.manifest"
     ignore_efis = config_str_to_stripped_arr(
         config["DEFAULT"]["IGNORE_KERNEL_EFIS"])
+    kernel_jobs = list_kernel_jobs(distribution, initramfs, ignore_efis)
+    cache_dir: Optional[Path] = None
+    if config_str_to_bool(config["DEFAULT"]["INITRAMFS_CACHE"]):
+        cache_dir = root_mount / CACHE_DIR_NAME
 
-    for [kernel, preset, base_name] in iterate_distribution_efi(distribution,
-                                                                initramfs):
-        vmlinuz = distribution.vmlinuz(kernel)
-        base_name = initramfs.file_name(kernel, preset)
-        base_name_tmpfs = tmpfs_file(base_name)
-        display = initramfs.display_name(kernel, preset)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        # The initramfs does not depend on the root hash, so it is built
+        # while the squashfs image is created.
+        initramfs_future = executor.submit(build_initramfs_images, initramfs,
+                                           kernel_jobs, jobs, cache_dir)
 
-        if base_name in ignore_efis and base_name_tmpfs in ignore_efis:
-            logging.info("skipping due to ignored kernels")
-            continue
+        digest: Optional[str] = None
+        root_hash: Optional[str] = None
+        base: Optional[DeltaBase] = None
+        incremental = config_str_to_bool(
+            config["DEFAULT"]["INCREMENTAL_BUILD"])
+        delta = config_str_to_bool(config["DEFAULT"]["DELTA_BUILD"])
+        if incremental or delta:
+            digest = scan_root_return_digest(config, tmp_scan)
+        if incremental and digest is not None:
+            root_hash = unchanged_image_root_hash(KEY_DIR, image, digest)
+        reuse_image = root_hash is not None
+        if reuse_image:
+            logging.info("Nothing changed, reusing image of slot {}".format(
+                use_slot))
+        elif delta:
+            base = find_delta_base(KEY_DIR, root_mount, kernel_cmdline)
+        if base is not None:
+            root_hash = create_delta_squashfs_return_verity_hash(
+                config, tmp_image, tmp_scan, base)
+            if root_hash is None:
+                base = None
+            else:
+                link_base(base, root_mount)
+                # Written before the efis, so the base is never removed
+                # while an efi uses it
+                write_str_to(base_reference_path(image), base.name)
+        if root_hash is None:
+            root_hash = create_squashfs_return_verity_hash(config, tmp_image)
+        logging.debug("Calculated root hash: {}".format(root_hash))
+        hash_str: str = root_hash
+        extra_cmdline = "" if base is None else base.cmdline()
 
-        logging.info("Create initramfs for {}".format(display))
-        initramfs_path = initramfs.build_initramfs_with_microcode(
-            kernel, preset)
-
-        def build(bn, label, cmdline_add):
-            build_and_move_kernel(config, vmlinuz, initramfs_path,
-                                  use_slot, root_hash, cmdline_add,
-                                  bn, out_dir, label,
-                                  ignore_efis)
+        def build(job: KernelJob, initrd: List[Path]) \
+                -> List[Tuple[Path, str]]:
+            return build_kernel_efis(config, job, initrd, use_slot, hash_str,
+                                     ignore_efis, extra_cmdline)
 
-        build(base_name, display, "")
-        build(base_name_tmpfs, tmpfs_label(display),
-              "{}_volatile".format(KERNEL_PARAM_BASE))
+        # Results are returned in order, so efis are moved in order
+        for efis in executor.map(build, kernel_jobs,
+                                 initramfs_future.result()):
+            for (efi_file, base_name) in efis:
+                move_kernel(efi_file, use_slot, base_name, out_dir,
+                            ignore_efis)
+    except BaseException:
+        if stage_on_root:
+            # TMPDIR is removed anyway
+            remove_image(tmp_image)
+        raise
+    finally:
+        executor.shutdown(cancel_futures=True)
+    if cache_dir is not None:
+        remove_unused_initramfs(cache_dir, [job[3] for job in kernel_jobs])
 
-    # Only replace old image if initramfs was successfully created
-    shutil.move(tmp_image, image)
-    shutil.move(verity_image_path(tmp_image), verity_image_path(image))
+    if reuse_image:
+        return
+    # The manifest must never describe another image
+    manifest = manifest_path(image)
+    manifest.unlink(missing_ok=True)
+    # Only replace old image if initramfs was successfully created,
+    # when staged on ROOT_MOUNT, this is an atomic rename. The image may
+    # be hard linked to a delta base, which must keep its content.
+    with stage("move image"):
+        move_file(tmp_image, image)
+        move_file(verity_image_path(tmp_image), verity_image_path(image))
+    if base is None:
+        base_reference_path(image).unlink(missing_ok=True)
+        if digest is not None:
+            store_manifest(KEY_DIR, tmp_scan, digest, root_hash, manifest)
+    # A delta image has no manifest, so it is never used as a base
+    remove_unused_bases(root_mount)
 
 
-def backup_and_sign_efi(source: Path, dest: Path):
-    if dest.exists():
-        parent = dest.parent
-        backup_name = backup_file(dest.stem) + dest.suffix
-        backup = parent / backup_name
-        dest.replace(backup)
-    efi.sign(KEY_DIR, source, dest)
+def backup_and_sign_efis(files: List[Tuple[Path, Path]]):
+    # One file after the other, so a failure leaves the following
+    # destinations in place. The key is loaded only once anyway.
+    for source, dest in files:
+        if dest.exists():
+            parent = dest.parent
+            backup_name = backup_file(dest.stem) + dest.suffix
+            backup = parent / backup_name
+            dest.replace(backup)
+        efi.sign(KEY_DIR, source, dest)
 
 
 def backup_and_sign_extra_files(config: ConfigParser):
     extra = config["EXTRA_SIGN"]
+    to_sign = []
     for key in extra.keys():
         logging.info("Signing {}...".format(key))
         files = extra[key].split("=>")
@@ -144,4 +370,5 @@ def backup_and_sign_extra_files(config: ConfigParser):
         dest = Path(files[1].strip())
         logging.debug("Sign file '{}' to '{}'".format(src, dest))
         dest.resolve().parent.mkdir(parents=True, exist_ok=True)
-        backup_and_sign_efi(src, dest)
+        to_sign.append((src, dest))
+    backup_and_sign_efis(to_sign)
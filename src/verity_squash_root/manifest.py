@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Dict, Generator, IO, List, Optional, Tuple
+from verity_squash_root.exclude import CompiledPattern, compile_patterns, \
+    match_entry
+from verity_squash_root.image import verity_image_path
+from verity_squash_root.integrity import key_mac, key_mac_matches
+from verity_squash_root.verity import VerityFormatError, verity_root_hash
+
+MANIFEST_VERSION = 3
+
+
+def manifest_path(image: Path) -> Path:
+    return image.with_suffix("{}.manifest".format(image.suffix))
+
+
+def xattr_digest(path: str) -> str:
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        return ""
+    if len(names) == 0:
+        return ""
+    digest = hashlib.sha256()
+    for name in sorted(names):
+        try:
+            value = os.getxattr(path, name, follow_symlinks=False)
+        except OSError:
+            continue
+        digest.update("{}={}\n".format(name, value.hex()).encode())
+    return digest.hexdigest()
+
+
+def entry_record(path: str, rel: str, st: os.stat_result) -> List[Any]:
+    # Inode numbers are not recorded, squashfs numbers the inodes of
+    # every image anew, so they change after booting another image. The
+    # link count keeps changes of hard links. squashfs stores mtimes in
+    # whole seconds, so that is all that is compared.
+    if stat.S_ISDIR(st.st_mode):
+        # Size, mtime and link count of a directory change with its
+        # entries, which are recorded on their own. Otherwise excluded
+        # mount points (tmp, ROOT_MOUNT, ...) would change the manifest on
+        # every build.
+        links, size, mtime = 0, 0, 0
+    else:
+        links, size = st.st_nlink, st.st_size
+        mtime = st.st_mtime_ns // 10**9
+    return [rel, links, size, mtime, st.st_mode, st.st_uid, st.st_gid,
+            xattr_digest(path)]
+
+
+def scan_entries(root: Path, patterns: List[str]) \
+        -> Generator[List[Any], None, None]:
+    yield entry_record(str(root), "", os.lstat(root))
+    stack: List[Tuple[str, Tuple[str, ...], List[CompiledPattern]]] = [
+        (str(root), (), compile_patterns(patterns))]
+    while len(stack) > 0:
+        directory, parts, candidates = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except FileNotFoundError:
+            continue
+        subdirs: List[Tuple[str, Tuple[str, ...], List[CompiledPattern]]] = []
+        for entry in entries:
+            excluded, remaining = match_entry(candidates, len(parts),
+                                              entry.name)
+            if excluded:
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            entry_parts = parts + (entry.name,)
+            yield entry_record(entry.path, "/".join(entry_parts), st)
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append((entry.path, entry_parts, remaining))
+        stack.extend(reversed(subdirs))
+
+
+def write_scan(root: Path, patterns: List[str], settings: List[str],
+               out: Path) -> str:
+    digest = hashlib.sha256()
+    with open(out, "w", encoding="utf-8") as f:
+        line = json.dumps(settings) + "\n"
+        digest.update(line.encode())
+        f.write(line)
+        for record in scan_entries(root, patterns):
+            line = json.dumps(record) + "\n"
+            digest.update(line.encode())
+            f.write(line)
+    return digest.hexdigest()
+
+
+def _header_text(header: Mapping[str, Any]) -> str:
+    return "{}:{}:{}".format(header["version"], header["digest"],
+                             header["root_hash"])
+
+
+def store_manifest(key_dir: Path, scan: Path, digest: str, root_hash: str,
+                   dest: Path) -> None:
+    header = {
+        "version": MANIFEST_VERSION,
+        "digest": digest,
+        "root_hash": root_hash,
+    }
+    header["mac"] = key_mac(key_dir, _header_text(header))
+    with (open(dest, "w", encoding="utf-8") as dest_fd,
+          open(scan, "r", encoding="utf-8") as scan_fd):
+        dest_fd.write(json.dumps(header) + "\n")
+        shutil.copyfileobj(scan_fd, dest_fd)
+
+
+def read_manifest_header(key_dir: Path, path: Path) \
+        -> Optional[Mapping[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+        valid = header["version"] == MANIFEST_VERSION and \
+            key_mac_matches(key_dir, _header_text(header), header["mac"])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError):
+        valid = False
+    if not valid:
+        logging.warning("Ignoring invalid manifest {}".format(path))
+        return None
+    return header
+
+
+def _read_records(f: IO[str], digest) -> Dict[str, List[Any]]:
+    # The first line contains the mksquashfs settings
+    digest.update(f.readline().encode())
+    records = {}
+    for line in f:
+        digest.update(line.encode())
+        record = json.loads(line)
+        records[record[0]] = record[1:]
+    return records
+
+
+def read_scan_records(scan: Path) -> Dict[str, List[Any]]:
+    with open(scan, "r", encoding="utf-8") as f:
+        return _read_records(f, hashlib.sha256())
+
+
+def read_manifest_records(key_dir: Path, path: Path, root_hash: str) \
+        -> Optional[Dict[str, List[Any]]]:
+    header = read_manifest_header(key_dir, path)
+    if header is None or header["root_hash"] != root_hash:
+        return None
+    digest = hashlib.sha256()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            f.readline()
+            records = _read_records(f, digest)
+    except (OSError, ValueError, IndexError, KeyError, TypeError):
+        records = None
+    # Only the header is authenticated, the records by its digest
+    if records is None or digest.hexdigest() != header["digest"]:
+        logging.warning("Ignoring invalid manifest {}".format(path))
+        return None
+    return records
+
+
+def unchanged_image_root_hash(key_dir: Path, image: Path, digest: str) \
+        -> Optional[str]:
+    if not image.exists() or not verity_image_path(image).exists():
+        return None
+    header = read_manifest_header(key_dir, manifest_path(image))
+    if header is None or header["digest"] != digest:
+        return None
+    # The hash tree might have been replaced since the manifest was stored
+    verity_file = verity_image_path(image)
+    try:
+        root_hash = verity_root_hash(verity_file)
+    except (OSError, VerityFormatError):
+        root_hash = None
+    if root_hash != header["root_hash"]:
+        logging.warning("Root hash of {} does not match its manifest".format(
+            verity_file))
+        return None
+    return root_hash
@@ -19,3 +19,37 @@ class TmpfsMount():
         tmp_umount = ["umount", "-f", "-R", str(self._directory)]
         exec_binary(tmp_umount)
         shutil.rmtree(self._directory)
+
+
+class VerityMount():
+    # Mount a squashfs image read-only via a dm-verity device
+    _image: Path
+    _verity: Path
+    _root_hash: str
+    _name: str
+    _directory: Path
+
+    def __init__(self, image: Path, verity: Path, root_hash: str, name: str,
+                 directory: Path):
+        self._image = image
+        self._verity = verity
+        self._root_hash = root_hash
+        self._name = name
+        self._directory = directory
+
+    def __enter__(self):
+        exec_binary(["veritysetup", "open", str(self._image), self._name,
+                     str(self._verity), self._root_hash])
+        try:
+            self._directory.mkdir()
+            exec_binary(["mount", "-t", "squashfs", "-o", "ro",
+                         "/dev/mapper/{}".format(self._name),
+                         str(self._directory)])
+        except BaseException:
+            exec_binary(["veritysetup", "close", self._name])
+            raise
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        exec_binary(["umount", str(self._directory)])
+        exec_binary(["veritysetup", "close", self._name])
+        self._directory.rmdir()
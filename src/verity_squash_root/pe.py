@@ -0,0 +1,261 @@
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+from verity_squash_root.file_op import copy_file_data
+
+HEADER_READ_SIZE = 4096
+SECTION_HEADER = struct.Struct("<8sIIIIIIHHI")
+# IMAGE_SCN_CNT_INITIALIZED_DATA | IMAGE_SCN_MEM_READ
+SECTION_READ_DATA = 0x40000040
+SECURITY_DIRECTORY = 4
+DEBUG_DIRECTORY = 6
+PE32_MAGIC = 0x10b
+PE32_PLUS_MAGIC = 0x20b
+# Parsed stubs, keyed by (st_dev, st_ino, st_size, st_mtime_ns)
+STUB_CACHE: Dict[Tuple[int, int, int, int], "PEImage"] = {}
+STUB_CACHE_LOCK = threading.Lock()
+# A section is filled with one file or with several files in a row
+SectionData = Union[Path, List[Path]]
+
+
+class PEFormatError(ValueError):
+    pass
+
+
+class PEEmptyError(PEFormatError):
+    pass
+
+
+class PETruncatedError(PEFormatError):
+    pass
+
+
+def align(value: int, alignment: int) -> int:
+    return -(-value // alignment) * alignment
+
+
+class PEImage:
+
+    def __init__(self, headers: bytes):
+        if headers[:2] != b"MZ":
+            raise PEFormatError("No DOS header found")
+        try:
+            self._parse(headers)
+        except struct.error:
+            raise PETruncatedError("Headers are truncated")
+
+    def _parse(self, headers: bytes) -> None:
+        pe_offset = struct.unpack_from("<I", headers, 0x3c)[0]
+        if headers[pe_offset:pe_offset + 4] != b"PE\0\0":
+            raise PEFormatError("No PE signature found")
+        self.coff_offset = pe_offset + 4
+        (self.number_of_sections, self.size_of_optional_header) = \
+            struct.unpack_from("<2xH12xH", headers, self.coff_offset)
+        self.optional_offset = self.coff_offset + 20
+        magic = struct.unpack_from("<H", headers, self.optional_offset)[0]
+        if magic == PE32_PLUS_MAGIC:
+            self.image_base = struct.unpack_from(
+                "<Q", headers, self.optional_offset + 24)[0]
+            self.directories_offset = self.optional_offset + 112
+        elif magic == PE32_MAGIC:
+            self.image_base = struct.unpack_from(
+                "<I", headers, self.optional_offset + 28)[0]
+            self.directories_offset = self.optional_offset + 96
+        else:
+            raise PEFormatError("Unknown optional header magic {}".format(
+                hex(magic)))
+        (self.section_alignment, self.file_alignment) = struct.unpack_from(
+            "<II", headers, self.optional_offset + 32)
+        (self.size_of_image, self.size_of_headers) = struct.unpack_from(
+            "<II", headers, self.optional_offset + 56)
+        self.number_of_directories = struct.unpack_from(
+            "<I", headers, self.directories_offset - 4)[0]
+        self.section_table = \
+            self.optional_offset + self.size_of_optional_header
+        table_end = self.section_table + \
+            SECTION_HEADER.size * self.number_of_sections
+        if table_end > len(headers):
+            raise PETruncatedError("Section table is truncated")
+        self.headers = headers
+        self.sections = [
+            list(SECTION_HEADER.unpack_from(
+                headers, self.section_table + SECTION_HEADER.size * i))
+            for i in range(self.number_of_sections)]
+
+    def data_directory(self, index: int) -> Tuple[int, int]:
+        if index >= self.number_of_directories:
+            return 0, 0
+        return struct.unpack_from(
+            "<II", self.headers, self.directories_offset + 8 * index)
+
+    def end(self) -> int:
+        return max((s[2] + s[1] for s in self.sections), default=0)
+
+    def data_end(self) -> int:
+        return max((s[4] + s[3] for s in self.sections if s[3] > 0),
+                   default=self.size_of_headers)
+
+
+def read_section(path: Path, name: str) -> Optional[bytes]:
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size == 0:
+            raise PEEmptyError("{} is empty".format(path))
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            image = PEImage(data[:HEADER_READ_SIZE])
+            if image.size_of_headers > HEADER_READ_SIZE:
+                image = PEImage(data[:image.size_of_headers])
+            if image.data_end() > size:
+                raise PETruncatedError("{} is truncated".format(path))
+            for s in image.sections:
+                if s[0].rstrip(b"\0") == name.encode():
+                    # The raw data is padded to the file alignment
+                    return data[s[4]:s[4] + min(s[1] or s[3], s[3])]
+    return None
+
+
+def read_pe_image(fd: BinaryIO) -> PEImage:
+    headers = fd.read(HEADER_READ_SIZE)
+    image = PEImage(headers)
+    if image.size_of_headers > len(headers):
+        headers += fd.read(image.size_of_headers - len(headers))
+        image = PEImage(headers)
+    return image
+
+
+def read_stub_image(fd: BinaryIO) -> PEImage:
+    # The same stub is used for every efi file of a build
+    st = os.fstat(fd.fileno())
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with STUB_CACHE_LOCK:
+        image = STUB_CACHE.get(key)
+    if image is None:
+        image = read_pe_image(fd)
+        with STUB_CACHE_LOCK:
+            STUB_CACHE[key] = image
+    return image
+
+
+def section_header(name: str, size: int, address: int, raw_size: int,
+                   offset: int) -> List[Any]:
+    if len(name) > 8:
+        raise ValueError("Section name too long: {}".format(name))
+    return [name.encode(), size, address, raw_size, offset, 0, 0, 0, 0,
+            SECTION_READ_DATA]
+
+
+def write_padding(dest_fd: BinaryIO, position: int, offset: int) -> None:
+    dest_fd.write(bytes(offset - position))
+
+
+def write_file_data(dest_fd: BinaryIO, path: Path, size: int) -> None:
+    with open(path, "rb") as src_fd:
+        copy_file_data(src_fd.fileno(), dest_fd.fileno(), size)
+
+
+def section_files(data: SectionData) -> List[Tuple[Path, int]]:
+    paths = data if isinstance(data, list) else [data]
+    return [(path, path.stat().st_size) for path in paths]
+
+
+def append_sections(stub: Path,
+                    sections: List[Tuple[str, Optional[SectionData]]],
+                    variants: List[Tuple[Path, Path]]) -> None:
+    # The section without a file is the only difference between the
+    # variants, it is filled with the first path of every variant.
+    # Its data is placed at the end of the file, so all other data is
+    # written once and copied for the other variants.
+    variable = [i for i, (_, path) in enumerate(sections) if path is None]
+    if len(variable) != 1:
+        raise ValueError("Exactly one variable section needed")
+    variable_name = sections[variable[0]][0]
+    variant_sizes = [path.stat().st_size for path, _ in variants]
+    with open(stub, "rb") as stub_fd:
+        image = read_stub_image(stub_fd)
+        fa = image.file_alignment
+        sa = image.section_alignment
+        table_end = image.section_table + SECTION_HEADER.size * (
+            image.number_of_sections + len(sections))
+        headers_size = max(image.size_of_headers, align(table_end, fa))
+        shift = headers_size - image.size_of_headers
+        if shift > 0 and image.data_directory(DEBUG_DIRECTORY)[1] > 0:
+            raise PEFormatError(
+                "Not enough header space in {} to add sections".format(stub))
+        stub_end = image.data_end()
+
+        stub_sections = [s[:4] + [s[4] + shift if s[3] > 0 else s[4]] + s[5:]
+                         for s in image.sections]
+        offset = align(stub_end + shift, fa)
+        address = align(image.end(), sa)
+        new_sections: List[List[Any]] = []
+        files = []
+        for name, data in sections:
+            if data is None:
+                # Reserve the address space for the biggest variant
+                size = max(variant_sizes, default=0)
+                new_sections.append(section_header(name, size, address, 0,
+                                                   0))
+            else:
+                parts = section_files(data)
+                size = sum(part_size for _, part_size in parts)
+                new_sections.append(section_header(name, size, address,
+                                                   align(size, fa), offset))
+                files.append((parts, new_sections[-1]))
+                offset += align(size, fa)
+            address = align(address + size, sa)
+        variable_offset = offset
+
+        headers = bytearray(image.headers[:image.size_of_headers])
+        headers += bytes(shift)
+        # The symbol table and signatures behind the sections are dropped,
+        # the signature would be invalid anyway.
+        struct.pack_into("<H", headers, image.coff_offset + 2,
+                         image.number_of_sections + len(new_sections))
+        struct.pack_into("<II", headers, image.coff_offset + 8, 0, 0)
+        # Signing calculates the checksum again
+        struct.pack_into("<III", headers, image.optional_offset + 56,
+                         address, headers_size, 0)
+        if image.number_of_directories > SECURITY_DIRECTORY:
+            struct.pack_into(
+                "<II", headers,
+                image.directories_offset + 8 * SECURITY_DIRECTORY, 0, 0)
+        size_of_data = struct.unpack_from(
+            "<I", headers, image.optional_offset + 8)[0] + \
+            sum(s[3] for s in new_sections)
+
+        first: Optional[Path] = None
+        for (path, dest), size in zip(variants, variant_sizes):
+            new_sections[variable[0]] = section_header(
+                variable_name, size, new_sections[variable[0]][2],
+                align(size, fa), variable_offset)
+            for i, s in enumerate(stub_sections + new_sections):
+                SECTION_HEADER.pack_into(
+                    headers, image.section_table + SECTION_HEADER.size * i,
+                    *s)
+            struct.pack_into("<I", headers, image.optional_offset + 8,
+                             size_of_data + align(size, fa))
+            with open(dest, "wb", buffering=0) as dest_fd:
+                dest_fd.write(headers)
+                if first is None:
+                    copy_file_data(stub_fd.fileno(), dest_fd.fileno(),
+                                   stub_end - image.size_of_headers,
+                                   image.size_of_headers)
+                    position = stub_end + shift
+                    for parts, s in files:
+                        write_padding(dest_fd, position, s[4])
+                        for part, part_size in parts:
+                            write_file_data(dest_fd, part, part_size)
+                        position = s[4] + s[1]
+                    write_padding(dest_fd, position, variable_offset)
+                    first = dest
+                else:
+                    with open(first, "rb") as first_fd:
+                        copy_file_data(first_fd.fileno(), dest_fd.fileno(),
+                                       variable_offset - headers_size,
+                                       headers_size)
+                write_file_data(dest_fd, path, size)
+                position = variable_offset + size
+                write_padding(dest_fd, position, align(position, fa))
@@ -0,0 +1,206 @@
+import logging
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from verity_squash_root.config import config_str_to_stripped_arr
+from verity_squash_root.exclude import CompiledPattern, compile_pattern, \
+    exclude_patterns
+
+# pattern as passed to mksquashfs and its compiled form
+Rule = Tuple[str, CompiledPattern]
+# device and inode of hard linked files
+InodeKey = Tuple[int, int]
+
+
+class SizeCount:
+
+    def __init__(self):
+        self.bytes = 0
+        self.inodes = 0
+
+    def add(self, size: int, inodes: int = 1) -> None:
+        self.bytes += size
+        self.inodes += inodes
+
+
+class SizeReport:
+
+    def __init__(self, patterns: List[str]):
+        self.included: Dict[str, SizeCount] = {}
+        self.excluded: Dict[str, SizeCount] = {p: SizeCount()
+                                               for p in patterns}
+        # Patterns which cannot be evaluated by the scan
+        self.unsupported: List[str] = []
+
+    def total(self) -> SizeCount:
+        result = SizeCount()
+        for count in self.included.values():
+            result.add(count.bytes, count.inodes)
+        return result
+
+
+class TreeResult:
+    # Result of the scan of one top-level directory
+
+    def __init__(self):
+        self.included = SizeCount()
+        self.excluded: Dict[str, SizeCount] = {}
+        # mksquashfs stores hard linked files once
+        self.links: Dict[InodeKey, int] = {}
+
+
+def file_size(st: os.stat_result) -> int:
+    return 0 if stat.S_ISDIR(st.st_mode) else st.st_size
+
+
+def count_tree(path: str, root_dev: int) -> SizeCount:
+    # Other filesystems below excluded directories (/proc, /sys, ...)
+    # are not counted, their sizes are meaningless
+    result = SizeCount()
+    stack = [path]
+    while len(stack) > 0:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if st.st_dev != root_dev:
+                continue
+            result.add(file_size(st))
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(entry.path)
+    return result
+
+
+def match_rules(rules: List[Rule], depth: int, name: str) \
+        -> Tuple[Optional[str], List[Rule]]:
+    # Like match_entry, but returns the matching pattern
+    remaining = []
+    for rule in rules:
+        if rule[1][depth].fullmatch(name) is None:
+            continue
+        if len(rule[1]) == depth + 1:
+            return rule[0], []
+        remaining.append(rule)
+    return None, remaining
+
+
+def add_entry(result: TreeResult,
+              stack: List[Tuple[str, Tuple[str, ...], List[Rule]]],
+              path: str, parts: Tuple[str, ...], name: str,
+              st: os.stat_result, rules: List[Rule], root_dev: int) -> None:
+    is_dir = stat.S_ISDIR(st.st_mode)
+    matched, remaining = match_rules(rules, len(parts), name)
+    if matched is not None:
+        if st.st_dev == root_dev:
+            count = result.excluded.setdefault(matched, SizeCount())
+            count.add(file_size(st))
+            if is_dir:
+                tree = count_tree(path, root_dev)
+                count.add(tree.bytes, tree.inodes)
+        return
+    if not is_dir and st.st_nlink > 1:
+        result.links[(st.st_dev, st.st_ino)] = st.st_size
+    else:
+        result.included.add(file_size(st))
+    if is_dir:
+        stack.append((path, parts + (name,), remaining))
+
+
+def scan_top(root: Path, name: str, rules: List[Rule],
+             root_dev: int) -> TreeResult:
+    result = TreeResult()
+    path = os.path.join(root, name)
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return result
+    stack: List[Tuple[str, Tuple[str, ...], List[Rule]]] = []
+    add_entry(result, stack, path, (), name, st, rules, root_dev)
+    while len(stack) > 0:
+        directory, parts, candidates = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            add_entry(result, stack, entry.path, parts, entry.name, st,
+                      candidates, root_dev)
+    return result
+
+
+def scan_sizes(root: Path, patterns: List[str], jobs: int) -> SizeReport:
+    report = SizeReport(patterns)
+    rules: List[Rule] = []
+    for p in patterns:
+        compiled = compile_pattern(p)
+        if compiled:
+            rules.append((p, compiled))
+        else:
+            del report.excluded[p]
+            report.unsupported.append(p)
+    root_dev = os.lstat(root).st_dev
+    tops = sorted(os.listdir(root))
+    # Every top-level directory is scanned by its own job, scandir and
+    # stat release the GIL
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            lambda name: scan_top(root, name, rules, root_dev), tops)
+        seen = set()
+        for name, result in zip(tops, results):
+            if result.included.inodes == 0 and len(result.links) == 0:
+                # The top-level entry itself is excluded
+                for rule, count in result.excluded.items():
+                    report.excluded[rule].add(count.bytes, count.inodes)
+                continue
+            included = report.included.setdefault(name, SizeCount())
+            included.add(result.included.bytes, result.included.inodes)
+            for key, size in result.links.items():
+                if key not in seen:
+                    seen.add(key)
+                    included.add(size)
+            for rule, count in result.excluded.items():
+                report.excluded[rule].add(count.bytes, count.inodes)
+    return report
+
+
+def prescan_root(config: ConfigParser, jobs: Optional[int] = None) \
+        -> SizeReport:
+    root_mount = Path(config["DEFAULT"]["ROOT_MOUNT"])
+    efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
+    exclude_dirs = config_str_to_stripped_arr(
+        config["DEFAULT"]["EXCLUDE_DIRS"])
+    patterns = exclude_patterns(exclude_dirs, root_mount, efi_partition)
+    logging.info("Scanning sizes of the root...")
+    return scan_sizes(Path("/"), patterns, jobs or os.cpu_count() or 1)
+
+
+def format_size(count: SizeCount) -> str:
+    return "{:.1f} MiB, {} inodes".format(count.bytes / 1024 ** 2,
+                                          count.inodes)
+
+
+def format_size_report(report: SizeReport) -> List[str]:
+    lines = []
+    for name, count in sorted(report.included.items()):
+        lines.append(" + {}: {}".format(name, format_size(count)))
+    for pattern, count in report.excluded.items():
+        lines.append(" - {}: {}".format(pattern, format_size(count)))
+    for pattern in report.unsupported:
+        lines.append(" ? {}: not evaluated".format(pattern))
+    lines.append("Image content: {}".format(format_size(report.total())))
+    lines.append("\n(+ = included, - = excluded, sizes are uncompressed)")
+    return lines
@@ -39,9 +39,9 @@ def setup_systemd_boot(config: ConfigParser,
     boot_efi = Path("/usr/lib/systemd/boot/efi/systemd-bootx64.efi")
     efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
     logging.debug("Sign efi files")
-    efi.sign(KEY_DIR, boot_efi,
-             efi_partition / "EFI/systemd/systemd-bootx64.efi")
-    efi.sign(KEY_DIR, boot_efi, efi_partition / "EFI/BOOT/BOOTX64.EFI")
+    efi.sign_files(KEY_DIR, [
+        (boot_efi, efi_partition / "EFI/systemd/systemd-bootx64.efi"),
+        (boot_efi, efi_partition / "EFI/BOOT/BOOTX64.EFI")])
 
     efi_dirname = distribution.efi_dirname()
     out_dir = Path("/") / EFI_KERNELS / efi_dirname
@@ -0,0 +1,108 @@
+import json
+import logging
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Tuple
+
+REPORT_VERSION = 1
+# Finished stages of the current report
+STAGES: List[Dict[str, Any]] = []
+STAGES_LOCK = threading.Lock()
+REPORT_START = [time.monotonic()]
+# Stages which are running in the current thread or asyncio task
+RUNNING: ContextVar[Tuple[Dict[str, Any], ...]] = ContextVar("RUNNING",
+                                                             default=())
+
+
+def running_stages() -> Tuple[Dict[str, Any], ...]:
+    return RUNNING.get()
+
+
+def add_child_usage(usage: resource.struct_rusage) -> None:
+    # The usage of a child process counts for all stages which run it
+    for record in running_stages():
+        record["child_cpu"] += usage.ru_utime + usage.ru_stime
+        record["child_max_rss_kb"] = max(record["child_max_rss_kb"],
+                                         usage.ru_maxrss)
+
+
+@contextmanager
+def stage(name: str, **details: Any) \
+        -> Generator[Dict[str, Any], None, None]:
+    stages = running_stages()
+    start = time.monotonic()
+    cpu_start = time.thread_time()
+    record: Dict[str, Any] = {
+        "name": name,
+        "depth": len(stages),
+        "start": round(start - REPORT_START[0], 6),
+        "child_cpu": 0.0,
+        "child_max_rss_kb": 0,
+    }
+    record.update(details)
+    token = RUNNING.set(stages + (record,))
+    try:
+        yield record
+    finally:
+        RUNNING.reset(token)
+        record["wall"] = round(time.monotonic() - start, 6)
+        record["cpu"] = round(time.thread_time() - cpu_start, 6)
+        record["child_cpu"] = round(record["child_cpu"], 6)
+        # Peak of the whole process, ru_maxrss is never reset
+        record["max_rss_kb"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+        with STAGES_LOCK:
+            STAGES.append(record)
+
+
+def start_report() -> None:
+    with STAGES_LOCK:
+        STAGES.clear()
+        REPORT_START[0] = time.monotonic()
+
+
+def create_report(failed: bool) -> Dict[str, Any]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with STAGES_LOCK:
+        stages = sorted(STAGES, key=lambda s: s["start"])
+        wall = time.monotonic() - REPORT_START[0]
+    return {
+        "version": REPORT_VERSION,
+        "failed": failed,
+        "wall": round(wall, 6),
+        "cpu": round(own.ru_utime + own.ru_stime, 6),
+        "child_cpu": round(children.ru_utime + children.ru_stime, 6),
+        "max_rss_kb": own.ru_maxrss,
+        "child_max_rss_kb": children.ru_maxrss,
+        "stages": stages,
+    }
+
+
+def write_report(path: Path, failed: bool) -> None:
+    report = create_report(failed)
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+            f.write("\n")
+    except OSError as e:
+        # The report must not fail a build
+        logging.warning("Could not write build report: {}".format(e))
+        return
+    logging.debug("Build report written to {}".format(path))
+
+
+@contextmanager
+def build_report(path: Path) -> Generator[None, None, None]:
+    start_report()
+    failed = True
+    try:
+        with stage("build"):
+            yield
+        failed = False
+    finally:
+        write_report(path, failed)
@@ -0,0 +1,120 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Dict, List, Tuple
+from verity_squash_root.config import TMPDIR, KERNEL_PARAM_BASE, \
+    config_str_to_stripped_arr
+from verity_squash_root.delta import base_reference_path
+from verity_squash_root.exec import exec_binary
+from verity_squash_root.file_op import files_equal
+from verity_squash_root.image import mksquashfs, squashfs_profile, \
+    verity_image_path
+from verity_squash_root.mount import VerityMount
+from verity_squash_root.timing import stage
+from verity_squash_root.verity import read_superblock, verity_hash_file, \
+    verity_root_hash
+
+VERIFY_DIR = TMPDIR / "verify"
+DEVICE_NAME = "{}_verify".format(KERNEL_PARAM_BASE)
+# unsquashfs lists all paths below this directory
+LISTING_ROOT = " squashfs-root"
+
+
+def image_listing(image: Path) -> Dict[str, str]:
+    # path => permissions, owner, size and mtime
+    stdout, _ = exec_binary(["unsquashfs", "-lln", str(image)])
+    result = {}
+    for line in stdout.decode(errors="surrogateescape").splitlines():
+        pos = line.find(LISTING_ROOT)
+        if pos == -1:
+            continue
+        path = line[pos + len(LISTING_ROOT):] or "/"
+        result[path] = line[:pos]
+    return result
+
+
+def diff_listings(expected: Dict[str, str], actual: Dict[str, str]) \
+        -> Tuple[List[str], List[str]]:
+    # Returns the differences and the regular files to compare
+    differences = []
+    regular = []
+    for path in sorted(expected.keys() | actual.keys()):
+        if path not in actual:
+            differences.append("missing in rebuild: {}".format(path))
+        elif path not in expected:
+            differences.append("new in rebuild: {}".format(path))
+        elif expected[path] != actual[path]:
+            differences.append("metadata differs: {}: {} != {}".format(
+                path, expected[path].strip(), actual[path].strip()))
+        elif expected[path].startswith("-"):
+            regular.append(path)
+    return differences, regular
+
+
+def diff_contents(expected: Path, actual: Path, paths: List[str],
+                  jobs: int) -> List[str]:
+    def differs(path: str) -> bool:
+        rel = path.lstrip("/")
+        return not files_equal(expected / rel, actual / rel)
+
+    # Reading the verity devices is the bottleneck, so files are
+    # compared in parallel
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return ["content differs: {}".format(path)
+                for path, different in zip(paths,
+                                           executor.map(differs, paths))
+                if different]
+
+
+def compare_images(image: Path, image_hash: str, rebuild: Path,
+                   rebuild_hash: str, jobs: int) -> List[str]:
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        expected, actual = executor.map(image_listing, [image, rebuild])
+    differences, regular = diff_listings(expected, actual)
+    with (VerityMount(image, verity_image_path(image), image_hash,
+                      "{}_slot".format(DEVICE_NAME), VERIFY_DIR / "slot"),
+          VerityMount(rebuild, verity_image_path(rebuild), rebuild_hash,
+                      "{}_rebuild".format(DEVICE_NAME),
+                      VERIFY_DIR / "rebuild")):
+        differences += diff_contents(VERIFY_DIR / "slot",
+                                     VERIFY_DIR / "rebuild", regular, jobs)
+    if len(differences) == 0:
+        differences.append("All files are equal, only the layout of the "
+                           "squashfs image differs")
+    return differences
+
+
+def verify_build(config: ConfigParser, slot: str, jobs: int) -> List[str]:
+    root_mount = Path(config["DEFAULT"]["ROOT_MOUNT"])
+    efi_partition = Path(config["DEFAULT"]["EFI_PARTITION"])
+    exclude_dirs = config_str_to_stripped_arr(
+        config["DEFAULT"]["EXCLUDE_DIRS"])
+    image = root_mount / "image_{}.squashfs".format(slot)
+    if base_reference_path(image).exists():
+        raise ValueError("Image of slot {} is a delta image, only full "
+                         "images can be verified".format(slot))
+    verity = verity_image_path(image)
+    # The rebuilt image uses the salt of the slot image, so the root
+    # hashes are equal if the images are equal
+    salt, verity_uuid, _ = read_superblock(verity)
+    image_hash = verity_root_hash(verity)
+    VERIFY_DIR.mkdir(parents=True, exist_ok=True)
+    rebuild = VERIFY_DIR / "image.squashfs"
+    try:
+        logging.info("Rebuilding image of slot {}...".format(slot))
+        with stage("mksquashfs"):
+            mksquashfs(exclude_dirs, rebuild, root_mount, efi_partition,
+                       squashfs_profile(config))
+        with stage("veritysetup"):
+            rebuild_hash = verity_hash_file(rebuild,
+                                            verity_image_path(rebuild), jobs,
+                                            salt, verity_uuid)
+        if rebuild_hash == image_hash:
+            return []
+        logging.warning("Rebuilt image differs, comparing files...")
+        return compare_images(image, image_hash, rebuild, rebuild_hash,
+                              jobs)
+    finally:
+        rebuild.unlink(missing_ok=True)
+        verity_image_path(rebuild).unlink(missing_ok=True)
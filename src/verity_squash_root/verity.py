@@ -0,0 +1,235 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Deque, List, Optional, Tuple, Union
+from verity_squash_root.file_op import copy_file_data
+
+# Same defaults as veritysetup format
+BLOCK_SIZE = 4096
+HASH_NAME = "sha256"
+SALT_SIZE = 32
+VERITY_SIGNATURE = b"verity\0\0"
+VERITY_VERSION = 1
+VERITY_HASH_TYPE = 1
+SUPERBLOCK = struct.Struct("<8sII16s32sIIQH6x256s168x")
+# Blocks hashed by one job
+CHUNK_BLOCKS = 2048
+READ_SIZE = CHUNK_BLOCKS * BLOCK_SIZE
+
+
+def hash_blocks(base, data: Union[bytes, memoryview]) -> bytes:
+    # base is a hash object which already contains the salt
+    result = bytearray()
+    view = memoryview(data)
+    for offset in range(0, len(view), BLOCK_SIZE):
+        h = base.copy()
+        h.update(view[offset:offset + BLOCK_SIZE])
+        result += h.digest()
+    return bytes(result)
+
+
+def pad_block(data: bytes) -> bytes:
+    return data + bytes(-len(data) % BLOCK_SIZE)
+
+
+class VerityHashTree:
+    # Creates the same hash tree as veritysetup format, the data can be
+    # added in pieces while it is written. The lowest level (1/128 of the
+    # data) is written to a scratch file in scratch_dir, only the levels
+    # above it are kept in memory.
+
+    def __init__(self, jobs: int = 1, salt: Optional[bytes] = None,
+                 verity_uuid: Optional[uuid.UUID] = None,
+                 scratch_dir: Optional[Path] = None):
+        self.salt = os.urandom(SALT_SIZE) if salt is None else salt
+        if len(self.salt) > 256:
+            raise ValueError("Salt is too long")
+        self.uuid = uuid.uuid4() if verity_uuid is None else verity_uuid
+        self.data_blocks = 0
+        self._base = hashlib.new(HASH_NAME, self.salt)
+        self._jobs = jobs
+        self._buffer = bytearray()
+        self._scratch_dir = scratch_dir
+        self._level0: Optional[IO[bytes]] = None
+        self._pending: Deque[Future] = deque()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if jobs > 1:
+            # hashlib releases the GIL for blocks of this size
+            self._executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def __enter__(self) -> "VerityHashTree":
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb) -> None:
+        self.close()
+        self._close_level0()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _close_level0(self) -> None:
+        if self._level0 is not None:
+            self._level0.close()
+            self._level0 = None
+
+    def _write_digests(self, digests: bytes) -> None:
+        if self._level0 is None:
+            self._level0 = tempfile.TemporaryFile(dir=self._scratch_dir)
+        self._level0.write(digests)
+
+    def _hash_chunk(self, chunk: Union[bytes, memoryview]) -> None:
+        self.data_blocks += len(chunk) // BLOCK_SIZE
+        if self._executor is None:
+            self._write_digests(hash_blocks(self._base, chunk))
+            return
+        self._pending.append(self._executor.submit(hash_blocks, self._base,
+                                                   chunk))
+        # Limit the memory used by queued data
+        while len(self._pending) > 2 * self._jobs:
+            self._write_digests(self._pending.popleft().result())
+
+    def update(self, data: Union[bytes, memoryview]) -> None:
+        view = memoryview(data)
+        if len(self._buffer) > 0:
+            missing = -len(self._buffer) % READ_SIZE
+            self._buffer += view[:missing]
+            view = view[missing:]
+            if len(self._buffer) < READ_SIZE:
+                return
+            self._hash_chunk(bytes(self._buffer))
+            self._buffer.clear()
+        # Whole chunks are hashed without copying them
+        full = len(view) - len(view) % READ_SIZE
+        for offset in range(0, full, READ_SIZE):
+            self._hash_chunk(view[offset:offset + READ_SIZE])
+        self._buffer += view[full:]
+
+    def wait(self) -> None:
+        # Afterwards no job uses the data passed to update anymore
+        while len(self._pending) > 0:
+            self._write_digests(self._pending.popleft().result())
+
+    def _finish_data(self) -> None:
+        # Like veritysetup, a partial block at the end is not part of
+        # the data
+        full = len(self._buffer) - len(self._buffer) % BLOCK_SIZE
+        if full > 0:
+            self._hash_chunk(bytes(self._buffer[:full]))
+        self._buffer.clear()
+        self.wait()
+        self.close()
+
+    def superblock(self) -> bytes:
+        return SUPERBLOCK.pack(
+            VERITY_SIGNATURE, VERITY_VERSION, VERITY_HASH_TYPE,
+            self.uuid.bytes, HASH_NAME.encode(), BLOCK_SIZE, BLOCK_SIZE,
+            self.data_blocks, len(self.salt), self.salt)
+
+    def finish(self, verity_file: Path) -> str:
+        self._finish_data()
+        try:
+            if self._level0 is None:
+                raise ValueError("No data to create a hash tree for")
+            return self._write_tree(self._level0, verity_file)
+        finally:
+            self._close_level0()
+
+    def _write_tree(self, level0: IO[bytes], verity_file: Path) -> str:
+        levels: List[bytes] = []
+        level0_size = level0.tell()
+        if self.data_blocks == 1:
+            # The hash of the only block is the root hash
+            level0.seek(0)
+            digests = level0.read()
+            level0_size = 0
+        else:
+            level0.write(bytes(-level0_size % BLOCK_SIZE))
+            level0_size = level0.tell()
+            level0.seek(0)
+            # The second level is computed from the scratch file
+            digests = b"".join(
+                hash_blocks(self._base, chunk)
+                for chunk in iter(lambda: level0.read(READ_SIZE), b""))
+        # Every level hashes the blocks of the level below, until there
+        # is only one block left, whose hash is the root hash
+        while len(digests) > hashlib.new(HASH_NAME).digest_size:
+            level = pad_block(digests)
+            levels.append(level)
+            digests = hash_blocks(self._base, level)
+        level0.flush()
+        with open(verity_file, "wb") as f:
+            f.write(pad_block(self.superblock()))
+            # The top level is stored first
+            for level in reversed(levels):
+                f.write(level)
+            f.flush()
+            copy_file_data(level0.fileno(), f.fileno(), level0_size)
+        return digests.hex()
+
+
+class VerityFormatError(ValueError):
+    pass
+
+
+def read_superblock(verity_file: Path) -> Tuple[bytes, uuid.UUID, int]:
+    # Returns salt, uuid and number of data blocks of a hash tree
+    # created by veritysetup format or VerityHashTree
+    with open(verity_file, "rb") as f:
+        data = f.read(SUPERBLOCK.size)
+    if len(data) < SUPERBLOCK.size:
+        raise VerityFormatError("{} is truncated".format(verity_file))
+    (signature, version, hash_type, verity_uuid, hash_name, data_size,
+     hash_size, data_blocks, salt_size, salt) = SUPERBLOCK.unpack(data)
+    if signature != VERITY_SIGNATURE or version != VERITY_VERSION or \
+            hash_type != VERITY_HASH_TYPE or \
+            hash_name.rstrip(b"\0") != HASH_NAME.encode() or \
+            data_size != BLOCK_SIZE or hash_size != BLOCK_SIZE:
+        raise VerityFormatError(
+            "{} is not a supported hash tree".format(verity_file))
+    return salt[:salt_size], uuid.UUID(bytes=verity_uuid), data_blocks
+
+
+def verity_root_hash(verity_file: Path) -> str:
+    salt, _, data_blocks = read_superblock(verity_file)
+    if data_blocks < 2:
+        raise VerityFormatError(
+            "{} has no hash blocks".format(verity_file))
+    # The top level is a single block stored after the superblock
+    with open(verity_file, "rb") as f:
+        f.seek(BLOCK_SIZE)
+        top = f.read(BLOCK_SIZE)
+    if len(top) != BLOCK_SIZE:
+        raise VerityFormatError("{} is truncated".format(verity_file))
+    return hashlib.new(HASH_NAME, salt + top).hexdigest()
+
+
+def verity_hash_file(image: Path, verity_file: Path, jobs: int = 1,
+                     salt: Optional[bytes] = None,
+                     verity_uuid: Optional[uuid.UUID] = None) -> str:
+    # Hashing from a memory map reads the page cache directly instead of
+    # copying it for every read. The scratch file is on the same file
+    # system as the image, which is ROOT_MOUNT for images that do not fit
+    # into memory.
+    with VerityHashTree(jobs, salt, verity_uuid,
+                        verity_file.parent) as tree:
+        with open(image, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    view = memoryview(data)
+                    try:
+                        tree.update(view)
+                        tree.wait()
+                    finally:
+                        # No job may use the map after it is closed
+                        tree.close()
+                        view.release()
+        return tree.finish(verity_file)
@@ -0,0 +1,102 @@
+import hashlib
+import shutil
+import struct
+import unittest
+from .test_helper import get_test_files_path, wrap_tempdir
+from verity_squash_root.authenticode import AuthenticodeSigner, \
+    HAS_CRYPTOGRAPHY, checksum_add, checksum_finish, der, der_content, \
+    der_int, der_oid, der_set, hash_ranges
+from verity_squash_root.file_op import read_from
+from verity_squash_root.pe import PEFormatError, PEImage
+
+TEST_FILES_DIR = get_test_files_path("authenticode")
+STUB = get_test_files_path("efi") / "stub_slot_a.efi"
+# Verified with openssl smime -verify and pefile
+SIGNED_STUB_SHA256 = \
+    "c6ab3119a117cf85dbc687d549576b603c21c07d4a9d0ee42c98a1db5d45dec8"
+STUB_AUTHENTICODE_DIGEST = \
+    "586751136be47e7e10871fb17c8d9ff88b823c4c1895a568fff4ad908408e88c"
+
+
+def sha256(path) -> str:
+    return hashlib.sha256(read_from(path)).hexdigest()
+
+
+class AuthenticodeTest(unittest.TestCase):
+
+    def test__der(self):
+        self.assertEqual(der(0x04, b"ab"), bytes.fromhex("04026162"))
+        self.assertEqual(der(0x04, bytes(200))[:3], bytes.fromhex("0481c8"))
+        self.assertEqual(der(0x04, bytes(300))[:4],
+                         bytes.fromhex("0482012c"))
+        self.assertEqual(der_content(der(0x04, bytes(300))), bytes(300))
+        self.assertEqual(der_content(der(0x04, b"ab")), b"ab")
+        self.assertEqual(der_int(0), bytes.fromhex("020100"))
+        self.assertEqual(der_int(127), bytes.fromhex("02017f"))
+        self.assertEqual(der_int(128), bytes.fromhex("02020080"))
+        self.assertEqual(der_int(4660), bytes.fromhex("02021234"))
+        self.assertEqual(der_oid("1.2.840.113549.1.7.2"),
+                         bytes.fromhex("06092a864886f70d010702"))
+        self.assertEqual(der_set(b"\x02\x01\x05", b"\x02\x01\x01"),
+                         bytes.fromhex("3106020101020105"))
+
+    def test__checksum(self):
+        self.assertEqual(checksum_finish(checksum_add(0, 0, b"\1\2\3"), 3),
+                         0x0201 + 0x0003 + 3)
+        # odd offsets are the high byte of a word
+        self.assertEqual(checksum_add(0, 1, b"\1"), 0x100)
+        self.assertEqual(checksum_add(0xfffe, 0, b"\2\0"), 1)
+        self.assertEqual(checksum_finish(0, 10), 0xffff + 10)
+
+    def test__hash_ranges(self):
+        image = PEImage(read_from(STUB))
+        ranges, checksum_offset, security_offset = hash_ranges(image, 0xb6f0)
+        self.assertEqual(checksum_offset, 0xd8)
+        self.assertEqual(security_offset, 0x128)
+        self.assertEqual(
+            ranges,
+            [(0, 0xd8), (0xdc, 0x128), (0x130, 0x2f0), (0x2f0, 0x4f0),
+             (0x4f0, 0x72f0), (0x72f0, 0x74f0), (0x74f0, 0x9ef0),
+             (0x9ef0, 0xa0f0), (0xa0f0, 0xb0f0), (0xb0f0, 0xb2f0),
+             (0xb2f0, 0xb4f0), (0xb4f0, 0xb6f0), (0xb6f0, 0xb6f0)])
+        with self.assertRaises(PEFormatError) as e_ctx:
+            hash_ranges(image, 0xb000)
+        self.assertEqual(str(e_ctx.exception), "File is truncated")
+
+    @unittest.skipUnless(HAS_CRYPTOGRAPHY, "cryptography is not installed")
+    @wrap_tempdir
+    def test__sign_file(self, tempdir):
+        signer = AuthenticodeSigner.from_files(TEST_FILES_DIR / "db.key",
+                                               TEST_FILES_DIR / "db.crt")
+        out = tempdir / "out.efi"
+        signer.sign_file(STUB, out)
+        self.assertEqual(sha256(out), SIGNED_STUB_SHA256)
+        data = read_from(out)
+        table_offset, table_size = struct.unpack_from("<II", data, 0x128)
+        # the old signature of the stub is replaced
+        self.assertEqual(table_offset, 0xcf50)
+        self.assertEqual(table_offset + table_size, len(data))
+        length, revision, cert_type = struct.unpack_from(
+            "<IHH", data, table_offset)
+        self.assertEqual((revision, cert_type), (0x200, 2))
+        self.assertIn(bytes.fromhex(STUB_AUTHENTICODE_DIGEST),
+                      data[table_offset:table_offset + length])
+
+        # in place and signing a signed file replaces the signature
+        in_place = tempdir / "in_place.efi"
+        shutil.copyfile(STUB, in_place)
+        signer.sign_file(in_place, in_place)
+        self.assertEqual(sha256(in_place), SIGNED_STUB_SHA256)
+        signer.sign_file(in_place, in_place)
+        self.assertEqual(sha256(in_place), SIGNED_STUB_SHA256)
+
+    @unittest.skipUnless(HAS_CRYPTOGRAPHY, "cryptography is not installed")
+    @wrap_tempdir
+    def test__sign_file__invalid(self, tempdir):
+        signer = AuthenticodeSigner(read_from(TEST_FILES_DIR / "db.key"),
+                                    read_from(TEST_FILES_DIR / "db.crt"))
+        truncated = tempdir / "truncated.efi"
+        truncated.write_bytes(read_from(STUB)[:0x5000])
+        with self.assertRaises(PEFormatError) as e_ctx:
+            signer.sign_file(truncated, tempdir / "out.efi")
+        self.assertEqual(str(e_ctx.exception), "File is truncated")
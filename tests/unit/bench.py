@@ -0,0 +1,142 @@
+import unittest
+from configparser import ConfigParser
+from pathlib import Path
+from unittest import mock
+from unittest.mock import call
+from .test_helper import wrap_tempdir
+from verity_squash_root.bench import BenchResult, bench_squashfs, \
+    format_results, list_files, random_read, sequential_read
+
+
+def bench_config() -> ConfigParser:
+    config = ConfigParser()
+    config.read_string(
+        "[DEFAULT]\n"
+        "ROOT_MOUNT = /mnt/root\n"
+        "EFI_PARTITION = /boot/efi\n"
+        "EXCLUDE_DIRS = /home\n"
+        "[SQUASHFS_PROFILE:default]\n"
+        "[SQUASHFS_PROFILE:fast]\n"
+        "COMPRESSOR = zstd\n"
+        "COMPRESSION_LEVEL = 1\n")
+    return config
+
+
+class BenchTest(unittest.TestCase):
+
+    @wrap_tempdir
+    def test__list_files(self, tempdir):
+        (tempdir / "b").mkdir()
+        (tempdir / "b" / "file").write_bytes(b"12345")
+        (tempdir / "a").write_bytes(b"1")
+        (tempdir / "empty").write_bytes(b"")
+        (tempdir / "link").symlink_to(tempdir / "a")
+        self.assertEqual(list_files(tempdir),
+                         [(tempdir / "a", 1), (tempdir / "b" / "file", 5)])
+
+    @wrap_tempdir
+    def test__read(self, tempdir):
+        (tempdir / "a").write_bytes(bytes(300 * 1024))
+        (tempdir / "b").write_bytes(bytes(10))
+        files = list_files(tempdir)
+        with mock.patch("verity_squash_root.bench.time.monotonic",
+                        side_effect=[1.0, 3.0, 1.0, 5.0]):
+            self.assertEqual(sequential_read(files, 1024 ** 2),
+                             (300 * 1024 + 10) / 2)
+            # Stops at the limit
+            self.assertEqual(sequential_read(files, 140 * 1024),
+                             256 * 1024 / 4)
+        with mock.patch("verity_squash_root.bench.time.monotonic",
+                        side_effect=[1.0, 2.0, 1.0, 2.0]):
+            first = random_read(files, 100)
+            # The same blocks are read every time
+            self.assertEqual(random_read(files, 100), first)
+        self.assertGreater(first, 100 * 4096 / 2)
+        self.assertLessEqual(first, 100 * 4096)
+        self.assertEqual(random_read([], 100), 0.0)
+
+    @wrap_tempdir
+    def test__bench_squashfs(self, tempdir):
+        base = "verity_squash_root.bench"
+        all_mocks = mock.MagicMock()
+        config = bench_config()
+        image = tempdir / "fast.squashfs"
+        verity = tempdir / "fast.squashfs.verity"
+        files = [(Path("/a"), 5)]
+
+        def mksquashfs(exclude_dirs, image, root_mount, efi_partition,
+                       profile):
+            image.write_bytes(bytes(4096))
+
+        def veritysetup_image(image):
+            verity.write_bytes(b"1")
+            return "hash"
+
+        all_mocks.mksquashfs.side_effect = mksquashfs
+        all_mocks.veritysetup_image.side_effect = veritysetup_image
+        all_mocks.list_files.return_value = files
+        all_mocks.sequential_read.return_value = 10.0
+        all_mocks.random_read.return_value = 5.0
+        with (mock.patch("{}.BENCH_DIR".format(base), new=tempdir),
+              mock.patch("{}.mksquashfs".format(base),
+                         new=all_mocks.mksquashfs),
+              mock.patch("{}.veritysetup_image".format(base),
+                         new=all_mocks.veritysetup_image),
+              mock.patch("{}.VerityMount".format(base),
+                         new=all_mocks.VerityMount),
+              mock.patch("{}.list_files".format(base),
+                         new=all_mocks.list_files),
+              mock.patch("{}.drop_caches".format(base),
+                         new=all_mocks.drop_caches),
+              mock.patch("{}.sequential_read".format(base),
+                         new=all_mocks.sequential_read),
+              mock.patch("{}.random_read".format(base),
+                         new=all_mocks.random_read)):
+            result = bench_squashfs(config, ["fast"])
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].name, "fast")
+        self.assertEqual(result[0].options,
+                         ["-comp", "zstd", "-Xcompression-level", "1"])
+        self.assertEqual(result[0].image_size, 4096)
+        self.assertEqual(result[0].sequential_read, 10.0)
+        self.assertEqual(result[0].random_read, 5.0)
+        self.assertEqual(
+            all_mocks.mock_calls,
+            [call.mksquashfs(["/home"], image, Path("/mnt/root"),
+                             Path("/boot/efi"), mock.ANY),
+             call.veritysetup_image(image),
+             call.VerityMount(image, verity, "hash",
+                              "verity_squash_root_bench", tempdir / "mnt"),
+             call.VerityMount().__enter__(),
+             call.list_files(tempdir / "mnt"),
+             call.drop_caches(),
+             call.sequential_read(files, 256 * 1024 ** 2),
+             call.drop_caches(),
+             call.random_read(files, 4096),
+             call.VerityMount().__exit__(None, None, None)])
+        # Only one image is kept in memory
+        self.assertFalse(image.exists())
+        self.assertFalse(verity.exists())
+
+        with self.assertRaises(ValueError) as e_ctx:
+            bench_squashfs(config, ["default", "missing"])
+        self.assertEqual(str(e_ctx.exception),
+                         "Squashfs profile missing is not configured, add a "
+                         "section [SQUASHFS_PROFILE:missing]")
+
+    def test__format_results(self):
+        default = BenchResult("default", [])
+        default.build_time = 100.04
+        default.image_size = 3 * 1024 ** 3
+        default.verity_time = 5.0
+        default.sequential_read = 500 * 1024 ** 2
+        default.random_read = 20.25 * 1024 ** 2
+        fast = BenchResult("fast", ["-comp", "zstd"])
+        self.assertEqual(
+            format_results([default, fast]),
+            ["profile  options     build s  size MiB  verity s  seq MiB/s"
+             "  random MiB/s",
+             "default  -           100.0    3072.0    5.0       500.0"
+             "      20.2",
+             "fast     -comp zstd  0.0      0.0       0.0       0.0"
+             "        0.0"])
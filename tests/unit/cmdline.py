@@ -1,9 +1,17 @@
 import unittest
-from verity_squash_root.cmdline import current_slot, unused_slot
+from verity_squash_root.cmdline import current_slot, kernel_param, \
+    unused_slot
 
 
 class CmdlineTest(unittest.TestCase):
 
+    def test__kernel_param(self):
+        cmdline = ("root=L=5 verity_squash_root_base=base_1 "
+                   "verity_squash_root_base_hash=12ab\n")
+        self.assertEqual(kernel_param(cmdline, "base"), "base_1")
+        self.assertEqual(kernel_param(cmdline, "base_hash"), "12ab")
+        self.assertEqual(kernel_param(cmdline, "slot"), None)
+
     def test__current_slot(self):
         self.assertEqual(
             current_slot("root=L=5 rw verity_squash_root_slot=a pti=on"),
@@ -11,6 +19,9 @@ class CmdlineTest(unittest.TestCase):
         self.assertEqual(
             current_slot("crpytroot verity_squash_root_slot=b tsx=off"),
             "b")
+        self.assertEqual(
+            current_slot("crpytroot verity_squash_root_slot=A\n"),
+            "a")
         self.assertEqual(
             current_slot("crpytroot pti=on tsx=off"),
             None)
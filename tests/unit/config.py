@@ -3,7 +3,8 @@ from pathlib import Path
 from unittest import mock
 from tests.unit.test_helper import PROJECT_ROOT
 from verity_squash_root.config import config_str_to_stripped_arr, \
-    read_config, check_config, is_volatile_boot, check_config_and_system
+    config_str_to_bool, read_config, check_config, is_volatile_boot, \
+    check_config_and_system
 
 
 class ConfigTest(unittest.TestCase):
@@ -14,6 +15,15 @@ class ConfigTest(unittest.TestCase):
                 " var/!(lib) ,/mnt/test\n,another/dir/ ,testdir"),
             ["var/!(lib)", "/mnt/test", "another/dir/", "testdir"])
 
+    def test__config_str_to_bool(self):
+        for s in ["1", "yes", " True", "on\n"]:
+            self.assertTrue(config_str_to_bool(s))
+        for s in ["0", "no", "False ", "off", ""]:
+            self.assertFalse(config_str_to_bool(s))
+        with self.assertRaises(ValueError) as e:
+            config_str_to_bool("maybe")
+        self.assertEqual(str(e.exception), "Not a boolean value: maybe")
+
     @mock.patch("verity_squash_root.config.ConfigParser")
     def test__read_config(self, cp_mock):
         result = read_config()
@@ -50,6 +50,8 @@ class DecryptTest(unittest.TestCase):
         config = mock.Mock()
         with (mock.patch("{}.decrypt_secure_boot_keys".format(base),
                          new=all_mocks.decrypt_secure_boot_keys),
+              mock.patch("{}.forget_signers".format(base),
+                         new=all_mocks.forget_signers),
               mock.patch("{}.shutil".format(base),
                          new=all_mocks.shutil)):
             with DecryptKeys(config):
@@ -58,6 +60,7 @@ class DecryptTest(unittest.TestCase):
                 all_mocks.mock_calls,
                 [call.decrypt_secure_boot_keys(config),
                  call.inner_func(),
+                 call.forget_signers(),
                  call.shutil.rmtree(KEY_DIR)])
 
     @wrap_tempdir
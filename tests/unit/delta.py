@@ -0,0 +1,196 @@
+import os
+import stat
+import unittest
+from pathlib import Path
+from unittest import mock
+from .test_helper import wrap_tempdir
+from verity_squash_root.delta import DeltaBase, base_reference_path, \
+    compute_delta, delta_base_name, find_delta_base, link_base, \
+    remove_unused_bases, write_delta_options
+from verity_squash_root.file_op import read_text_from, write_str_to
+from verity_squash_root.manifest import scan_entries
+
+DIR = stat.S_IFDIR | 0o755
+REG = stat.S_IFREG | 0o644
+ROOT_HASH = "0123456789abcdef0123456789abcdef"
+
+
+def record(ino: int, mode: int = REG, mtime: int = 1):
+    return [ino, 0, mtime, mode, 0, 0, ""]
+
+
+class DeltaTest(unittest.TestCase):
+
+    def test__delta_base(self):
+        self.assertEqual(delta_base_name(ROOT_HASH), "base_0123456789abcdef")
+        base = DeltaBase(mock.Mock(), ROOT_HASH, {})
+        self.assertEqual(base.name, "base_0123456789abcdef")
+        self.assertEqual(
+            base.cmdline(),
+            "verity_squash_root_base=base_0123456789abcdef "
+            "verity_squash_root_base_hash={}".format(ROOT_HASH))
+        self.assertEqual(
+            base_reference_path(Path("/mnt/root/image_a.squashfs")),
+            Path("/mnt/root/image_a.squashfs.base"))
+
+    def test__compute_delta(self):
+        base = {
+            "": record(1, DIR),
+            "etc": record(2, DIR),
+            "etc/a": record(3),
+            "etc/b": record(4),
+            "usr": record(5, DIR),
+            "usr/lib": record(6, DIR),
+            "usr/lib/x": record(7),
+            "old": record(8, DIR),
+            "old/f": record(9),
+            "opt": record(10, DIR),
+            "opt/gone": record(11),
+            "odd name": record(12),
+        }
+        current = {
+            "": record(1, DIR),
+            "etc": record(2, DIR),
+            "etc/a": record(3, mtime=2),
+            "etc/b": record(4),
+            "usr": record(5, DIR),
+            "usr/lib": record(6, DIR),
+            "usr/lib/x": record(7),
+            "opt": record(10, DIR),
+            "new": record(13, DIR),
+            "new/f": record(14),
+            "odd name": record(12),
+        }
+        excludes, whiteouts = compute_delta(base, current)
+        # Unchanged directories are excluded as a whole, names mksquashfs
+        # cannot read from the exclude file are always included
+        self.assertEqual(excludes, ["etc/b", "usr"])
+        # Files in deleted directories are hidden with the directory
+        self.assertEqual(whiteouts, ["old", "opt/gone"])
+
+        self.assertEqual(compute_delta(current, current), (
+            ["etc", "new", "opt", "usr"], []))
+
+    @wrap_tempdir
+    def test__compute_delta__mtime_nanoseconds(self, tempdir):
+        def records():
+            return {e[0]: e[1:] for e in scan_entries(tempdir, [])}
+
+        write_str_to(tempdir / "generated", "cache")
+        os.utime(tempdir / "generated", ns=(0, 1000000123456789))
+        base = records()
+        # squashfs keeps whole seconds, so the booted base image has no
+        # nanoseconds
+        os.utime(tempdir / "generated", ns=(0, 1000000000000000))
+        self.assertEqual(compute_delta(base, records()), (["generated"], []))
+        os.utime(tempdir / "generated", ns=(0, 1000001000000000))
+        self.assertEqual(compute_delta(base, records()), ([], []))
+
+    @wrap_tempdir
+    def test__write_delta_options(self, tempdir):
+        work_dir = tempdir / "delta"
+        self.assertEqual(
+            write_delta_options(["etc/b", "usr"], ["old", "opt/gone"],
+                                work_dir),
+            ["-ef", str(work_dir / "exclude"),
+             "-pf", str(work_dir / "pseudo")])
+        self.assertEqual(read_text_from(work_dir / "exclude"),
+                         "etc/b\nusr\n")
+        self.assertEqual(read_text_from(work_dir / "pseudo"),
+                         "/old c 0 0 0 0 0\n/opt/gone c 0 0 0 0 0\n")
+
+        with self.assertLogs() as logs:
+            self.assertIsNone(write_delta_options([], ["a b"], work_dir))
+        self.assertEqual(logs.output,
+                         ["INFO:root:Deleted files cannot be whited out, "
+                          "building a full image"])
+
+    @wrap_tempdir
+    def test__find_delta_base(self, tempdir):
+        key_dir = tempdir / "keys"
+        image = tempdir / "image_a.squashfs"
+        records = {"": record(1, DIR)}
+        with mock.patch("verity_squash_root.delta.read_manifest_records",
+                        return_value=records) as read_mock:
+            cmdline = "rw verity_squash_root_slot=a " \
+                "verity_squash_root_hash={}\n".format(ROOT_HASH)
+            with self.assertLogs() as logs:
+                self.assertIsNone(find_delta_base(key_dir, tempdir, "rw"))
+                self.assertIsNone(find_delta_base(key_dir, tempdir, cmdline))
+            self.assertEqual(
+                logs.output,
+                ["INFO:root:Not booted from an image, building a full image",
+                 "INFO:root:Base image image_a.squashfs is missing, "
+                 "building a full image"])
+
+            write_str_to(image, "image")
+            write_str_to(tempdir / "image_a.squashfs.verity", "verity")
+            base = find_delta_base(key_dir, tempdir, cmdline)
+            self.assertEqual(base.image, image)
+            self.assertEqual(base.root_hash, ROOT_HASH)
+            self.assertEqual(base.records, records)
+            read_mock.assert_called_once_with(
+                key_dir, tempdir / "image_a.squashfs.manifest", ROOT_HASH)
+
+            # Booted from a delta image, the new delta uses the same base
+            read_mock.reset_mock()
+            image = tempdir / "base_1.squashfs"
+            write_str_to(image, "image")
+            write_str_to(tempdir / "base_1.squashfs.verity", "verity")
+            base = find_delta_base(
+                key_dir, tempdir,
+                "verity_squash_root_slot=b verity_squash_root_hash=1 "
+                "verity_squash_root_base=base_1 "
+                "verity_squash_root_base_hash={}".format(ROOT_HASH))
+            self.assertEqual(base.image, image)
+            self.assertEqual(base.root_hash, ROOT_HASH)
+            read_mock.assert_called_once_with(
+                key_dir, tempdir / "base_1.squashfs.manifest", ROOT_HASH)
+
+            read_mock.return_value = None
+            with self.assertLogs() as logs:
+                self.assertIsNone(find_delta_base(key_dir, tempdir, cmdline))
+            self.assertEqual(logs.output,
+                             ["INFO:root:No manifest for base image "
+                              "image_a.squashfs, building a full image"])
+
+    @wrap_tempdir
+    def test__link_base(self, tempdir):
+        image = tempdir / "image_a.squashfs"
+        for suffix, content in [("", "image"), (".verity", "verity"),
+                                (".manifest", "manifest")]:
+            write_str_to(tempdir / "image_a.squashfs{}".format(suffix),
+                         content)
+        base = DeltaBase(image, ROOT_HASH, {})
+        link_base(base, tempdir)
+        # Linking twice does nothing
+        link_base(base, tempdir)
+        name = "base_0123456789abcdef.squashfs"
+        self.assertEqual((tempdir / name).stat().st_ino, image.stat().st_ino)
+        self.assertEqual(read_text_from(tempdir / "{}.verity".format(name)),
+                         "verity")
+        self.assertEqual(
+            read_text_from(tempdir / "{}.manifest".format(name)), "manifest")
+        # A new image for the slot does not change the base
+        image.unlink()
+        write_str_to(image, "new")
+        self.assertEqual(read_text_from(tempdir / name), "image")
+
+        link_base(DeltaBase(tempdir / name, ROOT_HASH, {}), tempdir)
+        self.assertEqual(read_text_from(tempdir / name), "image")
+
+    @wrap_tempdir
+    def test__remove_unused_bases(self, tempdir):
+        for name in ["base_1.squashfs", "base_1.squashfs.verity",
+                     "base_2.squashfs", "base_2.squashfs.verity",
+                     "base_2.squashfs.manifest", "image_a.squashfs",
+                     "image_b.squashfs"]:
+            write_str_to(tempdir / name, "")
+        write_str_to(tempdir / "image_b.squashfs.base", "base_1\n")
+        with self.assertLogs() as logs:
+            remove_unused_bases(tempdir)
+        self.assertEqual(sorted(p.name for p in tempdir.iterdir()),
+                         ["base_1.squashfs", "base_1.squashfs.verity",
+                          "image_a.squashfs", "image_b.squashfs",
+                          "image_b.squashfs.base"])
+        self.assertEqual(len(logs.output), 3)
@@ -1,8 +1,10 @@
+import os
 import unittest
 from pathlib import Path
 from unittest import mock
-from verity_squash_root.distributions.base import \
+from verity_squash_root.distributions.base import DistributionConfig, \
     calc_kernel_packages_not_unique
+from tests.unit.test_helper import wrap_tempdir
 
 
 def distribution_mock():
@@ -38,3 +40,31 @@ class BaseDistributionTest(unittest.TestCase):
              "This means, that there are probably old files in "
              "/usr/lib/modules"],
             calc_kernel_packages_not_unique(distri_mock))
+
+    @wrap_tempdir
+    def test__list_kernels__cached(self, tempdir):
+        for kernel in ["5.19", "5.14"]:
+            (tempdir / kernel).mkdir()
+        distri = DistributionConfig("arch", "Arch")
+        with mock.patch.object(distri, "_modules_dir", new=mock.Mock(
+                wraps=tempdir)):
+            self.assertEqual(distri.list_kernels(), ["5.19", "5.14"])
+            self.assertEqual(distri.kernel_position("5.14"), 1)
+            # The returned list is a copy of the snapshot
+            distri.list_kernels().clear()
+            self.assertEqual(distri.list_kernels(), ["5.19", "5.14"])
+            distri._modules_dir.iterdir.assert_called_once_with()
+
+            (tempdir / "6.1").mkdir()
+            os.utime(tempdir, ns=(0, 1))
+            self.assertEqual(distri.list_kernels(), ["6.1", "5.19", "5.14"])
+            self.assertEqual(distri.kernel_position("5.14"), 2)
+            self.assertEqual(distri._modules_dir.iterdir.call_count, 2)
+
+            (tempdir / "6.1").rmdir()
+            os.utime(tempdir, ns=(0, 1))
+            self.assertEqual(distri.list_kernels(), ["6.1", "5.19", "5.14"])
+            distri.invalidate_kernels()
+            self.assertEqual(distri.list_kernels(), ["5.19", "5.14"])
+            with self.assertRaises(ValueError):
+                distri.kernel_position("6.1")
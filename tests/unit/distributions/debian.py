@@ -2,6 +2,7 @@ import unittest
 from pathlib import Path
 from unittest import mock
 from verity_squash_root.distributions.debian import DebianConfig
+from tests.unit.test_helper import wrap_tempdir
 
 
 class DebianConfigTest(unittest.TestCase):
@@ -10,16 +11,22 @@ class DebianConfigTest(unittest.TestCase):
         debian = DebianConfig("ubuntu", "Kali")
         self.assertEqual(debian.efi_dirname(), "ubuntu")
 
-    def test__kernel_to_name(self):
+    @wrap_tempdir
+    def test__kernel_to_name(self, tempdir):
+        for kernel in ["5.4", "6.1.13", "5.15.2"]:
+            (tempdir / kernel).mkdir()
         debian = DebianConfig("debian", "Debian GNU/Linux")
-        debian.list_kernels = mock.Mock(
-            return_value=["6.1.13", "5.15.2", "5.4"])
-        self.assertEqual(debian.kernel_to_name("6.1.13"),
-                         "current")
-        self.assertEqual(debian.kernel_to_name("5.15.2"),
-                         "old")
-        self.assertEqual(debian.kernel_to_name("5.4"),
-                         "old_x2")
+        with mock.patch.object(debian, "_modules_dir", new=tempdir):
+            self.assertEqual(debian.kernel_to_name("6.1.13"),
+                             "current")
+            self.assertEqual(debian.kernel_to_name("5.15.2"),
+                             "old")
+            self.assertEqual(debian.kernel_to_name("5.4"),
+                             "old_x2")
+            with self.assertRaises(ValueError) as e:
+                debian.kernel_to_name("5.3")
+            self.assertEqual(str(e.exception),
+                             "Kernel 5.3 not found in {}".format(tempdir))
 
     def test__vmlinuz(self):
         debian = DebianConfig("debian", "Debian GNU/Linux")
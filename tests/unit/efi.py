@@ -1,4 +1,3 @@
-import math
 import unittest
 from .test_helper import get_test_files_path
 from pathlib import Path
@@ -6,8 +5,8 @@ from unittest import mock
 from verity_squash_root.config import KEY_DIR
 from verity_squash_root.file_op import read_from
 from verity_squash_root.efi import file_matches_slot_or_is_broken, sign, \
-    create_efi_executable, build_and_sign_kernel, get_cmdline, \
-    calculate_efi_stub_end, calculate_efi_stub_alignment
+    create_efi_executables, build_and_sign_kernels, get_cmdline, \
+    sign_files, load_signer, forget_signers
 
 TEST_FILES_DIR = get_test_files_path("efi")
 
@@ -21,7 +20,7 @@ class EfiTest(unittest.TestCase):
             content_before = read_from(file)
             result = file_matches_slot_or_is_broken(file, slot)
             self.assertEqual(content_before, read_from(file),
-                             "objcopy modified file (breaks secure boot)")
+                             "Reading modified file (breaks secure boot)")
             return result
 
         self.assertTrue(wrapper("stub_slot_a.efi", "a"))
@@ -48,6 +47,11 @@ class EfiTest(unittest.TestCase):
             self.assertTrue(wrapper("stub_empty.efi", "b"))
         self.assertEqual(logs.output, log_empty)
 
+        with mock.patch("verity_squash_root.efi.read_section",
+                        return_value=None):
+            self.assertFalse(wrapper("stub_slot_a.efi", "a"))
+
+    @mock.patch("verity_squash_root.efi.HAS_CRYPTOGRAPHY", new=False)
     @mock.patch("verity_squash_root.efi.exec_binary")
     def test__sign(self, mock):
         sign(Path("my/key/dir"), Path("my/in/file"), Path("my/out/file"))
@@ -58,57 +62,58 @@ class EfiTest(unittest.TestCase):
              "--output", "my/out/file",
              "my/in/file"])
 
-    def test__calculate_efi_stub_end(self):
-        self.assertEqual(
-            calculate_efi_stub_end(TEST_FILES_DIR / "stub_slot_a.efi"),
-            74064)
-
-    def test__calculate_efi_stub_alignment(self):
-        self.assertEqual(
-            calculate_efi_stub_alignment(TEST_FILES_DIR / "stub_slot_a.efi"),
-            512)
-
-    def test__calculate_efi_stub_alignment__not_found(self):
-        with self.assertRaises(ValueError) as e_ctx:
-            calculate_efi_stub_alignment(
-                TEST_FILES_DIR / "no_sections_or_info")
+    @mock.patch("verity_squash_root.efi.exec_binary")
+    @mock.patch("verity_squash_root.efi.load_signer")
+    def test__sign__in_process(self, load_mock, exec_mock):
+        sign(Path("my/key/dir"), Path("my/in/file"), Path("my/out/file"))
+        load_mock.assert_called_once_with(Path("my/key/dir"))
+        load_mock.return_value.sign_file.assert_called_once_with(
+            Path("my/in/file"), Path("my/out/file"))
+        exec_mock.assert_not_called()
+
+    @mock.patch("verity_squash_root.efi.sign")
+    def test__sign_files(self, sign_mock):
+        sign_files(Path("my/key/dir"), [(Path("a"), Path("b")),
+                                        (Path("c"), Path("c"))])
         self.assertEqual(
-            str(e_ctx.exception), "Efistub SectionAlignment not found")
+            sign_mock.mock_calls,
+            [mock.call(Path("my/key/dir"), Path("a"), Path("b")),
+             mock.call(Path("my/key/dir"), Path("c"), Path("c"))])
 
-    @mock.patch("verity_squash_root.efi.calculate_efi_stub_alignment")
-    @mock.patch("verity_squash_root.efi.exec_binary")
-    @mock.patch("verity_squash_root.efi.calculate_efi_stub_end")
-    def test__create_efi_executable(self, calc_mock, exec_mock, align_mock):
-        def align(x):
-            return 2048 * math.ceil(x / 2048)
-
-        align_mock.return_value = 2048
-        calc_mock.return_value = 74064
-        create_efi_executable(
+    def test__load_signer(self):
+        base = "verity_squash_root.efi"
+        key_dir = get_test_files_path("authenticode")
+        with (mock.patch("{}.SIGNERS".format(base), new={}),
+              mock.patch("{}.HAS_CRYPTOGRAPHY".format(base), new=True),
+              mock.patch("{}.AuthenticodeSigner".format(base)) as signer):
+            loaded = signer.from_files.return_value
+            self.assertIs(load_signer(key_dir), loaded)
+            self.assertIs(load_signer(key_dir), loaded)
+            signer.from_files.assert_called_once_with(
+                key_dir / "db.key", key_dir / "db.crt")
+            forget_signers()
+            load_signer(key_dir)
+            self.assertEqual(signer.from_files.call_count, 2)
+            with mock.patch("{}.HAS_CRYPTOGRAPHY".format(base), new=False):
+                self.assertIsNone(load_signer(key_dir))
+
+    @mock.patch("verity_squash_root.efi.append_sections")
+    def test__create_efi_executables(self, append_mock):
+        variants = [(TEST_FILES_DIR / "cmdline", Path("/tmp/file.efi")),
+                    (Path("/tmp/tmpfs.cmdline"), Path("/tmp/tmpfs.efi"))]
+        create_efi_executables(
             TEST_FILES_DIR / "stub_slot_a.efi",
-            TEST_FILES_DIR / "cmdline",
             TEST_FILES_DIR / "vmlinuz",
-            TEST_FILES_DIR / "initrd",
-            Path("/tmp/file.efi"))
-        align_mock.assert_called_once_with(TEST_FILES_DIR / "stub_slot_a.efi")
-        calc_mock.assert_called_once_with(TEST_FILES_DIR / "stub_slot_a.efi")
-        osrel_size = Path("/etc/os-release").stat().st_size
-
-        exec_mock.assert_called_once_with([
-            'objcopy',
-            '--add-section', '.osrel=/etc/os-release',
-            '--change-section-vma', '.osrel=0x12800',
-            '--add-section', '.cmdline={}'.format(TEST_FILES_DIR / "cmdline"),
-            '--change-section-vma', '.cmdline={}'.format(
-                hex(align(0x12800 + osrel_size))),
-            '--add-section', '.initrd={}'.format(TEST_FILES_DIR / "initrd"),
-            '--change-section-vma', '.initrd={}'.format(
-                hex(align(0x13000 + osrel_size))),
-            '--add-section', '.linux={}'.format(TEST_FILES_DIR / "vmlinuz"),
-            '--change-section-vma', '.linux={}'.format(
-                hex(align(0x13800 + osrel_size))),
-            str(TEST_FILES_DIR / "stub_slot_a.efi"),
-            str(Path("/tmp/file.efi"))])
+            [Path("/boot/intel-ucode.img"), TEST_FILES_DIR / "initrd"],
+            variants)
+        append_mock.assert_called_once_with(
+            TEST_FILES_DIR / "stub_slot_a.efi",
+            [(".osrel", Path("/etc/os-release")),
+             (".cmdline", None),
+             (".initrd", [Path("/boot/intel-ucode.img"),
+                          TEST_FILES_DIR / "initrd"]),
+             (".linux", TEST_FILES_DIR / "vmlinuz")],
+            variants)
 
     def test__get_cmdline__configfile(self):
         all_mocks = mock.Mock()
@@ -147,7 +152,7 @@ class EfiTest(unittest.TestCase):
                 [call.efi.CMDLINE_FILE.exists(),
                  call.efi.CMDLINE_FILE.read_text()])
 
-    def test__build_and_sign_kernel(self):
+    def test__build_and_sign_kernels(self):
         all_mocks = mock.Mock()
         base = "verity_squash_root.efi"
         config = {
@@ -157,55 +162,66 @@ class EfiTest(unittest.TestCase):
         }
         call = mock.call
 
-        with (mock.patch("{}.sign".format(base),
-                         new=all_mocks.efi.sign),
+        with (mock.patch("{}.sign_files".format(base),
+                         new=all_mocks.efi.sign_files),
               mock.patch("{}.get_cmdline".format(base),
                          new=all_mocks.get_cmdline),
-              mock.patch("{}.create_efi_executable".format(base),
-                         new=all_mocks.efi.create_efi_executable),
+              mock.patch("{}.create_efi_executables".format(base),
+                         new=all_mocks.efi.create_efi_executables),
               mock.patch("{}.write_str_to".format(base),
                          new=all_mocks.write_str_to)):
             all_mocks.get_cmdline.return_value = "rw encrypt=/dev/sda2 quiet"
-            build_and_sign_kernel(config, Path("/boot/vmlinuz"),
-                                  Path("/tmp/initramfs.img"), "a",
-                                  "567myhash234", Path("/tmp/file.efi"),
-                                  "tmpfsparam")
+            build_and_sign_kernels(config, Path("/boot/vmlinuz"),
+                                   [Path("/tmp/initramfs.img")], "a",
+                                   "567myhash234",
+                                   [(Path("/tmp/file.efi"), ""),
+                                    (Path("/tmp/file_tmpfs.efi"),
+                                     "tmpfsparam")])
             self.assertEqual(
                 all_mocks.mock_calls,
                 [call.get_cmdline(config),
-                 call.write_str_to(Path("/tmp/verity_squash_root/cmdline"),
+                 call.write_str_to(Path("/tmp/file.cmdline"),
+                                   ("rw encrypt=/dev/sda2 quiet rw  "
+                                    "verity_squash_root_slot=a "
+                                    "verity_squash_root_hash=567myhash234")),
+                 call.write_str_to(Path("/tmp/file_tmpfs.cmdline"),
                                    ("rw encrypt=/dev/sda2 quiet rw tmpfsparam "
                                     "verity_squash_root_slot=a "
                                     "verity_squash_root_hash=567myhash234")),
-                 call.efi.create_efi_executable(
+                 call.efi.create_efi_executables(
                      Path("/usr/lib/systemd/mystub.efi"),
-                     Path("/tmp/verity_squash_root/cmdline"),
-                     Path("/boot/vmlinuz"), Path("/tmp/initramfs.img"),
-                     Path("/tmp/file.efi")),
-                 call.efi.sign(KEY_DIR, Path("/tmp/file.efi"),
-                               Path("/tmp/file.efi"))])
+                     Path("/boot/vmlinuz"), [Path("/tmp/initramfs.img")],
+                     [(Path("/tmp/file.cmdline"), Path("/tmp/file.efi")),
+                      (Path("/tmp/file_tmpfs.cmdline"),
+                       Path("/tmp/file_tmpfs.efi"))]),
+                 call.efi.sign_files(
+                     KEY_DIR,
+                     [(Path("/tmp/file.efi"), Path("/tmp/file.efi")),
+                      (Path("/tmp/file_tmpfs.efi"),
+                       Path("/tmp/file_tmpfs.efi"))])])
 
             all_mocks.reset_mock()
 
             all_mocks.get_cmdline.return_value = "encrypt=/dev/sda2 quiet"
-            build_and_sign_kernel(config, Path("/usr/lib/vmlinuz-lts"),
-                                  Path("/boot/initramfs_fallback.img"), "b",
-                                  "853anotherhash723",
-                                  Path("/tmporary/dir/f.efi"),
-                                  "")
+            build_and_sign_kernels(config, Path("/usr/lib/vmlinuz-lts"),
+                                   [Path("/boot/initramfs_fallback.img")],
+                                   "b",
+                                   "853anotherhash723",
+                                   [(Path("/tmporary/dir/f.efi"), "")])
             self.assertEqual(
                 all_mocks.mock_calls,
                 [call.get_cmdline(config),
                  call.write_str_to(
-                     Path("/tmp/verity_squash_root/cmdline"),
+                     Path("/tmporary/dir/f.cmdline"),
                      ("encrypt=/dev/sda2 quiet rw  verity_squash_root_slot=b "
                       "verity_squash_root_hash=853anotherhash723")),
-                 call.efi.create_efi_executable(
+                 call.efi.create_efi_executables(
                          Path("/usr/lib/systemd/mystub.efi"),
-                         Path("/tmp/verity_squash_root/cmdline"),
                          Path("/usr/lib/vmlinuz-lts"),
-                         Path("/boot/initramfs_fallback.img"),
-                         Path("/tmporary/dir/f.efi")),
-                 call.efi.sign(KEY_DIR,
-                               Path("/tmporary/dir/f.efi"),
-                               Path("/tmporary/dir/f.efi"))])
+                         [Path("/boot/initramfs_fallback.img")],
+                         [(Path("/tmporary/dir/f.cmdline"),
+                           Path("/tmporary/dir/f.efi"))]),
+                 call.efi.sign_files(
+                     KEY_DIR,
+                     [(Path("/tmporary/dir/f.efi"),
+                       Path("/tmporary/dir/f.efi"))])])
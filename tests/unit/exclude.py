@@ -0,0 +1,111 @@
+import unittest
+from pathlib import Path
+from verity_squash_root.exclude import compile_pattern, \
+    compile_patterns, covers, exclude_patterns, match_entry, \
+    translate_component
+from .test_helper import PROJECT_ROOT
+
+
+class ExcludeTest(unittest.TestCase):
+
+    def test__exclude_patterns(self):
+        setup = str(PROJECT_ROOT / "setup.py")
+        self.assertEqual(
+            exclude_patterns(["var/!(lib)", setup], Path("/mnt/root/"),
+                             Path("/boot/efi")),
+            ['dev/*', 'dev/.*', 'proc/*', 'proc/.*', 'run/*', 'run/.*',
+             'sys/*', 'sys/.*', 'tmp/*', 'tmp/.*',
+             'mnt/root/*', 'mnt/root/.*', 'boot/efi/*', 'boot/efi/.*',
+             'var/!(lib)/*', 'var/!(lib)/.*', setup[1:]])
+
+    def test__exclude_patterns__covered(self):
+        self.assertEqual(
+            exclude_patterns(["/tmp/cache", "var/!(lib)", "/var/cache/x",
+                              "/var/lib/x", "var/*/y", "/home/", "home"],
+                             Path("/mnt/root"), Path("/mnt/root/efi")),
+            ['dev/*', 'dev/.*', 'proc/*', 'proc/.*', 'run/*', 'run/.*',
+             'sys/*', 'sys/.*', 'tmp/*', 'tmp/.*',
+             'mnt/root/*', 'mnt/root/.*', 'var/!(lib)/*', 'var/!(lib)/.*',
+             'var/lib/x/*', 'var/lib/x/.*', 'var/*/y/*', 'var/*/y/.*',
+             'home/*', 'home/.*'])
+
+    def test__exclude_patterns__same_level(self):
+        setup = PROJECT_ROOT / "setup.py"
+        # The contents of var/cache are excluded by var/!(lib|log), a file
+        # is excluded itself and is kept
+        self.assertEqual(
+            exclude_patterns(["/var/!(lib|log)", "/var/cache",
+                              "{}/!(tests)".format(PROJECT_ROOT),
+                              str(setup)],
+                             Path("/mnt/root"), Path("/boot/efi")),
+            ['dev/*', 'dev/.*', 'proc/*', 'proc/.*', 'run/*', 'run/.*',
+             'sys/*', 'sys/.*', 'tmp/*', 'tmp/.*',
+             'mnt/root/*', 'mnt/root/.*', 'boot/efi/*', 'boot/efi/.*',
+             'var/!(lib|log)/*', 'var/!(lib|log)/.*',
+             '{}/!(tests)/*'.format(str(PROJECT_ROOT).lstrip("/")),
+             '{}/!(tests)/.*'.format(str(PROJECT_ROOT).lstrip("/")),
+             str(setup).lstrip("/")])
+
+    def test__covers(self):
+        directory = compile_pattern("var/!(lib)")
+        self.assertTrue(covers(directory, ["var", "cache", "x"]))
+        self.assertFalse(covers(directory, ["var", "cache"]))
+        self.assertTrue(covers(directory, ["var", "cache"], True))
+        self.assertFalse(covers(directory, ["var", "lib"], True))
+        self.assertFalse(covers(directory, ["var"], True))
+        self.assertFalse(covers(directory, ["var", "lib", "x"]))
+        self.assertFalse(covers(directory, ["var", "*", "x"]))
+        self.assertFalse(covers(directory, ["usr", "cache", "x"]))
+
+    def test__translate_component(self):
+        def matches(pattern, name):
+            return translate_component(pattern).fullmatch(name) is not None
+
+        self.assertTrue(matches("*", "file"))
+        self.assertFalse(matches("*", ".hidden"))
+        self.assertTrue(matches(".*", ".hidden"))
+        self.assertTrue(matches("ab?", "abc"))
+        self.assertFalse(matches("ab?", "abcd"))
+        self.assertTrue(matches("[a-c]x", "bx"))
+        self.assertFalse(matches("[!a-c]x", "bx"))
+        self.assertTrue(matches("[!a-c]x", "dx"))
+        self.assertTrue(matches("a[b", "a[b"))
+        self.assertTrue(matches("\\*", "*"))
+        self.assertFalse(matches("\\*", "a"))
+        self.assertTrue(matches("@(lib|log)", "log"))
+        self.assertFalse(matches("@(lib|log)", "logs"))
+        self.assertTrue(matches("+(ab)", "abab"))
+        self.assertTrue(matches("x?(y)", "x"))
+        self.assertTrue(matches("!(lib|log)", "cache"))
+        self.assertTrue(matches("!(lib|log)", "libs"))
+        self.assertFalse(matches("!(lib|log)", "lib"))
+        self.assertFalse(matches("!(lib|log)", ".cache"))
+
+    def test__compile_pattern__unsupported(self):
+        self.assertIsNone(compile_pattern("var/!(lib)x/*"))
+        self.assertIsNone(compile_pattern("var/@(!(lib))/*"))
+        self.assertIsNone(compile_pattern("var/[[:alpha:]]/*"))
+        self.assertIsNone(compile_pattern("var/@(lib/*"))
+        self.assertEqual(len(compile_patterns(["var/!(lib)x/*", "tmp/*"])),
+                         1)
+
+    def test__match_entry(self):
+        candidates = compile_patterns(["var/!(lib|log)/*", "home/*",
+                                       "etc/passwd"])
+        self.assertEqual(match_entry(candidates, 0, "usr"), (False, []))
+        self.assertEqual(match_entry(candidates, 0, "etc"),
+                         (False, [candidates[2]]))
+        self.assertEqual(match_entry(candidates[2:], 1, "passwd"),
+                         (True, []))
+        self.assertEqual(match_entry(candidates[2:], 1, "group"),
+                         (False, []))
+        self.assertEqual(match_entry(candidates, 0, "home"),
+                         (False, [candidates[1]]))
+        self.assertEqual(match_entry(candidates[1:2], 1, "user"),
+                         (True, []))
+        self.assertEqual(match_entry(candidates[:1], 1, "lib"),
+                         (False, []))
+        self.assertEqual(match_entry(candidates[:1], 1, "cache"),
+                         (False, candidates[:1]))
+        self.assertEqual(match_entry(candidates[:1], 2, "file"),
+                         (True, []))
@@ -1,5 +1,8 @@
+import time
 import unittest
-from verity_squash_root.exec import exec_binary, ExecBinaryError
+from verity_squash_root.exec import READ_SIZE, exec_binaries, \
+    exec_binary, ExecBinaryError, ExecTimeoutError
+from verity_squash_root.timing import create_report, stage, start_report
 
 
 class ExecTest(unittest.TestCase):
@@ -24,6 +27,11 @@ class ExecTest(unittest.TestCase):
         self.assertEqual(e_ctx.exception.stderr(),
                          'err str\n')
 
+    def test__exec_binary__signal(self):
+        # Like Popen, a child killed by a signal returns -signal
+        self.assertEqual(exec_binary(["dash", "-c", "kill -9 $$"], -9),
+                         (b"", b""))
+
     def test__exec_binary__result(self):
         result = exec_binary(["dash", "-c",
                               'printf StdOutStr\\\\n123;'
@@ -43,3 +51,53 @@ class ExecTest(unittest.TestCase):
         self.assertEqual(
             e_ctx.exception.args,
             ("Binary not found: notexistingbin, is it installed?",))
+
+    def test__exec_binary__output_line(self):
+        lines = []
+        result = exec_binary(["dash", "-c", "printf 'a\\nb c\\n\\nd'; "
+                              "printf err >&2"], output_line=lines.append)
+        self.assertEqual(result, (b"", b"err"))
+        self.assertEqual(lines, ["a", "b c", "", "d"])
+
+        # A line is passed on, before it gets longer than READ_SIZE
+        lines.clear()
+        exec_binary(["dash", "-c", "head -c 200000 /dev/zero | tr '\\0' x"],
+                    output_line=lines.append)
+        self.assertEqual("".join(lines), "x" * 200000)
+        self.assertTrue(all(len(line) <= 2 * READ_SIZE for line in lines))
+
+    def test__exec_binary__timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(ExecTimeoutError) as e_ctx:
+            exec_binary(["sleep", "10"], timeout=0.1)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(str(e_ctx.exception),
+                         "Timeout after 0.1s executing 'sleep 10'")
+
+    def test__exec_binaries(self):
+        start_report()
+        with stage("outer"):
+            self.assertEqual(
+                exec_binaries([["dash", "-c", "printf 1"],
+                               ["dash", "-c", "printf 2"],
+                               ["dash", "-c", "printf 3"]], 2),
+                [(b"1", b""), (b"2", b""), (b"3", b"")])
+        # Concurrent commands are nested in the stage which runs them
+        self.assertEqual(sorted((s["name"], s["depth"])
+                                for s in create_report(False)["stages"]),
+                         [("exec dash", 1)] * 3 + [("outer", 0)])
+
+        lines = []
+        exec_binaries([["dash", "-c", "echo a; echo b"],
+                       ["dash", "-c", "echo c"]], 2,
+                      output_line=lambda i, line: lines.append((i, line)))
+        self.assertEqual(sorted(lines), [(0, "a"), (0, "b"), (1, "c")])
+
+        start = time.monotonic()
+        with self.assertRaises(ExecBinaryError) as e_ctx:
+            exec_binaries([["sleep", "10"],
+                           ["dash", "-c", "echo failed >&2; exit 1"],
+                           ["sleep", "10"]], 3)
+        # The other commands are killed on the first failure
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(e_ctx.exception.stderr(), "failed\n")
@@ -1,7 +1,12 @@
+import errno
+import os
+import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
 from .test_helper import get_test_files_path, wrap_tempdir
 from verity_squash_root.file_op import read_text_from, write_str_to, \
-    merge_files, read_from
+    merge_files, move_file, read_from, copy_file_data, files_equal
 
 TEST_FILES_DIR = get_test_files_path("file_op")
 READ_TXT = TEST_FILES_DIR / "read.txt"
@@ -39,3 +44,54 @@ class FileOPTest(unittest.TestCase):
                          "{}{}{}{}".format(
                              in1_text, READ_TXT_CONTENT,
                              in3_text, READ_TXT_CONTENT))
+
+    @wrap_tempdir
+    def test__copy_file_data(self, tempdir):
+        out = tempdir / "out"
+        with (open(READ_TXT, "rb") as src_fd,
+              open(out, "wb", buffering=0) as dest_fd):
+            dest_fd.write(b"head ")
+            copy_file_data(src_fd.fileno(), dest_fd.fileno(), 4, 5)
+            copy_file_data(src_fd.fileno(), dest_fd.fileno(), 5)
+            with self.assertRaises(EOFError) as e_ctx:
+                copy_file_data(src_fd.fileno(), dest_fd.fileno(), 10, 15)
+            self.assertEqual(str(e_ctx.exception),
+                             "File ended 5 bytes too early")
+        self.assertEqual(read_text_from(out), "head is aThis str.\n")
+
+    @wrap_tempdir
+    def test__files_equal(self, tempdir):
+        same = tempdir / "same"
+        write_str_to(same, READ_TXT_CONTENT)
+        other = tempdir / "other"
+        write_str_to(other, READ_TXT_CONTENT.replace("test", "tset"))
+        self.assertTrue(files_equal(READ_TXT, same))
+        self.assertTrue(files_equal(READ_TXT, same, 3))
+        self.assertFalse(files_equal(READ_TXT, other, 3))
+        write_str_to(other, READ_TXT_CONTENT + "x")
+        self.assertFalse(files_equal(READ_TXT, other))
+
+    @wrap_tempdir
+    def test__move_file(self, tempdir):
+        image = tempdir / "image_a.squashfs"
+        base = tempdir / "base_x.squashfs"
+        write_str_to(image, "old image")
+        os.link(image, base)
+        shm = Path("/dev/shm")
+        with tempfile.TemporaryDirectory(
+                dir=shm if shm.is_dir() else None) as src_dir:
+            src = Path(src_dir) / "tmp.squashfs"
+            write_str_to(src, "new image")
+            if os.stat(src_dir).st_dev != os.stat(tempdir).st_dev:
+                move_file(src, image)
+            else:
+                # Move across file systems like from the tmpfs TMPDIR
+                with mock.patch("os.rename", side_effect=OSError(
+                        errno.EXDEV, "Invalid cross-device link")):
+                    move_file(src, image)
+            self.assertFalse(src.exists())
+        self.assertEqual(read_text_from(image), "new image")
+        # The hard link keeps the old image
+        self.assertEqual(read_text_from(base), "old image")
+        self.assertEqual(sorted(p.name for p in tempdir.iterdir()),
+                         ["base_x.squashfs", "image_a.squashfs"])
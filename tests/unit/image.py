@@ -1,21 +1,25 @@
+import logging
 import unittest
+from configparser import ConfigParser
 from pathlib import Path
 from unittest import mock
-from verity_squash_root.image import mksquashfs, veritysetup_image, \
-    verity_image_path
+from verity_squash_root.image import mksquashfs, mksquashfs_cmd, \
+    veritysetup_image, verity_image_path, parse_size, SquashfsProfile, \
+    squashfs_profile, squashfs_profile_names
 from .test_helper import PROJECT_ROOT
 
 
 class ImageTest(unittest.TestCase):
 
-    @mock.patch("verity_squash_root.image.exec_binary")
-    def test__veritysetup_image(self, mock):
-        mock.return_value = (b'Test: 5\nRoot hash: 0x1256890\nLine', b'')
+    @mock.patch("verity_squash_root.image.os.cpu_count")
+    @mock.patch("verity_squash_root.image.verity_hash_file")
+    def test__veritysetup_image(self, hash_mock, cpu_mock):
+        hash_mock.return_value = "0x1256890"
+        cpu_mock.return_value = 6
         root_hash = veritysetup_image(Path("/myimage.squashfs"))
         self.assertEqual(root_hash, "0x1256890")
-        mock.assert_called_once_with(
-            ["veritysetup", "format", "/myimage.squashfs",
-             "/myimage.squashfs.verity"])
+        hash_mock.assert_called_once_with(
+            Path("/myimage.squashfs"), Path("/myimage.squashfs.verity"), 6)
 
     def test__verity_image_path(self):
         self.assertEqual(verity_image_path(Path("/mnt/root/my_img.iso")),
@@ -24,12 +28,12 @@ class ImageTest(unittest.TestCase):
     @mock.patch("verity_squash_root.image.exec_binary")
     def test__mksquashfs(self, mock):
         setup = str(PROJECT_ROOT / "setup.py")
-        mksquashfs(["var/!(lib)", "/home", setup, "/root"], "/image.squashfs",
+        mksquashfs(["var/!(lib)", "/home", setup, "/srv"], "/image.squashfs",
                    "/mnt/root/", "/boot/weird/efi")
         mock.assert_called_once_with(
             ['mksquashfs', '/', '/image.squashfs',
              '-reproducible', '-xattrs', '-wildcards', '-noappend',
-             '-no-exports',
+             '-no-exports', '-no-progress',
              '-p', '/mnt/root/ d 0700 0 0',
              '-p', '/boot/weird/efi d 0700 0 0',
              '-e', 'dev/*', 'dev/.*',
@@ -39,4 +43,113 @@ class ImageTest(unittest.TestCase):
              'var/!(lib)/*', 'var/!(lib)/.*',
              'home/*', 'home/.*',
              setup[1:],
-             'root/*', 'root/.*'])
+             'srv/*', 'srv/.*'], output_line=logging.debug)
+
+    @mock.patch("verity_squash_root.image.exec_binary")
+    def test__mksquashfs__profile(self, mock):
+        profile = SquashfsProfile("zstd", 3, 262144, 2, 512 * 1024 ** 2)
+        mksquashfs([], "/image.squashfs", "/mnt/root", "/boot/efi", profile,
+                   ["-ef", "/tmp/exclude"])
+        mock.assert_called_once_with(
+            ['mksquashfs', '/', '/image.squashfs',
+             '-reproducible', '-xattrs', '-wildcards', '-noappend',
+             '-no-exports', '-no-progress',
+             '-comp', 'zstd', '-Xcompression-level', '3', '-b', '262144',
+             '-processors', '2', '-mem', '512M', '-ef', '/tmp/exclude',
+             '-p', '/mnt/root d 0700 0 0',
+             '-p', '/boot/efi d 0700 0 0',
+             '-e', 'dev/*', 'dev/.*',
+             'proc/*', 'proc/.*', 'run/*', 'run/.*', 'sys/*', 'sys/.*',
+             'tmp/*', 'tmp/.*', 'mnt/root/*', 'mnt/root/.*',
+             'boot/efi/*', 'boot/efi/.*'], output_line=logging.debug)
+
+    def test__parse_size(self):
+        self.assertEqual(parse_size("4096"), 4096)
+        self.assertEqual(parse_size(" 128k"), 131072)
+        self.assertEqual(parse_size("1M"), 1048576)
+        self.assertEqual(parse_size("2G"), 2147483648)
+        for value in ["", "1.5M", "1T", "M", "-1"]:
+            with self.assertRaises(ValueError) as e_ctx:
+                parse_size(value)
+            self.assertEqual(str(e_ctx.exception),
+                             "Invalid size: {}".format(value))
+
+    def test__squashfs_profile(self):
+        profile = SquashfsProfile()
+        self.assertEqual(profile.compression_options(), [])
+        self.assertEqual(profile.resource_options(), [])
+        profile = SquashfsProfile("xz", block_size=1024 ** 2)
+        self.assertEqual(profile.compression_options(),
+                         ["-comp", "xz", "-b", "1048576"])
+        profile = SquashfsProfile(compression_level=9, processors=1,
+                                  memory=3 * 1024 ** 3)
+        self.assertEqual(profile.compression_options(),
+                         ["-Xcompression-level", "9"])
+        self.assertEqual(profile.resource_options(),
+                         ["-processors", "1", "-mem", "3072M"])
+
+        for kwargs, msg in [
+                ({"compressor": "bzip2"},
+                 "Unknown squashfs compressor: bzip2"),
+                ({"compressor": "xz", "compression_level": 3},
+                 "Compressor xz has no compression level"),
+                ({"compression_level": 10},
+                 "Compression level of gzip needs to be between 1 and 9"),
+                ({"compressor": "zstd", "compression_level": 0},
+                 "Compression level of zstd needs to be between 1 and 22"),
+                ({"block_size": 2048},
+                 "Block size needs to be a power of two between 4K and 1M"),
+                ({"block_size": 12288},
+                 "Block size needs to be a power of two between 4K and 1M"),
+                ({"block_size": 2 * 1024 ** 2},
+                 "Block size needs to be a power of two between 4K and 1M"),
+                ({"processors": 0},
+                 "Number of processors needs to be positive"),
+                ({"memory": 1024},
+                 "Memory limit needs to be at least 1M")]:
+            with self.assertRaises(ValueError) as e_ctx:
+                SquashfsProfile(**kwargs)
+            self.assertEqual(str(e_ctx.exception), msg)
+
+    def test__squashfs_profile__config(self):
+        config = ConfigParser()
+        config.read_string(
+            "[DEFAULT]\n"
+            "SQUASHFS_PROFILE = fast \n"
+            "[SQUASHFS_PROFILE:fast]\n"
+            "COMPRESSOR = zstd\n"
+            "COMPRESSION_LEVEL = 1\n"
+            "BLOCK_SIZE = 128K\n"
+            "PROCESSORS =\n"
+            "MEMORY = 1G\n")
+        profile = squashfs_profile(config)
+        self.assertEqual(profile.compression_options(),
+                         ["-comp", "zstd", "-Xcompression-level", "1",
+                          "-b", "131072"])
+        self.assertEqual(profile.resource_options(), ["-mem", "1024M"])
+
+        self.assertEqual(
+            squashfs_profile(config, "fast").compression_options(),
+            profile.compression_options())
+        self.assertEqual(squashfs_profile_names(config), ["fast"])
+
+        config["DEFAULT"]["SQUASHFS_PROFILE"] = "missing"
+        with self.assertRaises(ValueError) as e_ctx:
+            squashfs_profile(config)
+        self.assertEqual(str(e_ctx.exception),
+                         "Squashfs profile missing is not configured, add a "
+                         "section [SQUASHFS_PROFILE:missing]")
+
+    def test__mksquashfs_cmd(self):
+        self.assertEqual(
+            mksquashfs_cmd(["/home"], Path("/tmp/image.squashfs"),
+                           Path("/mnt/root"), Path("/boot/efi")),
+            ['mksquashfs', '/', '/tmp/image.squashfs',
+             '-reproducible', '-xattrs', '-wildcards', '-noappend',
+             '-no-exports',
+             '-p', '/mnt/root d 0700 0 0',
+             '-p', '/boot/efi d 0700 0 0',
+             '-e', 'dev/*', 'dev/.*',
+             'proc/*', 'proc/.*', 'run/*', 'run/.*', 'sys/*', 'sys/.*',
+             'tmp/*', 'tmp/.*', 'mnt/root/*', 'mnt/root/.*',
+             'boot/efi/*', 'boot/efi/.*', 'home/*', 'home/.*'])
@@ -1,9 +1,11 @@
 import unittest
 from pathlib import Path
 from unittest import mock
-from verity_squash_root.file_op import write_str_to, read_text_from
-from verity_squash_root.initramfs import merge_initramfs_images
-from verity_squash_root.initramfs.base import iterate_distribution_efi
+from verity_squash_root.exec import ExecBinaryError, exec_binaries
+from verity_squash_root.file_op import read_text_from, write_str_to
+from verity_squash_root.initramfs import initramfs_parts
+from verity_squash_root.initramfs.base import InitramfsBuilder, \
+    iterate_distribution_efi
 from tests.unit.distributions.base import distribution_mock
 from tests.unit.test_helper import wrap_tempdir
 
@@ -23,37 +25,53 @@ def create_initramfs_mock(distri):
         obj = {"5.19": ["default", "fallback"], "5.14": ["default"]}
         return obj[kernel]
 
+    def list_all_kernel_presets(kernels):
+        return {k: list_kernel_presets(k) for k in kernels}
+
     initramfs_mock.list_kernel_presets.side_effect = list_kernel_presets
+    initramfs_mock.list_all_kernel_presets.side_effect = \
+        list_all_kernel_presets
+
+    def build_many(kernel_presets, jobs):
+        return [initramfs_mock.build_initramfs_with_microcode(k, p)
+                for k, p in kernel_presets]
+
+    initramfs_mock.build_many.side_effect = build_many
     initramfs_mock.file_name.side_effect = file_name
     initramfs_mock.display_name.side_effect = display_name
     return initramfs_mock
 
 
+class ShellBuilder(InitramfsBuilder):
+
+    def file_name(self, kernel, preset):
+        return "{}_{}".format(kernel, preset)
+
+    def initramfs_command(self, kernel, preset, work_dir):
+        image = work_dir / "image"
+        # Fails, if another build uses the same directory
+        return (["dash", "-c",
+                 "test ! -e {i} && echo {k} > {i} && echo built {k}".format(
+                     i=image, k=kernel)],
+                [image])
+
+
 class InitramfsTest(unittest.TestCase):
 
     @wrap_tempdir
-    def test__merge_initramfs_images(self, tempdir):
+    def test__initramfs_parts(self, tempdir):
         in1 = tempdir / "some_file"
         in2 = tempdir / "another_file"
         in3 = tempdir / "filename"
-        in1_text = "First\npart"
-        in2_text = "First \n part\n"
-        in3_text = "Third part"
-        for i in [(in1, in1_text),
-                  (in2, in2_text),
-                  (in3, in3_text)]:
-            write_str_to(i[0], i[1])
-
-        out = tempdir / "merged_file"
-        merge_initramfs_images(in1, [Path("/not/existing"), in2,
-                                     Path("/no/image"),
-                                     Path("/still/no/image"),
-                                     in3,
-                                     Path("another/non/image")],
-                               out)
-        self.assertEqual(read_text_from(out),
-                         "{}{}{}".format(
-                             in2_text, in3_text, in1_text))
+        for i in [in1, in2, in3]:
+            write_str_to(i, "image")
+        self.assertEqual(
+            initramfs_parts(in1, [Path("/not/existing"), in2,
+                                  Path("/no/image"),
+                                  Path("/still/no/image"),
+                                  in3,
+                                  Path("another/non/image")]),
+            [in2, in3, in1])
 
     def test__iterate_distribution_efi(self):
         distri_mock = distribution_mock()
@@ -70,8 +88,39 @@ class InitramfsTest(unittest.TestCase):
                           ("5.14", "default", "linux-lts_default")])
         self.assertEqual(all_mock.mock_calls,
                          [mock.call.distri.list_kernels(),
-                          mock.call.initramfs.list_kernel_presets("5.19"),
+                          mock.call.initramfs.list_all_kernel_presets(
+                              ["5.19", "5.14"]),
                           mock.call.initramfs.file_name("5.19", "default"),
                           mock.call.initramfs.file_name("5.19", "fallback"),
-                          mock.call.initramfs.list_kernel_presets("5.14"),
                           mock.call.initramfs.file_name("5.14", "default")])
+
+    @wrap_tempdir
+    def test__build_many(self, tempdir):
+        builder = ShellBuilder()
+        base = "verity_squash_root.initramfs.base"
+        with (mock.patch("{}.WORK_DIR".format(base), new=tempdir),
+              mock.patch("{}.exec_binaries".format(base),
+                         wraps=exec_binaries) as exec_mock):
+            with self.assertLogs(level="DEBUG") as logs:
+                result = builder.build_many([("6.1", "default"),
+                                             ("6.1", "fallback"),
+                                             ("5.15", "default")], 2)
+            self.assertEqual(result,
+                             [[tempdir / "6.1_default" / "image"],
+                              [tempdir / "6.1_fallback" / "image"],
+                              [tempdir / "5.15_default" / "image"]])
+            self.assertEqual(read_text_from(result[2][0]), "5.15\n")
+            # The output of the generators is logged per initramfs
+            self.assertEqual(
+                sorted(line for line in logs.output if ": built" in line),
+                ["DEBUG:root:5.15_default: built 5.15",
+                 "DEBUG:root:6.1_default: built 6.1",
+                 "DEBUG:root:6.1_fallback: built 6.1"])
+            self.assertEqual(exec_mock.call_args.args[1], 2)
+
+            self.assertEqual(
+                builder.build_initramfs_with_microcode("6.2", "default"),
+                [tempdir / "6.2_default" / "image"])
+            self.assertEqual(exec_mock.call_args.args[1], 1)
+            with self.assertRaises(ExecBinaryError):
+                builder.build_many([("6.1", "default")], 1)
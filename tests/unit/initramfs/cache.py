@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import unittest
+from pathlib import Path
+from unittest import mock
+from verity_squash_root.file_op import read_text_from, write_str_to
+from verity_squash_root.initramfs.cache import cached_initramfs, \
+    host_file_state, path_state, remove_unused_initramfs, store_initramfs
+from tests.unit.test_helper import wrap_tempdir
+
+
+def create_key_dir(tempdir: Path) -> Path:
+    key_dir = tempdir / "keys"
+    key_dir.mkdir()
+    write_str_to(key_dir / "db.key", "secret key")
+    return key_dir
+
+
+class InitramfsCacheTest(unittest.TestCase):
+
+    @wrap_tempdir
+    def test__path_state(self, tempdir):
+        (tempdir / "dir" / "sub").mkdir(parents=True)
+        write_str_to(tempdir / "dir" / "sub" / "file", "abc")
+        state = path_state(tempdir / "dir")
+        self.assertEqual([s[0] for s in state],
+                         [str(tempdir / "dir"), str(tempdir / "dir" / "sub"),
+                          str(tempdir / "dir" / "sub" / "file")])
+        self.assertEqual(state[2][1], 3)
+        self.assertEqual(path_state(tempdir / "missing"),
+                         [[str(tempdir / "missing"), None]])
+        st = (tempdir / "dir" / "sub" / "file").stat()
+        self.assertEqual(host_file_state("./{}/dir/sub/file".format(
+            str(tempdir).lstrip("/"))),
+            [str(tempdir / "dir" / "sub" / "file"), 3,
+             st.st_mtime_ns // 10**9, st.st_mode])
+        # The same files in another image have other inode numbers
+        shutil.copytree(tempdir / "dir", tempdir / "copy")
+        os.utime(tempdir / "copy", ns=(0, 0))
+        os.utime(tempdir / "dir", ns=(0, 0))
+        self.assertEqual(
+            [s[1:] for s in path_state(tempdir / "copy")],
+            [s[1:] for s in path_state(tempdir / "dir")])
+        # Booting a squashfs image cuts the mtime to whole seconds
+        state = path_state(tempdir / "dir")
+        os.utime(tempdir / "dir" / "sub" / "file", ns=(0, 1000000123456789))
+        before = path_state(tempdir / "dir")
+        self.assertNotEqual(before, state)
+        os.utime(tempdir / "dir" / "sub" / "file", ns=(0, 1000000000000000))
+        self.assertEqual(path_state(tempdir / "dir"), before)
+        self.assertEqual(host_file_state("kernel/x86/microcode.bin"),
+                         ["/kernel/x86/microcode.bin", None])
+        self.assertEqual(host_file_state("./"), ["/", "directory"])
+
+    @wrap_tempdir
+    def test__cached_initramfs(self, tempdir):
+        key_dir = create_key_dir(tempdir)
+        cache_dir = tempdir / "cache"
+        modules = tempdir / "modules"
+        modules.mkdir()
+        write_str_to(tempdir / "busybox", "busybox")
+        microcode = tempdir / "microcode.img"
+        write_str_to(microcode, "microcode ")
+        image = tempdir / "linux.initcpio"
+        write_str_to(image, "initramfs")
+        work_dir = tempdir / "work" / "linux"
+        builder = mock.Mock()
+        builder.work_dir.return_value = work_dir
+        builder.cache_inputs.return_value = [modules, tempdir / "conf"]
+        builder.list_image_files.return_value = [
+            str(tempdir / "busybox").lstrip("/"), "init"]
+
+        def cached():
+            return cached_initramfs(key_dir, cache_dir, builder, "6.1",
+                                    "default", "linux")
+
+        def store():
+            store_initramfs(key_dir, cache_dir, builder, "6.1", "default",
+                            "linux", [microcode, image])
+
+        self.assertIsNone(cached())
+        store()
+        builder.list_image_files.assert_called_once_with(
+            cache_dir / "linux.tmp")
+        self.assertEqual(cached(), work_dir / "linux.image")
+        self.assertEqual(read_text_from(cache_dir / "linux.image"),
+                         "microcode initramfs")
+        # The image is copied to the trusted work dir and checked there
+        builder.work_dir.assert_called_with("6.1", "default")
+        self.assertEqual(read_text_from(work_dir / "linux.image"),
+                         "microcode initramfs")
+        self.assertIsNone(cached_initramfs(key_dir, cache_dir, builder,
+                                           "6.2", "default", "linux"))
+
+        # Files in the image and inputs of the builder
+        write_str_to(tempdir / "busybox", "new busybox")
+        self.assertIsNone(cached())
+        store()
+        self.assertEqual(cached(), work_dir / "linux.image")
+        write_str_to(modules / "new.ko", "module")
+        self.assertIsNone(cached())
+        store()
+        write_str_to(tempdir / "conf", "HOOKS=()")
+        self.assertIsNone(cached())
+        store()
+        self.assertEqual(cached(), work_dir / "linux.image")
+
+        write_str_to(cache_dir / "linux.image", "modified")
+        with self.assertLogs() as logs:
+            self.assertIsNone(cached())
+        self.assertEqual(logs.output,
+                         ["WARNING:root:Ignoring invalid initramfs cache "
+                          "{}".format(cache_dir / "linux.image")])
+        self.assertFalse((work_dir / "linux.image").exists())
+
+        store()
+        inputs = cache_dir / "linux.inputs"
+        entry = json.loads(read_text_from(inputs))
+        entry["files"] = []
+        write_str_to(inputs, json.dumps(entry))
+        # The file list is part of the authenticated digest
+        self.assertIsNone(cached())
+        entry["digest"] = "0" * 64
+        write_str_to(inputs, json.dumps(entry))
+        with self.assertLogs() as logs:
+            self.assertIsNone(cached())
+        self.assertEqual(logs.output,
+                         ["WARNING:root:Ignoring invalid initramfs cache "
+                          "{}".format(inputs)])
+
+    @wrap_tempdir
+    def test__remove_unused_initramfs(self, tempdir):
+        remove_unused_initramfs(tempdir / "missing", [])
+        for name in ["linux.image", "linux.inputs", "linux-lts.image",
+                     "linux-lts.inputs", "linux-lts.tmp"]:
+            write_str_to(tempdir / name, "")
+        remove_unused_initramfs(tempdir, ["linux", "linux_fallback"])
+        self.assertEqual(sorted(p.name for p in tempdir.iterdir()),
+                         ["linux.image", "linux.inputs"])
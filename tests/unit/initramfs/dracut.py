@@ -1,6 +1,6 @@
 import unittest
+from pathlib import Path
 from unittest.mock import Mock, call, patch
-from verity_squash_root.config import TMPDIR
 from verity_squash_root.initramfs.dracut import Dracut
 
 
@@ -25,24 +25,59 @@ class DracutTest(unittest.TestCase):
              call.display_name()])
         self.assertEqual(res, "Debian Hardened linux")
 
-    @patch("verity_squash_root.initramfs.dracut.exec_binary")
-    def test__build_initramfs_with_microcode(self, exec_mock):
+    def test__initramfs_command(self):
         distri = Mock()
         dracut = Dracut(distri)
-        result = dracut.build_initramfs_with_microcode("5.17.2", "rr")
-        self.assertEqual(result, TMPDIR / "5.17.2-rr.image")
+        work_dir = Path("/tmp/verity_squash_root/initramfs/linux")
+        result = dracut.initramfs_command("5.17.2", "", work_dir)
         self.assertEqual(distri.mock_calls, [])
         self.assertEqual(
-            exec_mock.mock_calls,
-            [call(["dracut",
-                   "--kver", "5.17.2",
-                   "--no-uefi",
-                   "--early-microcode",
-                   "--add",
-                   "verity-squash-root",
-                   str(TMPDIR / "5.17.2-rr.image")])])
+            result,
+            (["dracut",
+              "--kver", "5.17.2",
+              "--no-uefi",
+              "--early-microcode",
+              "--add",
+              "verity-squash-root",
+              "--tmpdir", str(work_dir),
+              str(work_dir / "initramfs.image")],
+             [work_dir / "initramfs.image"]))
 
     def test__list_kernel_presets(self):
         distri = Mock()
         dracut = Dracut(distri)
         self.assertEqual(dracut.list_kernel_presets("5.17.2"), [""])
+
+    def test__cache_inputs(self):
+        distri = Mock()
+        dracut = Dracut(distri)
+        self.assertEqual(
+            dracut.cache_inputs("5.17.2", ""),
+            [distri.modules_dir.return_value, Path("/etc/dracut.conf"),
+             Path("/etc/dracut.conf.d"), Path("/usr/lib/dracut"),
+             Path("/usr/lib/firmware/amd-ucode"),
+             Path("/usr/lib/firmware/intel-ucode")])
+        distri.modules_dir.assert_called_once_with("5.17.2")
+
+    @patch("verity_squash_root.initramfs.dracut.exec_binary")
+    def test__list_image_files(self, exec_mock):
+        exec_mock.return_value = (
+            b"Image: /tmp/5.17.2-.image: 20M\n"
+            b"========================================\n"
+            b"Early CPIO image\n"
+            b"drwxr-xr-x   3 root     root            0 Jan  1 10:00 kernel\n"
+            b"-rw-r--r--   1 root     root        10240 Jan  1 10:00 "
+            b"kernel/x86/microcode/GenuineIntel.bin\n"
+            b"crw-r--r--   1 root     root       5,   1 Jan  1 10:00 "
+            b"dev/console\n"
+            b"lrwxrwxrwx   1 root     root            7 Jan  1  2023 bin -> "
+            b"usr/bin\n"
+            b"-rwxr-xr-x   1 root     root       123456 Jan  1 10:00 "
+            b"usr/bin/my tool\n", b"")
+        dracut = Dracut(Mock())
+        self.assertEqual(
+            dracut.list_image_files(Path("/tmp/5.17.2-.image")),
+            ["kernel/x86/microcode/GenuineIntel.bin", "bin",
+             "usr/bin/my tool"])
+        exec_mock.assert_called_once_with(["lsinitrd",
+                                           "/tmp/5.17.2-.image"])
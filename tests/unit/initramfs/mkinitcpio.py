@@ -1,10 +1,13 @@
+import os
+import shutil
 import unittest
 from pathlib import Path
 from unittest import mock
 from verity_squash_root.initramfs.mkinitcpio import Mkinitcpio
-from verity_squash_root.exec import exec_binary
-from verity_squash_root.config import TMPDIR
-from tests.unit.test_helper import PROJECT_ROOT, get_test_files_path
+from verity_squash_root.exec import ExecBinaryError, exec_binary
+from verity_squash_root.file_op import write_str_to
+from tests.unit.test_helper import PROJECT_ROOT, get_test_files_path, \
+    wrap_tempdir
 from tests.unit.distributions.base import distribution_mock
 
 TEST_FILES_DIR = get_test_files_path("initramfs/mkinitcpio")
@@ -24,7 +27,7 @@ class MkinitcpioTest(unittest.TestCase):
         self.assertEqual(mkinitcpio.display_name("5.14", "set"),
                          "Arch Linux lts (set)")
 
-    def test__build_initramfs_with_microcode(self):
+    def test__initramfs_command(self):
         preset_info = "some info\npreset_image = /test\nsome more info\nx=y\n"
 
         def read(file):
@@ -35,57 +38,106 @@ class MkinitcpioTest(unittest.TestCase):
         base = "verity_squash_root.initramfs.mkinitcpio"
         all_mocks = mock.Mock()
         all_mocks.read_text_from.side_effect = read
-        with (mock.patch("{}.merge_initramfs_images".format(base),
-                         new=all_mocks.merge_initramfs_images),
-              mock.patch("{}.exec_binary".format(base),
-                         new=all_mocks.exec_binary),
+        work_dir = Path("/tmp/verity_squash_root/initramfs/linux-lts_x")
+        with (mock.patch("{}.initramfs_parts".format(base),
+                         new=all_mocks.initramfs_parts),
               mock.patch("{}.read_text_from".format(base),
                          new=all_mocks.read_text_from),
               mock.patch("{}.write_str_to".format(base),
                          new=all_mocks.write_str_to)):
             distri_mock = distribution_mock()
             mkinitcpio = Mkinitcpio(distri_mock)
-            res = mkinitcpio.build_initramfs_with_microcode(
-                "5.14", "x_preset")
-            base_name = "linux-lts-x_preset"
+            res = mkinitcpio.initramfs_command("5.14", "x_preset", work_dir)
             call = mock.call
             self.assertEqual(
                 all_mocks.mock_calls,
                 [call.read_text_from(
                      Path("/etc/mkinitcpio.d/linux-lts.preset")),
                  call.write_str_to(
-                     TMPDIR / "linux-lts-x_preset.preset",
+                     work_dir / "x_preset.preset",
                      ("{}\n"
                       "PRESETS=('x_preset')\n"
-                      "x_preset_image={}/{}.initcpio\n"
+                      "x_preset_image={}/x_preset.initcpio\n"
                       "x_preset_options=\"${{x_preset_options}} "
-                      "-A verity-squash-root\"\n"
-                      ).format(
-                          preset_info, TMPDIR, base_name)),
-                 call.exec_binary(["mkinitcpio", "-p",
-                                   "{}/{}.preset".format(TMPDIR, base_name)]),
-                 call.merge_initramfs_images(TMPDIR / "{}.initcpio".format(
-                                                 base_name),
-                                             distri_mock.microcode_paths(),
-                                             TMPDIR / "{}.image".format(
-                                                 base_name))])
-            self.assertEqual(res, TMPDIR / "{}.image".format(base_name))
+                      "-A verity-squash-root -t {}\"\n"
+                      ).format(preset_info, work_dir, work_dir)),
+                 call.initramfs_parts(work_dir / "x_preset.initcpio",
+                                      distri_mock.microcode_paths())])
+            self.assertEqual(
+                res, (["mkinitcpio", "-p", str(work_dir / "x_preset.preset")],
+                      all_mocks.initramfs_parts.return_value))
 
+    @wrap_tempdir
     @mock.patch("verity_squash_root.initramfs.mkinitcpio.exec_binary")
-    def test__list_kernel_presets(self, exec_mock):
-        def change_lib_path(cmd):
-            cmd[0] = str(PROJECT_ROOT / cmd[0].strip('/'))
-            cmd[1] = "../..{}".format(
-                TEST_FILES_DIR / "linux_name")
-            return exec_binary(cmd)
+    def test__list_kernel_presets(self, exec_mock, tempdir):
+        shutil.copy(TEST_FILES_DIR / "linux_name.preset",
+                    tempdir / "linux.preset")
+        write_str_to(tempdir / "linux-lts.preset", "PRESETS=('default')\n")
+        run = "/usr/lib/verity-squash-root/mkinitcpio_list_presets"
+
+        def list_presets(cmd):
+            # The helper loads the presets from /etc/mkinitcpio.d
+            stdout, stderr = exec_binary(
+                [str(PROJECT_ROOT / cmd[0].strip("/"))] +
+                ["../..{}".format(tempdir / name) for name in cmd[1:]])
+            return (stdout.replace("../..{}/".format(tempdir).encode(), b""),
+                    stderr)
+
+        exec_mock.side_effect = list_presets
+        with mock.patch("verity_squash_root.initramfs.mkinitcpio.PRESET_DIR",
+                        new=tempdir):
+            mkinitcpio = Mkinitcpio(distribution_mock())
+            self.assertEqual(mkinitcpio.list_kernel_presets("5.14"),
+                             ["default"])
+            self.assertEqual(
+                mkinitcpio.list_all_kernel_presets(["5.19", "5.14"]),
+                {"5.19": ["default", "fallback", "test"],
+                 "5.14": ["default"]})
+            self.assertEqual(mkinitcpio.list_kernel_presets("5.19"),
+                             ["default", "fallback", "test"])
+            # Listed again, when the preset file changes
+            mtime = (tempdir / "linux-lts.preset").stat().st_mtime_ns
+            os.utime(tempdir / "linux-lts.preset",
+                     ns=(mtime, mtime + 10 ** 9))
+            self.assertEqual(
+                mkinitcpio.list_all_kernel_presets(["5.19", "5.14"]),
+                {"5.19": ["default", "fallback", "test"],
+                 "5.14": ["default"]})
+        self.assertEqual(exec_mock.mock_calls,
+                         [mock.call([run, "linux-lts"]),
+                          mock.call([run, "linux"]),
+                          mock.call([run, "linux-lts"])])
+
+    def test__list_presets_helper(self):
+        # All presets are listed by one call, an invalid preset fails it
+        run = str(PROJECT_ROOT /
+                  "usr/lib/verity-squash-root/mkinitcpio_list_presets")
+        preset = "../..{}".format(TEST_FILES_DIR / "linux_name")
+        self.assertEqual(
+            exec_binary([run, preset, preset])[0].decode().splitlines(),
+            ["{} {}".format(preset, p)
+             for p in ["default", "fallback", "test"] * 2])
+        with self.assertRaises(ExecBinaryError):
+            exec_binary([run, preset, "../../not/existing"])
 
-        exec_mock.side_effect = change_lib_path
+    def test__cache_inputs(self):
+        distri_mock = distribution_mock()
+        distri_mock.microcode_paths.return_value = [
+            Path("/boot/intel-ucode.img")]
+        mkinitcpio = Mkinitcpio(distri_mock)
+        self.assertEqual(
+            mkinitcpio.cache_inputs("5.14", "default"),
+            [distri_mock.modules_dir.return_value,
+             Path("/etc/mkinitcpio.conf"), Path("/etc/mkinitcpio.conf.d"),
+             Path("/etc/mkinitcpio.d/linux-lts.preset"),
+             Path("/etc/initcpio"), Path("/usr/lib/initcpio"),
+             Path("/boot/intel-ucode.img")])
+        distri_mock.modules_dir.assert_called_once_with("5.14")
+
+    @mock.patch("verity_squash_root.initramfs.mkinitcpio.exec_binary")
+    def test__list_image_files(self, exec_mock):
+        exec_mock.return_value = (b"./\n./usr/bin/busybox\n./init\n", b"")
         mkinitcpio = Mkinitcpio(distribution_mock())
-        result = mkinitcpio.list_kernel_presets("5.14")
-        self.assertEqual(result, ["default", "fallback", "test"])
-        exec_mock.assert_called_once_with([
-            str(PROJECT_ROOT /
-                'usr/lib/verity-squash-root/mkinitcpio_list_presets'),
-            "../..{}".format(
-                PROJECT_ROOT /
-                'tests/unit/files/initramfs/mkinitcpio/linux_name')])
+        self.assertEqual(mkinitcpio.list_image_files(Path("/tmp/l.image")),
+                         ["./", "./usr/bin/busybox", "./init"])
+        exec_mock.assert_called_once_with(["lsinitcpio", "/tmp/l.image"])
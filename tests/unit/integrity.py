@@ -0,0 +1,17 @@
+import unittest
+from verity_squash_root.file_op import write_str_to
+from verity_squash_root.integrity import key_mac, key_mac_matches
+from .test_helper import wrap_tempdir
+
+
+class IntegrityTest(unittest.TestCase):
+
+    @wrap_tempdir
+    def test__key_mac(self, tempdir):
+        write_str_to(tempdir / "db.key", "my key")
+        mac = key_mac(tempdir, "some text")
+        self.assertEqual(len(mac), 64)
+        self.assertTrue(key_mac_matches(tempdir, "some text", mac))
+        self.assertFalse(key_mac_matches(tempdir, "other text", mac))
+        write_str_to(tempdir / "db.key", "other key")
+        self.assertFalse(key_mac_matches(tempdir, "some text", mac))
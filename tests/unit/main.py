@@ -1,3 +1,4 @@
+import threading
 import unittest
 from pathlib import Path
 from unittest import mock
@@ -5,11 +6,15 @@ from unittest.mock import call
 from tests.unit.distributions.base import distribution_mock
 from tests.unit.initramfs import create_initramfs_mock
 from tests.unit.test_helper import wrap_tempdir
-from verity_squash_root.config import KEY_DIR
+from verity_squash_root.config import KEY_DIR, REPORT_FILE
 from verity_squash_root.main import move_kernel_to, \
-    create_squashfs_return_verity_hash, build_and_move_kernel, \
-    create_image_and_sign_kernel, backup_and_sign_efi, \
-    backup_and_sign_extra_files, create_directory
+    create_squashfs_return_verity_hash, move_kernel, \
+    create_delta_squashfs_return_verity_hash, \
+    build_initramfs_images, build_kernel_efis, \
+    create_image_and_sign_kernel, build_image_and_sign_kernel, \
+    backup_and_sign_efis, remove_image, \
+    backup_and_sign_extra_files, create_directory, scan_root_return_digest, \
+    stage_image_on_root
 
 
 class MainTest(unittest.TestCase):
@@ -17,11 +22,20 @@ class MainTest(unittest.TestCase):
     def test__move_kernel_to(self):
         base = "verity_squash_root.main"
         all_mocks = mock.Mock()
+        all_mocks.dest.name = "linux.efi"
+        tmp_dest = all_mocks.dest.with_name.return_value
+        copy_calls = [call.dest.with_name("linux.efi.tmp"),
+                      call.shutil.move(all_mocks.src, tmp_dest)]
+        changed_calls = [call.dest.exists(),
+                         call.files_equal(all_mocks.src, all_mocks.dest)]
 
         with (mock.patch("{}.shutil".format(base),
                          new=all_mocks.shutil),
+              mock.patch("{}.files_equal".format(base),
+                         new=all_mocks.files_equal),
               mock.patch("{}.efi".format(base),
                          new=all_mocks.efi)):
+            all_mocks.files_equal.return_value = False
             # Kernel does not exist yet
             all_mocks.dest.exists.return_value = False
             move_kernel_to(all_mocks.src,
@@ -30,9 +44,9 @@ class MainTest(unittest.TestCase):
                            all_mocks.backup)
             self.assertEqual(
                 all_mocks.mock_calls,
-                [call.dest.exists(),
-                 call.shutil.move(all_mocks.src,
-                                  all_mocks.dest)])
+                [call.dest.exists()] + copy_calls + [
+                    call.dest.exists(),
+                    call.dest.with_name().replace(all_mocks.dest)])
 
             all_mocks.reset_mock()
             # Kernel exist, backup not supplied
@@ -43,12 +57,11 @@ class MainTest(unittest.TestCase):
                            None)
             self.assertEqual(
                 list(all_mocks.mock_calls),
-                [call.dest.exists(),
-                 call.efi.file_matches_slot_or_is_broken(
-                     all_mocks.dest, "a"),
-                 call.dest.unlink(),
-                 call.shutil.move(all_mocks.src,
-                                  all_mocks.dest)])
+                changed_calls + copy_calls + [
+                    call.dest.exists(),
+                    call.efi.file_matches_slot_or_is_broken(
+                        all_mocks.dest, "a"),
+                    call.dest.with_name().replace(all_mocks.dest)])
 
             all_mocks.reset_mock()
             # Kernel exist, slot does not match
@@ -60,11 +73,12 @@ class MainTest(unittest.TestCase):
                            all_mocks.backup)
             self.assertEqual(
                 all_mocks.mock_calls,
-                [call.dest.exists(),
-                 call.efi.file_matches_slot_or_is_broken(all_mocks.dest, "b"),
-                 call.dest.replace(all_mocks.backup),
-                 call.shutil.move(all_mocks.src,
-                                  all_mocks.dest)])
+                changed_calls + copy_calls + [
+                    call.dest.exists(),
+                    call.efi.file_matches_slot_or_is_broken(
+                        all_mocks.dest, "b"),
+                    call.dest.replace(all_mocks.backup),
+                    call.dest.with_name().replace(all_mocks.dest)])
 
             all_mocks.reset_mock()
             # Kernel exist, slot matches
@@ -76,11 +90,24 @@ class MainTest(unittest.TestCase):
                            all_mocks.backup)
             self.assertEqual(
                 all_mocks.mock_calls,
-                [call.dest.exists(),
-                 call.efi.file_matches_slot_or_is_broken(all_mocks.dest, "a"),
-                 call.dest.unlink(),
-                 call.shutil.move(all_mocks.src,
-                                  all_mocks.dest)])
+                changed_calls + copy_calls + [
+                    call.dest.exists(),
+                    call.efi.file_matches_slot_or_is_broken(
+                        all_mocks.dest, "a"),
+                    call.dest.with_name().replace(all_mocks.dest)])
+
+            all_mocks.reset_mock()
+            # Kernel exists and is unchanged
+            all_mocks.files_equal.return_value = True
+            with self.assertLogs() as logs:
+                move_kernel_to(all_mocks.src,
+                               all_mocks.dest,
+                               "a",
+                               all_mocks.backup)
+            self.assertEqual(logs.output,
+                             ["INFO:root:Efi linux.efi is unchanged"])
+            self.assertEqual(all_mocks.mock_calls,
+                             changed_calls + [call.src.unlink()])
 
     def test__create_squashfs_return_verity_hash(self):
         base = "verity_squash_root.main"
@@ -96,22 +123,117 @@ class MainTest(unittest.TestCase):
 
         with (mock.patch("{}.veritysetup_image".format(base),
                          new=all_mocks.veritysetup_image),
+              mock.patch("{}.squashfs_profile".format(base),
+                         new=all_mocks.squashfs_profile),
               mock.patch("{}.mksquashfs".format(base),
                          new=all_mocks.mksquashfs)):
             result = create_squashfs_return_verity_hash(
                 config, Path("/tmp/test.img"))
             self.assertEqual(
                 all_mocks.mock_calls,
-                [call.mksquashfs(['var/lib', 'opt/var'],
+                [call.squashfs_profile(config),
+                 call.mksquashfs(['var/lib', 'opt/var'],
                                  Path('/tmp/test.img'),
                                  Path('/opt/mnt/root'),
-                                 Path('/boot/second/efi')),
+                                 Path('/boot/second/efi'),
+                                 all_mocks.squashfs_profile.return_value),
                  call.veritysetup_image(
                      Path('/tmp/test.img'))])
             self.assertEqual(
                 result,
                 all_mocks.veritysetup_image())
 
+    def test__create_delta_squashfs_return_verity_hash(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {
+            "DEFAULT": {
+                "ROOT_MOUNT": "/opt/mnt/root",
+                "EFI_PARTITION": "/boot/efi",
+                "EXCLUDE_DIRS": "var/lib",
+            }
+        }
+        delta_base = mock.Mock()
+        delta_base.image = Path("/opt/mnt/root/image_a.squashfs")
+        image = Path("/tmp/test.img")
+        scan = Path("/tmp/scan")
+        options = ["-ef", "exclude", "-pf", "pseudo"]
+        with (mock.patch("{}.read_scan_records".format(base),
+                         new=all_mocks.read_scan_records),
+              mock.patch("{}.compute_delta".format(base),
+                         new=all_mocks.compute_delta),
+              mock.patch("{}.write_delta_options".format(base),
+                         new=all_mocks.write_delta_options),
+              mock.patch("{}.veritysetup_image".format(base),
+                         new=all_mocks.veritysetup_image),
+              mock.patch("{}.squashfs_profile".format(base),
+                         new=all_mocks.squashfs_profile),
+              mock.patch("{}.mksquashfs".format(base),
+                         new=all_mocks.mksquashfs)):
+            all_mocks.compute_delta.return_value = (["usr"], ["old"])
+            all_mocks.write_delta_options.return_value = options
+            result = create_delta_squashfs_return_verity_hash(
+                config, image, scan, delta_base)
+            start = [
+                call.read_scan_records(scan),
+                call.compute_delta(delta_base.records,
+                                   all_mocks.read_scan_records.return_value),
+                call.write_delta_options(
+                    ["usr"], ["old"], Path("/tmp/verity_squash_root/delta"))]
+            self.assertEqual(
+                all_mocks.mock_calls,
+                start + [
+                    call.squashfs_profile(config),
+                    call.mksquashfs(['var/lib'], image,
+                                    Path('/opt/mnt/root'), Path('/boot/efi'),
+                                    all_mocks.squashfs_profile.return_value,
+                                    options),
+                    call.veritysetup_image(image)])
+            self.assertEqual(result, all_mocks.veritysetup_image.return_value)
+
+            all_mocks.reset_mock()
+            all_mocks.write_delta_options.return_value = None
+            self.assertIsNone(create_delta_squashfs_return_verity_hash(
+                config, image, scan, delta_base))
+            self.assertEqual(all_mocks.mock_calls, start)
+
+    def test__scan_root_return_digest(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {
+            "DEFAULT": {
+                "ROOT_MOUNT": "/opt/mnt/root",
+                "EFI_PARTITION": "/boot/second/efi",
+                "EXCLUDE_DIRS": "var/lib,opt/var",
+            }
+        }
+
+        options = all_mocks.squashfs_profile.return_value.\
+            compression_options.return_value
+        with (mock.patch("{}.mksquashfs_cmd".format(base),
+                         new=all_mocks.mksquashfs_cmd),
+              mock.patch("{}.squashfs_profile".format(base),
+                         new=all_mocks.squashfs_profile),
+              mock.patch("{}.exclude_patterns".format(base),
+                         new=all_mocks.exclude_patterns),
+              mock.patch("{}.write_scan".format(base),
+                         new=all_mocks.write_scan)):
+            result = scan_root_return_digest(config, Path("/tmp/scan"))
+            args = (['var/lib', 'opt/var'], Path('/opt/mnt/root'),
+                    Path('/boot/second/efi'))
+            self.assertEqual(
+                all_mocks.mock_calls,
+                [call.squashfs_profile(config),
+                 call.squashfs_profile().compression_options(),
+                 call.mksquashfs_cmd(args[0], Path('image.squashfs'),
+                                     args[1], args[2], options),
+                 call.exclude_patterns(*args),
+                 call.write_scan(Path("/"),
+                                 all_mocks.exclude_patterns.return_value,
+                                 all_mocks.mksquashfs_cmd.return_value,
+                                 Path("/tmp/scan"))])
+            self.assertEqual(result, all_mocks.write_scan.return_value)
+
     def test__create_directory(self):
         path = mock.Mock()
         create_directory(path)
@@ -119,59 +241,143 @@ class MainTest(unittest.TestCase):
             path.mock_calls,
             [call.mkdir(parents=True, exist_ok=True)])
 
-    def test__build_and_move_kernel(self):
+    def test__move_kernel(self):
+        base = "verity_squash_root.main"
+        use_slot = mock.Mock()
+        tmp_efi = Path('/tmp/work/linux_fallback.efi')
+
+        with mock.patch("{}.move_kernel_to".format(base)) as move_mock:
+            # No backup
+            move_kernel(tmp_efi, use_slot, "linux_fallback",
+                        Path("/boot/ef/EFI/Debian"),
+                        ["linux", "linux_fallback_backup", "lts_lin"])
+            self.assertEqual(
+                move_mock.mock_calls,
+                [call(tmp_efi,
+                      Path('/boot/ef/EFI/Debian/linux_fallback.efi'),
+                      use_slot, None)])
+
+            move_mock.reset_mock()
+            # Backup
+            move_kernel(tmp_efi, use_slot, "linux_tmpfs",
+                        Path("/boot/efidir/EFI/Debian"),
+                        ["linux", "linux_tmp", "lts_lin"])
+            self.assertEqual(
+                move_mock.mock_calls,
+                [call(tmp_efi,
+                      Path('/boot/efidir/EFI/Debian/linux_tmpfs.efi'),
+                      use_slot,
+                      Path('/boot/efidir/EFI/Debian/'
+                           'linux_tmpfs_backup.efi'))])
+
+    def test__build_initramfs_images(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        jobs = [("5.19", "default", Path("/lib64/modules/5.19/vmlinuz"),
+                 "linux_default", "Display Linux"),
+                ("5.14", "default", Path("/lib64/modules/5.14/vmlinuz"),
+                 "linux-lts_default", "Display Linux-lts")]
+        cache_dir = Path("/mnt/root/initramfs_cache")
+        cached = Path("/tmp/verity_squash_root/initramfs/linux_default/"
+                      "linux_default.image")
+        built = [[Path("/tmp/linux.img")], [Path("/tmp/linux-lts.img")]]
+        all_mocks.initramfs.build_many.return_value = built
+        with (mock.patch("{}.cached_initramfs".format(base),
+                         new=all_mocks.cached_initramfs),
+              mock.patch("{}.store_initramfs".format(base),
+                         new=all_mocks.store_initramfs)):
+            self.assertEqual(
+                build_initramfs_images(all_mocks.initramfs, jobs, 3), built)
+            self.assertEqual(all_mocks.mock_calls,
+                             [call.initramfs.build_many(
+                                 [("5.19", "default"), ("5.14", "default")],
+                                 3)])
+
+            all_mocks.reset_mock()
+            all_mocks.cached_initramfs.side_effect = [cached, None]
+            all_mocks.initramfs.build_many.return_value = built[1:]
+            with self.assertLogs() as logs:
+                self.assertEqual(
+                    build_initramfs_images(all_mocks.initramfs, jobs, 3,
+                                           cache_dir),
+                    [[cached], built[1]])
+            self.assertEqual(logs.output,
+                             ["INFO:root:Reusing initramfs for Display Linux",
+                              "INFO:root:Create initramfs for "
+                              "Display Linux-lts"])
+            self.assertEqual(
+                all_mocks.mock_calls,
+                [call.cached_initramfs(KEY_DIR, cache_dir,
+                                       all_mocks.initramfs, "5.19",
+                                       "default", "linux_default"),
+                 call.cached_initramfs(KEY_DIR, cache_dir,
+                                       all_mocks.initramfs, "5.14",
+                                       "default", "linux-lts_default"),
+                 call.initramfs.build_many([("5.14", "default")], 3),
+                 call.store_initramfs(KEY_DIR, cache_dir,
+                                      all_mocks.initramfs, "5.14", "default",
+                                      "linux-lts_default", built[1])])
+
+    def test__build_kernel_efis(self):
         base = "verity_squash_root.main"
         all_mocks = mock.Mock()
         config = mock.Mock()
-        vmlinuz = mock.Mock()
-        initramfs = mock.Mock()
-        use_slot = mock.Mock()
-        root_hash = mock.Mock()
-        cmdline_add = mock.Mock()
+        vmlinuz = Path("/boot/vmlinuz")
+        job = ("5.19", "default", vmlinuz, "linux", "Linux")
+        initrd = [Path("/tmp/initramfs.img")]
+        work_dir = Path("/tmp/verity_squash_root/efi/linux")
+        efi_file = work_dir / "linux.efi"
+        tmpfs_efi_file = work_dir / "linux_tmpfs.efi"
 
         with (mock.patch("{}.efi".format(base),
                          new=all_mocks.efi),
-              mock.patch("{}.move_kernel_to".format(base),
-                         new=all_mocks.move_kernel_to)):
-            # No install
-            build_and_move_kernel(
-                config, vmlinuz, initramfs, use_slot, root_hash,
-                cmdline_add, "linux_fallback", Path("/boot/ef/EFI/Debian"),
-                "Debian Linux", ["linux", "linux_fallback", "linux-lts"])
-            self.assertEqual(all_mocks.mock_calls, [])
-
-            # No backup
-            build_and_move_kernel(
-                config, vmlinuz, initramfs, use_slot, root_hash,
-                cmdline_add, "linux_fallback", Path("/boot/ef/EFI/Debian"),
-                "Debian Linux", ["linux", "linux_fallback_backup", "lts_lin"])
+              mock.patch("{}.create_directory".format(base),
+                         new=all_mocks.create_directory)):
+            with self.assertLogs() as logs:
+                result = build_kernel_efis(config, job, initrd, "a", "hash",
+                                           ["linux_fallback"])
+            self.assertEqual(logs.output,
+                             ["INFO:root:Processing Linux",
+                              "INFO:root:Processing Linux tmpfs"])
+            self.assertEqual(
+                all_mocks.mock_calls,
+                [call.create_directory(work_dir),
+                 call.efi.build_and_sign_kernels(
+                     config, vmlinuz, initrd, "a", "hash",
+                     [(efi_file, ""),
+                      (tmpfs_efi_file, "verity_squash_root_volatile")])])
+            self.assertEqual(result, [(efi_file, "linux"),
+                                      (tmpfs_efi_file, "linux_tmpfs")])
 
+            all_mocks.reset_mock()
+            result = build_kernel_efis(config, job, initrd, "a", "hash",
+                                       ["linux_tmpfs"])
             self.assertEqual(
                 all_mocks.mock_calls,
-                [call.efi.build_and_sign_kernel(
-                     config, vmlinuz, initramfs, use_slot, root_hash,
-                     Path('/tmp/verity_squash_root/tmp.efi'), cmdline_add),
-                 call.move_kernel_to(
-                     Path('/tmp/verity_squash_root/tmp.efi'),
-                     Path('/boot/ef/EFI/Debian/linux_fallback.efi'),
-                     use_slot, None)])
+                [call.create_directory(work_dir),
+                 call.efi.build_and_sign_kernels(
+                     config, vmlinuz, initrd, "a", "hash",
+                     [(efi_file, "")])])
+            self.assertEqual(result, [(efi_file, "linux")])
 
             all_mocks.reset_mock()
-            # Backup
-            build_and_move_kernel(
-                config, vmlinuz, initramfs, use_slot, root_hash,
-                cmdline_add, "linux_tmpfs", Path("/boot/efidir/EFI/Debian"),
-                "Debian Linux 11", ["linux", "linux_tmp", "lts_lin"])
+            result = build_kernel_efis(config, job, initrd, "a", "hash", [],
+                                       "verity_squash_root_base=base_1")
             self.assertEqual(
                 all_mocks.mock_calls,
-                [call.efi.build_and_sign_kernel(
-                     config, vmlinuz, initramfs, use_slot, root_hash,
-                     Path('/tmp/verity_squash_root/tmp.efi'), cmdline_add),
-                 call.move_kernel_to(
-                     Path('/tmp/verity_squash_root/tmp.efi'),
-                     Path('/boot/efidir/EFI/Debian/linux_tmpfs.efi'),
-                     use_slot,
-                     Path('/boot/efidir/EFI/Debian/linux_tmpfs_backup.efi'))])
+                [call.create_directory(work_dir),
+                 call.efi.build_and_sign_kernels(
+                     config, vmlinuz, initrd, "a", "hash",
+                     [(efi_file, "verity_squash_root_base=base_1"),
+                      (tmpfs_efi_file, "verity_squash_root_volatile "
+                       "verity_squash_root_base=base_1")])])
+
+            all_mocks.reset_mock()
+            result = build_kernel_efis(config, job, initrd, "a", "hash",
+                                       ["linux", "linux_tmpfs"])
+            self.assertEqual(all_mocks.mock_calls,
+                             [call.create_directory(work_dir)])
+            self.assertEqual(result, [])
 
     def test__create_image_and_sign_kernel(self):
         base = "verity_squash_root.main"
@@ -180,9 +386,21 @@ class MainTest(unittest.TestCase):
         use_slot = mock.Mock()
         root_hash = mock.Mock()
 
-        def initrdfunc(kernel, preset):
-            return Path("/path/initramfs_{}_{}.img".format(kernel, preset))
+        def build_efis(config, job, initramfs_path, use_slot, root_hash,
+                       ignore_efis, extra_cmdline):
+            base_name = job[3]
+            return [(Path("/tmp/{}.efi".format(base_name)), base_name),
+                    (Path("/tmp/{}_tmpfs.efi".format(base_name)),
+                     "{}_tmpfs".format(base_name))]
 
+        # Builds run in another thread, so the order between builds and
+        # moves is not fixed
+        build_mock = mock.Mock(side_effect=build_efis)
+        move_mock = mock.Mock()
+        initrd_fallback = [Path("/tmp/linux_fallback.img")]
+        initrd_lts = [Path("/tmp/linux-lts_default.img")]
+        initramfs_build_mock = mock.Mock(
+            return_value=[initrd_fallback, initrd_lts])
         config = {
             "DEFAULT": {
                 "ROOT_MOUNT": "/opt/mnt/root",
@@ -190,6 +408,10 @@ class MainTest(unittest.TestCase):
                 "IGNORE_KERNEL_EFIS":
                     " linux_default ,linux_default_tmpfs ,linux_fallback_tmpfs"
                     ",linux_lts_t",
+                "INCREMENTAL_BUILD": "false",
+                "DELTA_BUILD": "false",
+                "INITRAMFS_CACHE": "false",
+                "STAGE_IMAGE_ON_ROOT_MOUNT": "false",
             }
         }
         ignored_efis = ["linux_default", "linux_default_tmpfs",
@@ -202,12 +424,22 @@ class MainTest(unittest.TestCase):
                          new=all_mocks.create_directory),
               mock.patch("{}.create_squashfs_return_verity_hash".format(base),
                          new=all_mocks.create_squashfs_return_verity_hash),
-              mock.patch("{}.build_and_move_kernel".format(base),
-                         new=all_mocks.build_and_move_kernel),
+              mock.patch("{}.build_initramfs_images".format(base),
+                         new=initramfs_build_mock),
+              mock.patch("{}.build_kernel_efis".format(base),
+                         new=build_mock),
+              mock.patch("{}.move_kernel".format(base),
+                         new=move_mock),
               mock.patch("{}.shutil".format(base),
                          new=all_mocks.shutil),
-              mock.patch("{}.move_kernel_to".format(base),
-                         new=all_mocks.move_kernel_to)):
+              mock.patch("{}.move_file".format(base),
+                         new=all_mocks.move_file),
+              mock.patch("{}.manifest_path".format(base),
+                         new=all_mocks.manifest_path),
+              mock.patch("{}.base_reference_path".format(base),
+                         new=all_mocks.base_reference_path),
+              mock.patch("{}.remove_unused_bases".format(base),
+                         new=all_mocks.remove_unused_bases)):
             distri_mock = distribution_mock()
             # create separate mock, since otherwise all_mock history will be
             # full # with initramfs calls to distribution.
@@ -215,14 +447,18 @@ class MainTest(unittest.TestCase):
             distri_initramfs_mock = mock.Mock()
             distri_initramfs_mock.distri = distri_mock
             distri_initramfs_mock.initramfs = initramfs_mock
-            initramfs_mock.build_initramfs_with_microcode.side_effect = \
-                initrdfunc
             all_mocks.cmdline.unused_slot.return_value = use_slot
             all_mocks.create_squashfs_return_verity_hash.return_value = \
                 root_hash
             all_mocks.read_text_from.return_value = cmdline
-            create_image_and_sign_kernel(config, distri_mock, initramfs_mock)
+            build_image_and_sign_kernel(config, distri_mock, initramfs_mock)
             efi_path = Path('/boot/efi/EFI/verity_squash_root/ArchEfi')
+            fallback_job = ("5.19", "fallback",
+                            Path('/lib64/modules/5.19/vmlinuz'),
+                            "linux_fallback", "Display Linux (fallback)")
+            lts_job = ("5.14", "default",
+                       Path('/lib64/modules/5.14/vmlinuz'),
+                       "linux-lts_default", "Display Linux-lts (default)")
             self.assertEqual(
                 all_mocks.mock_calls,
                 [call.read_text_from(Path('/proc/cmdline')),
@@ -232,62 +468,44 @@ class MainTest(unittest.TestCase):
                  call.create_squashfs_return_verity_hash(
                      config,
                      Path('/tmp/verity_squash_root/tmp.squashfs')),
-                 call.build_and_move_kernel(
-                     config,
-                     Path('/lib64/modules/5.19/vmlinuz'),
-                     Path('/path/initramfs_5.19_fallback.img'),
-                     use_slot,
-                     root_hash,
-                     '',
-                     'linux_fallback',
-                     efi_path,
-                     'Display Linux (fallback)',
-                     ignored_efis),
-                 call.build_and_move_kernel(
-                     config,
-                     Path('/lib64/modules/5.19/vmlinuz'),
-                     Path('/path/initramfs_5.19_fallback.img'),
-                     use_slot,
-                     root_hash,
-                     'verity_squash_root_volatile',
-                     'linux_fallback_tmpfs',
-                     efi_path,
-                     'Display Linux (fallback) tmpfs',
-                     ignored_efis),
-                 call.build_and_move_kernel(
-                     config,
-                     Path('/lib64/modules/5.14/vmlinuz'),
-                     Path('/path/initramfs_5.14_default.img'),
-                     use_slot,
-                     root_hash,
-                     '',
-                     'linux-lts_default',
-                     efi_path,
-                     'Display Linux-lts (default)',
-                     ignored_efis),
-                 call.build_and_move_kernel(
-                     config,
-                     Path('/lib64/modules/5.14/vmlinuz'),
-                     Path('/path/initramfs_5.14_default.img'),
-                     use_slot,
-                     root_hash,
-                     'verity_squash_root_volatile',
-                     'linux-lts_default_tmpfs',
-                     efi_path,
-                     'Display Linux-lts (default) tmpfs',
-                     ignored_efis),
-                 call.shutil.move(
+                 call.manifest_path(Path(
+                     '/opt/mnt/root/image_{}.squashfs'.format(use_slot))),
+                 call.manifest_path().unlink(missing_ok=True),
+                 call.move_file(
                      Path('/tmp/verity_squash_root/tmp.squashfs'),
                      Path('/opt/mnt/root/image_{}.squashfs'.format(use_slot))),
-                 call.shutil.move(
+                 call.move_file(
                      Path('/tmp/verity_squash_root/tmp.squashfs.verity'),
                      Path('/opt/mnt/root/image_{}.squashfs.verity'.format(
-                         use_slot)))])
+                         use_slot))),
+                 call.base_reference_path(Path(
+                     '/opt/mnt/root/image_{}.squashfs'.format(use_slot))),
+                 call.base_reference_path().unlink(missing_ok=True),
+                 call.remove_unused_bases(Path("/opt/mnt/root"))])
+            self.assertEqual(
+                initramfs_build_mock.mock_calls,
+                [call(initramfs_mock, [fallback_job, lts_job], 1, None)])
+            self.assertEqual(
+                build_mock.mock_calls,
+                [call(config, fallback_job, initrd_fallback, use_slot,
+                      root_hash, ignored_efis, ""),
+                 call(config, lts_job, initrd_lts, use_slot, root_hash,
+                      ignored_efis, "")])
+            self.assertEqual(
+                move_mock.mock_calls,
+                [call(Path("/tmp/linux_fallback.efi"), use_slot,
+                      "linux_fallback", efi_path, ignored_efis),
+                 call(Path("/tmp/linux_fallback_tmpfs.efi"), use_slot,
+                      "linux_fallback_tmpfs", efi_path, ignored_efis),
+                 call(Path("/tmp/linux-lts_default.efi"), use_slot,
+                      "linux-lts_default", efi_path, ignored_efis),
+                 call(Path("/tmp/linux-lts_default_tmpfs.efi"), use_slot,
+                      "linux-lts_default_tmpfs", efi_path, ignored_efis)])
             self.assertEqual(
                 distri_initramfs_mock.mock_calls,
                 [call.distri.efi_dirname(),
                  call.distri.list_kernels(),
-                 call.initramfs.list_kernel_presets('5.19'),
+                 call.initramfs.list_all_kernel_presets(['5.19', '5.14']),
                  call.initramfs.file_name('5.19', 'default'),
                  call.distri.vmlinuz('5.19'),
                  call.initramfs.file_name('5.19', 'default'),
@@ -296,30 +514,479 @@ class MainTest(unittest.TestCase):
                  call.distri.vmlinuz('5.19'),
                  call.initramfs.file_name('5.19', 'fallback'),
                  call.initramfs.display_name('5.19', 'fallback'),
-                 call.initramfs.build_initramfs_with_microcode(
-                     '5.19', 'fallback'),
-                 call.initramfs.list_kernel_presets('5.14'),
                  call.initramfs.file_name('5.14', 'default'),
                  call.distri.vmlinuz('5.14'),
                  call.initramfs.file_name('5.14', 'default'),
-                 call.initramfs.display_name('5.14', 'default'),
-                 call.initramfs.build_initramfs_with_microcode(
-                     '5.14', 'default')])
+                 call.initramfs.display_name('5.14', 'default')])
 
-    def test__backup_and_sign_efi(self):
+    def test__create_image_and_sign_kernel__jobs(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {
+            "DEFAULT": {
+                "ROOT_MOUNT": "/opt/mnt/root",
+                "EFI_PARTITION": "/boot/efi",
+                "IGNORE_KERNEL_EFIS": "",
+                "INCREMENTAL_BUILD": "false",
+                "DELTA_BUILD": "false",
+                "INITRAMFS_CACHE": "false",
+                "STAGE_IMAGE_ON_ROOT_MOUNT": "false",
+            }
+        }
+        started = threading.Barrier(3, timeout=5)
+
+        def build_efis(config, job, initramfs_path, use_slot, root_hash,
+                       ignore_efis, extra_cmdline):
+            # all jobs need to run at the same time to pass the barrier
+            started.wait()
+            return [(Path("/tmp/{}.efi".format(job[3])), job[3])]
+
+        with (mock.patch("{}.read_text_from".format(base),
+                         new=all_mocks.read_text_from),
+              mock.patch("{}.create_directory".format(base),
+                         new=all_mocks.create_directory),
+              mock.patch("{}.create_squashfs_return_verity_hash".format(base),
+                         new=all_mocks.create_squashfs_return_verity_hash),
+              mock.patch("{}.build_kernel_efis".format(base),
+                         new=all_mocks.build_kernel_efis),
+              mock.patch("{}.move_kernel".format(base),
+                         new=all_mocks.move_kernel),
+              mock.patch("{}.shutil".format(base),
+                         new=all_mocks.shutil),
+              mock.patch("{}.move_file".format(base),
+                         new=all_mocks.move_file),
+              mock.patch("{}.manifest_path".format(base),
+                         new=all_mocks.manifest_path),
+              mock.patch("{}.base_reference_path".format(base),
+                         new=all_mocks.base_reference_path),
+              mock.patch("{}.remove_unused_bases".format(base),
+                         new=all_mocks.remove_unused_bases)):
+            distri_mock = distribution_mock()
+            initramfs_mock = create_initramfs_mock(distribution_mock())
+            all_mocks.build_kernel_efis.side_effect = build_efis
+            all_mocks.read_text_from.return_value = ""
+            build_image_and_sign_kernel(config, distri_mock, initramfs_mock,
+                                        3)
+            efi_path = Path('/boot/efi/EFI/verity_squash_root/ArchEfi')
+            # moves are in order, independent of finished jobs
+            self.assertEqual(
+                all_mocks.move_kernel.mock_calls,
+                [call(Path("/tmp/{}.efi".format(name)), "a", name, efi_path,
+                      [""])
+                 for name in ["linux_default", "linux_fallback",
+                              "linux-lts_default"]])
+
+    def test__create_image_and_sign_kernel__overlap(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {
+            "DEFAULT": {
+                "ROOT_MOUNT": "/opt/mnt/root",
+                "EFI_PARTITION": "/boot/efi",
+                "IGNORE_KERNEL_EFIS": "",
+                "INCREMENTAL_BUILD": "false",
+                "DELTA_BUILD": "false",
+                "INITRAMFS_CACHE": "true",
+                "STAGE_IMAGE_ON_ROOT_MOUNT": "false",
+            }
+        }
+        overlap = threading.Barrier(2, timeout=5)
+
+        def build_initramfs_images(initramfs, kernel_jobs, jobs, cache_dir):
+            self.assertEqual(cache_dir,
+                             Path("/opt/mnt/root/initramfs_cache"))
+            self.assertEqual(jobs, 2)
+            # only passes, if the squashfs is created at the same time
+            overlap.wait()
+            return [[Path("/tmp/{}.img".format(job[3]))]
+                    for job in kernel_jobs]
+
+        def create_squashfs(config, image):
+            overlap.wait()
+            return "hash"
+
+        with (mock.patch("{}.read_text_from".format(base),
+                         new=all_mocks.read_text_from),
+              mock.patch("{}.create_directory".format(base),
+                         new=all_mocks.create_directory),
+              mock.patch("{}.create_squashfs_return_verity_hash".format(base),
+                         new=all_mocks.create_squashfs_return_verity_hash),
+              mock.patch("{}.build_initramfs_images".format(base),
+                         new=all_mocks.build_initramfs_images),
+              mock.patch("{}.build_kernel_efis".format(base),
+                         new=all_mocks.build_kernel_efis),
+              mock.patch("{}.move_kernel".format(base),
+                         new=all_mocks.move_kernel),
+              mock.patch("{}.shutil".format(base),
+                         new=all_mocks.shutil),
+              mock.patch("{}.move_file".format(base),
+                         new=all_mocks.move_file),
+              mock.patch("{}.manifest_path".format(base),
+                         new=all_mocks.manifest_path),
+              mock.patch("{}.base_reference_path".format(base),
+                         new=all_mocks.base_reference_path),
+              mock.patch("{}.remove_unused_bases".format(base),
+                         new=all_mocks.remove_unused_bases),
+              mock.patch("{}.remove_unused_initramfs".format(base),
+                         new=all_mocks.remove_unused_initramfs)):
+            distri_mock = distribution_mock()
+            initramfs_mock = create_initramfs_mock(distribution_mock())
+            all_mocks.build_initramfs_images.side_effect = \
+                build_initramfs_images
+            all_mocks.create_squashfs_return_verity_hash.side_effect = \
+                create_squashfs
+            all_mocks.build_kernel_efis.return_value = []
+            all_mocks.read_text_from.return_value = ""
+            build_image_and_sign_kernel(config, distri_mock, initramfs_mock,
+                                        2)
+            jobs = [c.args[1] for c in all_mocks.build_kernel_efis.mock_calls]
+            self.assertEqual(
+                [c.args[2] for c in all_mocks.build_kernel_efis.mock_calls],
+                [[Path("/tmp/{}.img".format(j[3]))] for j in jobs])
+            self.assertEqual(
+                [c.args[4] for c in all_mocks.build_kernel_efis.mock_calls],
+                ["hash"] * 3)
+            all_mocks.remove_unused_initramfs.assert_called_once_with(
+                Path("/opt/mnt/root/initramfs_cache"),
+                ["linux_default", "linux_fallback", "linux-lts_default"])
+
+    def test__create_image_and_sign_kernel__report(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.MagicMock()
+        with (mock.patch("{}.build_report".format(base),
+                         new=all_mocks.build_report),
+              mock.patch("{}.build_image_and_sign_kernel".format(base),
+                         new=all_mocks.build_image_and_sign_kernel)):
+            create_image_and_sign_kernel(all_mocks.config,
+                                         all_mocks.distribution,
+                                         all_mocks.initramfs, 3)
+        self.assertEqual(
+            all_mocks.mock_calls,
+            [call.build_report(REPORT_FILE),
+             call.build_report().__enter__(),
+             call.build_image_and_sign_kernel(all_mocks.config,
+                                              all_mocks.distribution,
+                                              all_mocks.initramfs, 3),
+             call.build_report().__exit__(None, None, None)])
+
+    def test__create_image_and_sign_kernel__incremental(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {
+            "DEFAULT": {
+                "ROOT_MOUNT": "/opt/mnt/root",
+                "EFI_PARTITION": "/boot/efi",
+                "IGNORE_KERNEL_EFIS": "",
+                "INCREMENTAL_BUILD": "true",
+                "DELTA_BUILD": "false",
+                "INITRAMFS_CACHE": "false",
+                "STAGE_IMAGE_ON_ROOT_MOUNT": "false",
+            }
+        }
+        image = Path("/opt/mnt/root/image_b.squashfs")
+        tmp_image = Path("/tmp/verity_squash_root/tmp.squashfs")
+        tmp_scan = Path("/tmp/verity_squash_root/tmp.manifest")
+        with (mock.patch("{}.read_text_from".format(base),
+                         new=all_mocks.read_text_from),
+              mock.patch("{}.create_directory".format(base),
+                         new=all_mocks.create_directory),
+              mock.patch("{}.scan_root_return_digest".format(base),
+                         new=all_mocks.scan_root_return_digest),
+              mock.patch("{}.unchanged_image_root_hash".format(base),
+                         new=all_mocks.unchanged_image_root_hash),
+              mock.patch("{}.create_squashfs_return_verity_hash".format(base),
+                         new=all_mocks.create_squashfs_return_verity_hash),
+              mock.patch("{}.shutil".format(base),
+                         new=all_mocks.shutil),
+              mock.patch("{}.move_file".format(base),
+                         new=all_mocks.move_file),
+              mock.patch("{}.manifest_path".format(base),
+                         new=all_mocks.manifest_path),
+              mock.patch("{}.base_reference_path".format(base),
+                         new=all_mocks.base_reference_path),
+              mock.patch("{}.remove_unused_bases".format(base),
+                         new=all_mocks.remove_unused_bases),
+              mock.patch("{}.store_manifest".format(base),
+                         new=all_mocks.store_manifest)):
+            distri_mock = distribution_mock()
+            distri_mock.list_kernels.return_value = []
+            all_mocks.read_text_from.return_value = \
+                "verity_squash_root_slot=a"
+            all_mocks.scan_root_return_digest.return_value = "digest"
+            all_mocks.unchanged_image_root_hash.return_value = "old_hash"
+            build_image_and_sign_kernel(config, distri_mock, mock.Mock())
+            start = [
+                call.read_text_from(Path('/proc/cmdline')),
+                call.create_directory(Path(
+                    "/boot/efi/EFI/verity_squash_root/ArchEfi")),
+                call.scan_root_return_digest(config, tmp_scan),
+                call.unchanged_image_root_hash(KEY_DIR, image, "digest")]
+            self.assertEqual(all_mocks.mock_calls, start)
+
+            all_mocks.reset_mock()
+            all_mocks.unchanged_image_root_hash.return_value = None
+            all_mocks.create_squashfs_return_verity_hash.return_value = \
+                "new_hash"
+            build_image_and_sign_kernel(config, distri_mock, mock.Mock())
+            manifest = all_mocks.manifest_path.return_value
+            self.assertEqual(
+                all_mocks.mock_calls,
+                start + [
+                    call.create_squashfs_return_verity_hash(config,
+                                                            tmp_image),
+                    call.manifest_path(image),
+                    call.manifest_path().unlink(missing_ok=True),
+                    call.move_file(tmp_image, image),
+                    call.move_file(
+                        Path("/tmp/verity_squash_root/tmp.squashfs.verity"),
+                        Path("/opt/mnt/root/image_b.squashfs.verity")),
+                    call.base_reference_path(image),
+                    call.base_reference_path().unlink(missing_ok=True),
+                    call.store_manifest(KEY_DIR, tmp_scan, "digest",
+                                        "new_hash", manifest),
+                    call.remove_unused_bases(Path("/opt/mnt/root"))])
+
+    def test__create_image_and_sign_kernel__delta(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {
+            "DEFAULT": {
+                "ROOT_MOUNT": "/opt/mnt/root",
+                "EFI_PARTITION": "/boot/efi",
+                "IGNORE_KERNEL_EFIS": "",
+                "INCREMENTAL_BUILD": "false",
+                "DELTA_BUILD": "true",
+                "INITRAMFS_CACHE": "false",
+                "STAGE_IMAGE_ON_ROOT_MOUNT": "false",
+            }
+        }
+        root_mount = Path("/opt/mnt/root")
+        image = root_mount / "image_b.squashfs"
+        tmp_image = Path("/tmp/verity_squash_root/tmp.squashfs")
+        tmp_scan = Path("/tmp/verity_squash_root/tmp.manifest")
+        delta_base = mock.Mock()
+        delta_base.name = "base_1"
+        delta_base.cmdline.return_value = "verity_squash_root_base=base_1"
+        with (mock.patch("{}.read_text_from".format(base),
+                         new=all_mocks.read_text_from),
+              mock.patch("{}.write_str_to".format(base),
+                         new=all_mocks.write_str_to),
+              mock.patch("{}.create_directory".format(base),
+                         new=all_mocks.create_directory),
+              mock.patch("{}.scan_root_return_digest".format(base),
+                         new=all_mocks.scan_root_return_digest),
+              mock.patch("{}.find_delta_base".format(base),
+                         new=all_mocks.find_delta_base),
+              mock.patch("{}.create_delta_squashfs_return_verity_hash".format(
+                  base),
+                         new=all_mocks.create_delta),
+              mock.patch("{}.create_squashfs_return_verity_hash".format(base),
+                         new=all_mocks.create_squashfs_return_verity_hash),
+              mock.patch("{}.link_base".format(base),
+                         new=all_mocks.link_base),
+              mock.patch("{}.build_kernel_efis".format(base),
+                         new=all_mocks.build_kernel_efis),
+              mock.patch("{}.move_kernel".format(base),
+                         new=all_mocks.move_kernel),
+              mock.patch("{}.shutil".format(base),
+                         new=all_mocks.shutil),
+              mock.patch("{}.move_file".format(base),
+                         new=all_mocks.move_file),
+              mock.patch("{}.manifest_path".format(base),
+                         new=all_mocks.manifest_path),
+              mock.patch("{}.base_reference_path".format(base),
+                         new=all_mocks.base_reference_path),
+              mock.patch("{}.store_manifest".format(base),
+                         new=all_mocks.store_manifest),
+              mock.patch("{}.remove_unused_bases".format(base),
+                         new=all_mocks.remove_unused_bases)):
+            distri_mock = distribution_mock()
+            initramfs_mock = create_initramfs_mock(distribution_mock())
+            kernel_cmdline = "verity_squash_root_slot=a"
+            all_mocks.read_text_from.return_value = kernel_cmdline
+            all_mocks.scan_root_return_digest.return_value = "digest"
+            all_mocks.find_delta_base.return_value = delta_base
+            all_mocks.create_delta.return_value = "delta_hash"
+            all_mocks.build_kernel_efis.return_value = []
+            build_image_and_sign_kernel(config, distri_mock, initramfs_mock)
+            start = [
+                call.read_text_from(Path('/proc/cmdline')),
+                call.create_directory(Path(
+                    "/boot/efi/EFI/verity_squash_root/ArchEfi")),
+                call.scan_root_return_digest(config, tmp_scan),
+                call.find_delta_base(KEY_DIR, root_mount, kernel_cmdline)]
+            move = [
+                call.manifest_path(image),
+                call.manifest_path().unlink(missing_ok=True),
+                call.move_file(tmp_image, image),
+                call.move_file(
+                    Path("/tmp/verity_squash_root/tmp.squashfs.verity"),
+                    Path("/opt/mnt/root/image_b.squashfs.verity"))]
+            efis = [c for c in all_mocks.mock_calls
+                    if c[0] == "build_kernel_efis"]
+            self.assertEqual(len(efis), 3)
+            for c in efis:
+                self.assertEqual(
+                    c.args[4:],
+                    ("delta_hash", [""], "verity_squash_root_base=base_1"))
+            # The delta image gets no manifest, so it is never a base
+            self.assertEqual(
+                [c for c in all_mocks.mock_calls
+                 if c[0] != "build_kernel_efis"],
+                start + [
+                    call.create_delta(config, tmp_image, tmp_scan,
+                                      delta_base),
+                    call.link_base(delta_base, root_mount),
+                    call.base_reference_path(image),
+                    call.write_str_to(all_mocks.base_reference_path(),
+                                      "base_1"),
+                    call.find_delta_base().cmdline()] + move + [
+                    call.remove_unused_bases(root_mount)])
+
+            # Without a base, a full image with manifest is built
+            all_mocks.reset_mock()
+            all_mocks.find_delta_base.return_value = None
+            all_mocks.create_squashfs_return_verity_hash.return_value = \
+                "full_hash"
+            build_image_and_sign_kernel(config, distri_mock, initramfs_mock)
+            self.assertEqual(
+                [c for c in all_mocks.mock_calls
+                 if c[0] != "build_kernel_efis"],
+                start + [
+                    call.create_squashfs_return_verity_hash(config,
+                                                            tmp_image)] +
+                move + [
+                    call.base_reference_path(image),
+                    call.base_reference_path().unlink(missing_ok=True),
+                    call.store_manifest(KEY_DIR, tmp_scan, "digest",
+                                        "full_hash",
+                                        all_mocks.manifest_path()),
+                    call.remove_unused_bases(root_mount)])
+
+    def test__create_image_and_sign_kernel__stage_on_root(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {
+            "DEFAULT": {
+                "ROOT_MOUNT": "/opt/mnt/root",
+                "EFI_PARTITION": "/boot/efi",
+                "IGNORE_KERNEL_EFIS": "",
+                "INCREMENTAL_BUILD": "false",
+                "DELTA_BUILD": "false",
+                "INITRAMFS_CACHE": "false",
+                "STAGE_IMAGE_ON_ROOT_MOUNT": "true",
+            }
+        }
+        image = Path("/opt/mnt/root/image_b.squashfs")
+        tmp_image = Path("/opt/mnt/root/tmp.squashfs")
+        with (mock.patch("{}.read_text_from".format(base),
+                         new=all_mocks.read_text_from),
+              mock.patch("{}.create_directory".format(base),
+                         new=all_mocks.create_directory),
+              mock.patch("{}.create_squashfs_return_verity_hash".format(base),
+                         new=all_mocks.create_squashfs_return_verity_hash),
+              mock.patch("{}.remove_image".format(base),
+                         new=all_mocks.remove_image),
+              mock.patch("{}.shutil".format(base),
+                         new=all_mocks.shutil),
+              mock.patch("{}.move_file".format(base),
+                         new=all_mocks.move_file),
+              mock.patch("{}.manifest_path".format(base),
+                         new=all_mocks.manifest_path),
+              mock.patch("{}.base_reference_path".format(base),
+                         new=all_mocks.base_reference_path),
+              mock.patch("{}.remove_unused_bases".format(base),
+                         new=all_mocks.remove_unused_bases)):
+            distri_mock = distribution_mock()
+            distri_mock.list_kernels.return_value = []
+            all_mocks.read_text_from.return_value = \
+                "verity_squash_root_slot=a"
+            all_mocks.create_squashfs_return_verity_hash.return_value = \
+                "new_hash"
+            build_image_and_sign_kernel(config, distri_mock, mock.Mock())
+            start = [
+                call.read_text_from(Path('/proc/cmdline')),
+                call.create_directory(Path(
+                    "/boot/efi/EFI/verity_squash_root/ArchEfi")),
+                call.create_squashfs_return_verity_hash(config, tmp_image)]
+            self.assertEqual(
+                all_mocks.mock_calls,
+                start + [
+                    call.manifest_path(image),
+                    call.manifest_path().unlink(missing_ok=True),
+                    call.move_file(tmp_image, image),
+                    call.move_file(
+                        Path("/opt/mnt/root/tmp.squashfs.verity"),
+                        Path("/opt/mnt/root/image_b.squashfs.verity")),
+                    call.base_reference_path(image),
+                    call.base_reference_path().unlink(missing_ok=True),
+                    call.remove_unused_bases(Path("/opt/mnt/root"))])
+
+            # A failed build does not leave the image on the disk
+            all_mocks.reset_mock()
+            all_mocks.create_squashfs_return_verity_hash.side_effect = \
+                OSError("No space left on device")
+            with self.assertRaises(OSError):
+                build_image_and_sign_kernel(config, distri_mock, mock.Mock())
+            self.assertEqual(all_mocks.mock_calls,
+                             start + [call.remove_image(tmp_image)])
+
+    def test__stage_image_on_root(self):
+        base = "verity_squash_root.main"
+        all_mocks = mock.Mock()
+        config = {"DEFAULT": {"STAGE_IMAGE_ON_ROOT_MOUNT": "true"}}
+        with (mock.patch("{}.prescan_root".format(base),
+                         new=all_mocks.prescan_root),
+              mock.patch("{}.shutil".format(base),
+                         new=all_mocks.shutil)):
+            self.assertTrue(stage_image_on_root(config))
+            config["DEFAULT"]["STAGE_IMAGE_ON_ROOT_MOUNT"] = "false"
+            self.assertFalse(stage_image_on_root(config))
+            self.assertEqual(all_mocks.mock_calls, [])
+
+            config["DEFAULT"]["STAGE_IMAGE_ON_ROOT_MOUNT"] = " Auto"
+            content = all_mocks.prescan_root.return_value.total.return_value
+            content.bytes = 3 * 1024 ** 3
+            content.inodes = 1000
+            all_mocks.shutil.disk_usage.return_value.free = 2 * 1024 ** 3
+            with self.assertLogs() as logs:
+                self.assertTrue(stage_image_on_root(config))
+            self.assertEqual(
+                logs.output,
+                ["INFO:root:Image content: 3072.0 MiB, 1000 inodes, "
+                 "2048.0 MiB free in /tmp/verity_squash_root"])
+            all_mocks.shutil.disk_usage.return_value.free = 4 * 1024 ** 3
+            with self.assertLogs():
+                self.assertFalse(stage_image_on_root(config))
+            self.assertEqual(
+                all_mocks.mock_calls,
+                [call.prescan_root(config),
+                 call.prescan_root().total(),
+                 call.shutil.disk_usage(Path("/tmp/verity_squash_root"))] * 2)
+
+    @wrap_tempdir
+    def test__remove_image(self, tempdir):
+        image = tempdir / "tmp.squashfs"
+        image.write_text("image")
+        (tempdir / "tmp.squashfs.verity").write_text("verity")
+        remove_image(image)
+        self.assertEqual(list(tempdir.iterdir()), [])
+        remove_image(image)
+
+    def test__backup_and_sign_efis(self):
         base = "verity_squash_root.main"
         all_mocks = mock.Mock()
         with mock.patch("{}.efi".format(base),
                         new=all_mocks.efi):
             dest = all_mocks.dest
             dest.exists.return_value = False
-            backup_and_sign_efi(all_mocks.source, dest)
+            backup_and_sign_efis([(all_mocks.source, dest)])
             self.assertEqual(
                 all_mocks.mock_calls,
                 [call.dest.exists(),
                  call.efi.sign(KEY_DIR, all_mocks.source, dest)])
 
-    def test__backup_and_sign_efi__backup(self):
+    def test__backup_and_sign_efis__backup(self):
         base = "verity_squash_root.main"
         all_mocks = mock.Mock()
         with mock.patch("{}.efi".format(base),
@@ -330,12 +997,24 @@ class MainTest(unittest.TestCase):
             dest.stem = "myfile"
             dest.suffix = ".efi"
             replace = Path("/parent/dir/myfile_backup.efi")
-            backup_and_sign_efi(all_mocks.source, dest)
-            self.assertEqual(
-                all_mocks.mock_calls,
-                [call.dest.exists(),
-                 call.dest.replace(replace),
-                 call.efi.sign(KEY_DIR, all_mocks.source, dest)])
+            dest2 = all_mocks.dest2
+            dest2.exists.return_value = False
+            files = [(all_mocks.source, dest), (all_mocks.source2, dest2)]
+            backup_and_sign_efis(files)
+            calls = [call.dest.exists(),
+                     call.dest.replace(replace),
+                     call.efi.sign(KEY_DIR, all_mocks.source, dest),
+                     call.dest2.exists(),
+                     call.efi.sign(KEY_DIR, all_mocks.source2, dest2)]
+            self.assertEqual(all_mocks.mock_calls, calls)
+
+            # A failed signature does not move the following files away
+            all_mocks.reset_mock()
+            all_mocks.efi.sign.side_effect = FileNotFoundError("source")
+            dest2.exists.return_value = True
+            with self.assertRaises(FileNotFoundError):
+                backup_and_sign_efis(files)
+            self.assertEqual(all_mocks.mock_calls, calls[:3])
 
     @wrap_tempdir
     def test__backup_and_sign_extra_files(self, tempdir):
@@ -352,19 +1031,17 @@ class MainTest(unittest.TestCase):
                 "fwupd": "/usr/lib/fwupd/fwupd.efi => {}".format(fwupd_out),
             }
         }
-        with mock.patch("{}.backup_and_sign_efi".format(base),
-                        new=all_mocks.backup_and_sign_efi):
+        with mock.patch("{}.backup_and_sign_efis".format(base),
+                        new=all_mocks.backup_and_sign_efis):
             backup_and_sign_extra_files(config)
             self.assertTrue(systemd_out.resolve().parent.is_dir())
             self.assertTrue(fwupd_out.resolve().parent.is_dir())
             self.assertEqual(
                 all_mocks.mock_calls,
-                [call.backup_and_sign_efi(
-                     Path("/usr/lib/systemd/boot/efi/systemd-bootx64.efi"),
+                [call.backup_and_sign_efis([
+                    (Path("/usr/lib/systemd/boot/efi/systemd-bootx64.efi"),
                      systemd_out),
-                 call.backup_and_sign_efi(
-                     Path("/usr/lib/fwupd/fwupd.efi"),
-                     fwupd_out)])
+                    (Path("/usr/lib/fwupd/fwupd.efi"), fwupd_out)])])
 
     def test__backup_and_sign_extra_files__exception(self):
         base = "verity_squash_root.main"
@@ -377,16 +1054,13 @@ class MainTest(unittest.TestCase):
                 "test": "/x.efi => /y.efi",
             }
         }
-        with mock.patch("{}.backup_and_sign_efi".format(base),
-                        new=all_mocks.backup_and_sign_efi):
+        with mock.patch("{}.backup_and_sign_efis".format(base),
+                        new=all_mocks.backup_and_sign_efis):
             with self.assertRaises(ValueError) as e:
                 backup_and_sign_extra_files(config)
             self.assertEqual(
                 str(e.exception),
                 "extra signing files need to be specified as\n"
                 "name = SOURCE => DEST")
-            self.assertEqual(
-                all_mocks.mock_calls,
-                [call.backup_and_sign_efi(
-                     Path("/usr/lib/systemd/boot/efi/systemd-bootx64.efi"),
-                     Path("/systemd-bootx64.efi"))])
+            # Nothing is signed, if the config is invalid
+            self.assertEqual(all_mocks.mock_calls, [])
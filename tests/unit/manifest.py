@@ -0,0 +1,180 @@
+import os
+import shutil
+import unittest
+from pathlib import Path
+from unittest import mock
+from verity_squash_root.file_op import write_str_to, read_text_from
+from verity_squash_root.manifest import manifest_path, scan_entries, \
+    write_scan, store_manifest, read_manifest_header, \
+    read_manifest_records, read_scan_records, unchanged_image_root_hash
+from verity_squash_root.verity import VerityFormatError
+from .test_helper import wrap_tempdir
+
+
+def create_tree(tempdir: Path) -> Path:
+    root = tempdir / "root"
+    for d in ["etc", "tmp", "var/lib", "var/cache"]:
+        (root / d).mkdir(parents=True)
+    write_str_to(root / "etc/config", "config")
+    write_str_to(root / "tmp/file", "tmp")
+    write_str_to(root / "tmp/.hidden", "hidden")
+    write_str_to(root / "var/lib/db", "db")
+    write_str_to(root / "var/cache/file", "cache")
+    return root
+
+
+def create_key_dir(tempdir: Path) -> Path:
+    key_dir = tempdir / "keys"
+    key_dir.mkdir()
+    write_str_to(key_dir / "db.key", "secret key")
+    return key_dir
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test__manifest_path(self):
+        self.assertEqual(manifest_path(Path("/mnt/root/image_a.squashfs")),
+                         Path("/mnt/root/image_a.squashfs.manifest"))
+
+    @wrap_tempdir
+    def test__scan_entries(self, tempdir):
+        root = create_tree(tempdir)
+        result = [e[0] for e in scan_entries(
+            root, ["tmp/*", "tmp/.*", "var/!(lib)/*", "var/!(lib)/.*"])]
+        self.assertEqual(result,
+                         ["", "etc", "tmp", "var", "etc/config",
+                          "var/cache", "var/lib", "var/lib/db"])
+
+        entries = {e[0]: e for e in scan_entries(root, [])}
+        st = os.lstat(root / "etc/config")
+        self.assertEqual(entries["etc/config"],
+                         ["etc/config", 1, 6, st.st_mtime_ns // 10**9,
+                          st.st_mode, st.st_uid, st.st_gid, ""])
+        # directory size, mtime and link count are ignored
+        self.assertEqual(entries["etc"][1:4], [0, 0, 0])
+
+        # Another image of the same files has other inode numbers
+        copy = tempdir / "copy"
+        shutil.copytree(root, copy)
+        self.assertEqual(list(scan_entries(copy, [])),
+                         list(scan_entries(root, [])))
+        os.link(copy / "etc/config", copy / "etc/link")
+        self.assertEqual(
+            [e for e in scan_entries(copy, []) if e[0] == "etc/config"],
+            [["etc/config", 2, 6, st.st_mtime_ns // 10**9, st.st_mode,
+              st.st_uid, st.st_gid, ""]])
+
+    @wrap_tempdir
+    def test__write_scan(self, tempdir):
+        root = create_tree(tempdir)
+        out = tempdir / "scan"
+        patterns = ["tmp/*", "tmp/.*"]
+        digest = write_scan(root, patterns, ["mksquashfs", "-a"], out)
+        self.assertEqual(read_text_from(out).split("\n")[0],
+                         '["mksquashfs", "-a"]')
+        self.assertEqual(digest, write_scan(root, patterns,
+                                            ["mksquashfs", "-a"], out))
+        self.assertNotEqual(digest, write_scan(root, patterns,
+                                               ["mksquashfs", "-b"], out))
+        # changes in excluded directories are ignored
+        write_str_to(root / "tmp/new", "new")
+        self.assertEqual(digest, write_scan(root, patterns,
+                                            ["mksquashfs", "-a"], out))
+        os.utime(root / "etc/config", ns=(0, 0))
+        self.assertNotEqual(digest, write_scan(root, patterns,
+                                               ["mksquashfs", "-a"], out))
+
+    @wrap_tempdir
+    def test__store_and_read_manifest(self, tempdir):
+        key_dir = create_key_dir(tempdir)
+        scan = tempdir / "scan"
+        write_str_to(scan, '["settings"]\n["", 1]\n')
+        dest = tempdir / "image.manifest"
+        store_manifest(key_dir, scan, "digest1", "hash1", dest)
+        header = read_manifest_header(key_dir, dest)
+        self.assertEqual(header["digest"], "digest1")
+        self.assertEqual(header["root_hash"], "hash1")
+        self.assertEqual(read_text_from(dest).split("\n", 1)[1],
+                         '["settings"]\n["", 1]\n')
+
+        self.assertIsNone(read_manifest_header(key_dir, tempdir / "none"))
+
+        # modified root hash
+        write_str_to(dest, read_text_from(dest).replace("hash1", "hash2"))
+        with self.assertLogs() as logs:
+            self.assertIsNone(read_manifest_header(key_dir, dest))
+        self.assertEqual(
+            logs.output,
+            ["WARNING:root:Ignoring invalid manifest {}".format(dest)])
+
+        write_str_to(dest, "no json")
+        with self.assertLogs():
+            self.assertIsNone(read_manifest_header(key_dir, dest))
+
+    @wrap_tempdir
+    def test__read_manifest_records(self, tempdir):
+        key_dir = create_key_dir(tempdir)
+        root = create_tree(tempdir)
+        scan = tempdir / "scan"
+        digest = write_scan(root, ["tmp/*", "tmp/.*"], ["mksquashfs"], scan)
+        records = read_scan_records(scan)
+        self.assertEqual(sorted(records),
+                         ["", "etc", "etc/config", "tmp", "var", "var/cache",
+                          "var/cache/file", "var/lib", "var/lib/db"])
+        st = os.lstat(root / "etc/config")
+        self.assertEqual(records["etc/config"],
+                         [1, 6, st.st_mtime_ns // 10**9, st.st_mode,
+                          st.st_uid, st.st_gid, ""])
+
+        dest = tempdir / "image.manifest"
+        store_manifest(key_dir, scan, digest, "hash1", dest)
+        self.assertEqual(read_manifest_records(key_dir, dest, "hash1"),
+                         records)
+        self.assertIsNone(read_manifest_records(key_dir, dest, "hash2"))
+
+        # The records are authenticated by the digest in the header
+        write_str_to(dest, read_text_from(dest).replace('"etc/config"',
+                                                        '"etc/other"'))
+        with self.assertLogs() as logs:
+            self.assertIsNone(read_manifest_records(key_dir, dest, "hash1"))
+        self.assertEqual(
+            logs.output,
+            ["WARNING:root:Ignoring invalid manifest {}".format(dest)])
+
+    @wrap_tempdir
+    def test__unchanged_image_root_hash(self, tempdir):
+        key_dir = create_key_dir(tempdir)
+        image = tempdir / "image_a.squashfs"
+        verity_file = tempdir / "image_a.squashfs.verity"
+        header = {"digest": "d1", "root_hash": "h1"}
+        base = "verity_squash_root.manifest"
+        with (mock.patch("{}.read_manifest_header".format(base)) as read_mock,
+              mock.patch("{}.verity_root_hash".format(base)) as hash_mock):
+            read_mock.return_value = header
+            hash_mock.return_value = "h1"
+            self.assertIsNone(unchanged_image_root_hash(key_dir, image, "d1"))
+            write_str_to(image, "image")
+            self.assertIsNone(unchanged_image_root_hash(key_dir, image, "d1"))
+            write_str_to(verity_file, "verity")
+            self.assertEqual(
+                unchanged_image_root_hash(key_dir, image, "d1"), "h1")
+            hash_mock.assert_called_with(verity_file)
+            self.assertIsNone(unchanged_image_root_hash(key_dir, image, "d2"))
+            read_mock.return_value = None
+            self.assertIsNone(unchanged_image_root_hash(key_dir, image, "d1"))
+            read_mock.assert_called_with(key_dir, manifest_path(image))
+
+            # A replaced or corrupted hash tree is not reused
+            read_mock.return_value = header
+            hash_mock.return_value = "h2"
+            with self.assertLogs() as logs:
+                self.assertIsNone(
+                    unchanged_image_root_hash(key_dir, image, "d1"))
+            self.assertEqual(
+                logs.output,
+                ["WARNING:root:Root hash of {} does not match its "
+                 "manifest".format(verity_file)])
+            hash_mock.side_effect = VerityFormatError("truncated")
+            with self.assertLogs():
+                self.assertIsNone(
+                    unchanged_image_root_hash(key_dir, image, "d1"))
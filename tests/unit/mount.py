@@ -1,6 +1,7 @@
 import unittest
+from pathlib import Path
 from unittest import mock
-from verity_squash_root.mount import TmpfsMount
+from verity_squash_root.mount import TmpfsMount, VerityMount
 
 
 class MountTest(unittest.TestCase):
@@ -28,3 +29,42 @@ class MountTest(unittest.TestCase):
                 [call.exec_binary(['umount', '-f', '-R', '/my_directory']),
                  call.shutil.rmtree(all_mocks.path)])
             all_mocks.path.__str__.assert_called_once_with()
+
+    def test__verity_mount(self):
+        base = "verity_squash_root.mount"
+        all_mocks = mock.Mock()
+        call = mock.call
+        open_cmd = call.exec_binary(["veritysetup", "open", "/img", "dev",
+                                     "/img.verity", "hash"])
+        close_cmd = call.exec_binary(["veritysetup", "close", "dev"])
+        all_mocks.path.__str__ = mock.Mock(return_value="/mnt")
+
+        def calls():
+            return [c for c in all_mocks.mock_calls
+                    if c[0] != "path.__str__"]
+
+        with mock.patch("{}.exec_binary".format(base),
+                        new=all_mocks.exec_binary):
+            with VerityMount(Path("/img"), Path("/img.verity"), "hash",
+                             "dev", all_mocks.path):
+                self.assertEqual(
+                    calls(),
+                    [open_cmd,
+                     call.path.mkdir(),
+                     call.exec_binary(["mount", "-t", "squashfs", "-o", "ro",
+                                       "/dev/mapper/dev", "/mnt"])])
+                all_mocks.reset_mock()
+            self.assertEqual(
+                calls(),
+                [call.exec_binary(["umount", "/mnt"]),
+                 close_cmd,
+                 call.path.rmdir()])
+
+            all_mocks.reset_mock()
+            all_mocks.exec_binary.side_effect = [None, OSError("failed"),
+                                                 None]
+            with self.assertRaises(OSError):
+                with VerityMount(Path("/img"), Path("/img.verity"), "hash",
+                                 "dev", all_mocks.path):
+                    pass
+            self.assertEqual(all_mocks.exec_binary.mock_calls[-1], close_cmd)
@@ -0,0 +1,204 @@
+import os
+import shutil
+import unittest
+from unittest import mock
+from .test_helper import get_test_files_path, wrap_tempdir
+from verity_squash_root.file_op import read_from, write_str_to
+from verity_squash_root.pe import PEEmptyError, PEFormatError, PEImage, \
+    PETruncatedError, align, append_sections, read_pe_image, \
+    read_section, read_stub_image
+
+TEST_FILES_DIR = get_test_files_path("efi")
+STUB = TEST_FILES_DIR / "stub_slot_a.efi"
+
+
+def read_image(path) -> PEImage:
+    with open(path, "rb") as f:
+        return read_pe_image(f)
+
+
+class PETest(unittest.TestCase):
+
+    def test__align(self):
+        self.assertEqual(align(0, 512), 0)
+        self.assertEqual(align(1, 512), 512)
+        self.assertEqual(align(512, 512), 512)
+        self.assertEqual(align(74064, 512), 74240)
+
+    def test__read_pe_image(self):
+        image = read_image(STUB)
+        self.assertEqual(image.image_base, 0)
+        self.assertEqual(image.section_alignment, 512)
+        self.assertEqual(image.file_alignment, 512)
+        self.assertEqual(image.size_of_headers, 0x2f0)
+        self.assertEqual(image.end(), 74064)
+        self.assertEqual(image.data_end(), 0xb6f0)
+        self.assertEqual(image.data_directory(4), (0xcf50, 0x938))
+        self.assertEqual(image.data_directory(16), (0, 0))
+        self.assertEqual(
+            [s[0] for s in image.sections],
+            [b".cmdline", b".text\0\0\0", b".reloc\0\0", b".data\0\0\0",
+             b".dynamic", b".rela\0\0\0", b".dynsym\0", b".sbat\0\0\0",
+             b".sdmagic"])
+
+    def test__read_pe_image__invalid(self):
+        for path, msg in [(TEST_FILES_DIR / "no_sections_or_info",
+                           "No DOS header found"),
+                          (TEST_FILES_DIR / "stub_empty.efi",
+                           "No DOS header found")]:
+            with self.assertRaises(PEFormatError) as e_ctx:
+                read_image(path)
+            self.assertEqual(str(e_ctx.exception), msg)
+        headers = bytearray(read_from(STUB)[:0x2f0])
+        headers[0x80] = 0
+        with self.assertRaises(PEFormatError) as e_ctx:
+            PEImage(bytes(headers))
+        self.assertEqual(str(e_ctx.exception), "No PE signature found")
+        with self.assertRaises(PEFormatError) as e_ctx:
+            PEImage(read_from(STUB)[:0x200])
+        self.assertEqual(str(e_ctx.exception), "Section table is truncated")
+        with self.assertRaises(PETruncatedError) as e_ctx:
+            PEImage(read_from(STUB)[:0x90])
+        self.assertEqual(str(e_ctx.exception), "Headers are truncated")
+
+    def test__read_section(self):
+        cmdline = read_section(STUB, ".cmdline")
+        self.assertEqual(cmdline,
+                         b"root=LABEL=root rw  verity_squash_root_slot=a "
+                         b"verity_squash_root_hash=hash\n")
+        self.assertEqual(read_section(STUB, ".sdmagic"),
+                         b"#### LoaderInfo: systemd-stub 251.1-1-arch ####\0")
+        self.assertIsNone(read_section(STUB, ".osrel"))
+
+        path = TEST_FILES_DIR / "stub_broken.efi"
+        with self.assertRaises(PETruncatedError) as e_ctx:
+            read_section(path, ".cmdline")
+        self.assertEqual(str(e_ctx.exception), "{} is truncated".format(path))
+        path = TEST_FILES_DIR / "stub_empty.efi"
+        with self.assertRaises(PEEmptyError) as e_ctx:
+            read_section(path, ".cmdline")
+        self.assertEqual(str(e_ctx.exception), "{} is empty".format(path))
+        with self.assertRaises(PEFormatError) as e_ctx:
+            read_section(TEST_FILES_DIR / "no_sections_or_info", ".cmdline")
+        self.assertEqual(str(e_ctx.exception), "No DOS header found")
+
+    @wrap_tempdir
+    def test__read_stub_image(self, tempdir):
+        stub = tempdir / "stub.efi"
+        shutil.copyfile(STUB, stub)
+        base = "verity_squash_root.pe"
+        with (mock.patch("{}.STUB_CACHE".format(base), new={}) as cache,
+              mock.patch("{}.read_pe_image".format(base),
+                         wraps=read_pe_image) as read_mock):
+            with open(stub, "rb") as f:
+                image = read_stub_image(f)
+            with open(stub, "rb") as f:
+                self.assertIs(read_stub_image(f), image)
+            self.assertEqual(read_mock.call_count, 1)
+            self.assertEqual(len(cache), 1)
+            # a new stub version is parsed again
+            os.utime(stub, ns=(0, 0))
+            with open(stub, "rb") as f:
+                self.assertIsNot(read_stub_image(f), image)
+            self.assertEqual(read_mock.call_count, 2)
+            self.assertEqual(len(cache), 2)
+
+    @wrap_tempdir
+    def test__append_sections(self, tempdir):
+        osrel = tempdir / "osrel"
+        short = tempdir / "short"
+        write_str_to(osrel, "ID=test\n")
+        write_str_to(short, "short")
+        out = tempdir / "out.efi"
+        out_short = tempdir / "out_short.efi"
+        append_sections(STUB, [(".osrel", osrel),
+                               (".cmdline", None),
+                               (".initrd", TEST_FILES_DIR / "initrd"),
+                               (".linux", TEST_FILES_DIR / "vmlinuz")],
+                        [(TEST_FILES_DIR / "cmdline", out),
+                         (short, out_short)])
+        stub = read_from(STUB)
+        data = read_from(out)
+        image = read_image(out)
+        # no space for more section headers, so all sections are moved
+        shift = 0x400 - 0x2f0
+        self.assertEqual(image.size_of_headers, 0x400)
+        self.assertEqual(image.size_of_image, 0x13400)
+        self.assertEqual(image.data_directory(4), (0, 0))
+        old = read_image(STUB)
+        for s, o in zip(image.sections, old.sections):
+            self.assertEqual(s[:4] + s[5:], o[:4] + o[5:])
+            self.assertEqual(s[4], o[4] + shift)
+            self.assertEqual(data[s[4]:s[4] + s[3]], stub[o[4]:o[4] + o[3]])
+        self.assertEqual(
+            image.sections[9:],
+            [[b".osrel\0\0", 8, 0x12200, 0x200, 0xb800, 0, 0, 0, 0,
+              0x40000040],
+             [b".cmdline", 168, 0x12400, 0x200, 0xc800, 0, 0, 0, 0,
+              0x40000040],
+             [b".initrd\0", 2048, 0x12600, 0x800, 0xba00, 0, 0, 0, 0,
+              0x40000040],
+             [b".linux\0\0", 1536, 0x12e00, 0x600, 0xc200, 0, 0, 0, 0,
+              0x40000040]])
+        self.assertEqual(data[0xb800:0xba00], b"ID=test\n" + bytes(504))
+        self.assertEqual(data[0xba00:0xc200],
+                         read_from(TEST_FILES_DIR / "initrd"))
+        self.assertEqual(data[0xc200:0xc800],
+                         read_from(TEST_FILES_DIR / "vmlinuz"))
+        self.assertEqual(data[0xc800:],
+                         read_from(TEST_FILES_DIR / "cmdline") + bytes(344))
+
+        # Only the cmdline differs
+        image_short = read_image(out_short)
+        self.assertEqual(image_short.size_of_image, 0x13400)
+        self.assertEqual(image_short.sections[:10], image.sections[:10])
+        self.assertEqual(image_short.sections[11:], image.sections[11:])
+        self.assertEqual(
+            image_short.sections[10],
+            [b".cmdline", 5, 0x12400, 0x200, 0xc800, 0, 0, 0, 0, 0x40000040])
+        data_short = read_from(out_short)
+        self.assertEqual(data_short[0x400:0xc800], data[0x400:0xc800])
+        self.assertEqual(data_short[0xc800:], b"short" + bytes(507))
+
+        # enough space for another section header
+        out2 = tempdir / "out2.efi"
+        append_sections(out, [(".extra", None)], [(short, out2)])
+        self.assertEqual(read_image(out).sections, image.sections)
+        image2 = read_image(out2)
+        self.assertEqual(image2.size_of_headers, 0x400)
+        self.assertEqual(image2.sections[:-1], image.sections)
+        self.assertEqual(
+            image2.sections[-1],
+            [b".extra\0\0", 5, 0x13400, 0x200, 0xca00, 0, 0, 0, 0,
+             0x40000040])
+        data2 = read_from(out2)
+        self.assertEqual(data2[0x400:0xca00], data[0x400:])
+        self.assertEqual(data2[0xca00:], b"short" + bytes(507))
+
+    @wrap_tempdir
+    def test__append_sections__parts(self, tempdir):
+        microcode = tempdir / "microcode"
+        write_str_to(microcode, "microcode")
+        out = tempdir / "out.efi"
+        append_sections(STUB, [(".cmdline", None),
+                               (".initrd", [microcode,
+                                            TEST_FILES_DIR / "initrd"])],
+                        [(TEST_FILES_DIR / "cmdline", out)])
+        initrd = read_image(out).sections[-1]
+        self.assertEqual(initrd[:2], [b".initrd\0", 9 + 2048])
+        self.assertEqual(read_from(out)[initrd[4]:initrd[4] + initrd[1]],
+                         b"microcode" + read_from(TEST_FILES_DIR / "initrd"))
+
+    @wrap_tempdir
+    def test__append_sections__invalid(self, tempdir):
+        with self.assertRaises(ValueError) as e_ctx:
+            append_sections(STUB, [(".toolong_", None)],
+                            [(STUB, tempdir / "out")])
+        self.assertEqual(str(e_ctx.exception),
+                         "Section name too long: .toolong_")
+        for sections in [[(".linux", STUB)],
+                         [(".cmdline", None), (".other", None)]]:
+            with self.assertRaises(ValueError) as e_ctx:
+                append_sections(STUB, sections, [(STUB, tempdir / "out")])
+            self.assertEqual(str(e_ctx.exception),
+                             "Exactly one variable section needed")
@@ -0,0 +1,91 @@
+import os
+import unittest
+from configparser import ConfigParser
+from pathlib import Path
+from unittest import mock
+from .test_helper import wrap_tempdir
+from verity_squash_root.file_op import write_str_to
+from verity_squash_root.prescan import SizeCount, SizeReport, \
+    format_size_report, prescan_root, scan_sizes
+
+
+def create_tree(tempdir: Path) -> Path:
+    root = tempdir / "root"
+    for d in ["etc", "tmp", "usr/lib", "var/cache", "var/lib"]:
+        (root / d).mkdir(parents=True)
+    write_str_to(root / "etc/config", "config")
+    write_str_to(root / "tmp/file", "tmp")
+    write_str_to(root / "tmp/.hidden", "hidden")
+    write_str_to(root / "usr/lib/lib.so", "x" * 1000)
+    write_str_to(root / "var/cache/file", "cache")
+    write_str_to(root / "var/lib/db", "db")
+    write_str_to(root / "swapfile", "s" * 100)
+    # Hard links are stored once
+    os.link(root / "usr/lib/lib.so", root / "etc/lib.so")
+    os.link(root / "usr/lib/lib.so", root / "usr/lib/lib2.so")
+    return root
+
+
+def sizes(counts):
+    return {name: (c.bytes, c.inodes) for name, c in counts.items()}
+
+
+class PrescanTest(unittest.TestCase):
+
+    @wrap_tempdir
+    def test__scan_sizes(self, tempdir):
+        root = create_tree(tempdir)
+        patterns = ["tmp/*", "tmp/.*", "var/!(lib)/*", "var/!(lib)/.*",
+                    "swapfile", "usr/[[:alpha:]]"]
+        for jobs in [1, 3]:
+            report = scan_sizes(root, patterns, jobs)
+            self.assertEqual(sizes(report.included), {
+                "etc": (1006, 3),
+                "tmp": (0, 1),
+                "usr": (0, 2),
+                "var": (2, 4),
+            })
+            self.assertEqual(sizes(report.excluded), {
+                "tmp/*": (3, 1),
+                "tmp/.*": (6, 1),
+                "var/!(lib)/*": (5, 1),
+                "var/!(lib)/.*": (0, 0),
+                "swapfile": (100, 1),
+            })
+            self.assertEqual(report.unsupported, ["usr/[[:alpha:]]"])
+            total = report.total()
+            self.assertEqual((total.bytes, total.inodes), (1008, 10))
+
+    def test__format_size_report(self):
+        report = SizeReport(["tmp/*"])
+        report.included["usr"] = SizeCount()
+        report.included["usr"].add(3 * 1024 ** 2, 5)
+        report.included["etc"] = SizeCount()
+        report.included["etc"].add(1024 ** 2 // 2)
+        report.excluded["tmp/*"].add(1024, 2)
+        report.unsupported.append("a/[[:alpha:]]")
+        self.assertEqual(
+            format_size_report(report),
+            [" + etc: 0.5 MiB, 1 inodes",
+             " + usr: 3.0 MiB, 5 inodes",
+             " - tmp/*: 0.0 MiB, 2 inodes",
+             " ? a/[[:alpha:]]: not evaluated",
+             "Image content: 3.5 MiB, 6 inodes",
+             "\n(+ = included, - = excluded, sizes are uncompressed)"])
+
+    def test__prescan_root(self):
+        config = ConfigParser()
+        config.read_string("[DEFAULT]\n"
+                           "ROOT_MOUNT = /mnt/root\n"
+                           "EFI_PARTITION = /boot/efi\n"
+                           "EXCLUDE_DIRS = /home\n")
+        with mock.patch("verity_squash_root.prescan.scan_sizes") as scan:
+            with self.assertLogs():
+                result = prescan_root(config, 4)
+        self.assertEqual(result, scan.return_value)
+        scan.assert_called_once_with(
+            Path("/"),
+            ["dev/*", "dev/.*", "proc/*", "proc/.*", "run/*", "run/.*",
+             "sys/*", "sys/.*", "tmp/*", "tmp/.*", "mnt/root/*",
+             "mnt/root/.*", "boot/efi/*", "boot/efi/.*", "home/*",
+             "home/.*"], 4)
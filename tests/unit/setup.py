@@ -51,7 +51,7 @@ class SetupTest(unittest.TestCase):
 
     @mock.patch("verity_squash_root.setup.exec_binary")
     @mock.patch("verity_squash_root.setup.write_str_to")
-    @mock.patch("verity_squash_root.setup.efi.sign")
+    @mock.patch("verity_squash_root.setup.efi.sign_files")
     def test__setup_systemd_boot(self, sign_mock, write_to_mock, exec_mock):
         distri_mock = distribution_mock()
         initramfs_mock = create_initramfs_mock(distri_mock)
@@ -69,10 +69,10 @@ class SetupTest(unittest.TestCase):
         boot_efi = Path("/usr/lib/systemd/boot/efi/systemd-bootx64.efi")
         self.assertEqual(
             sign_mock.mock_calls,
-            [mock.call(KEY_DIR, Path(boot_efi),
-                       Path("/boot/efi_dir/EFI/systemd/systemd-bootx64.efi")),
-             mock.call(KEY_DIR, boot_efi,
-                       Path("/boot/efi_dir/EFI/BOOT/BOOTX64.EFI"))])
+            [mock.call(KEY_DIR, [
+                (boot_efi,
+                 Path("/boot/efi_dir/EFI/systemd/systemd-bootx64.efi")),
+                (boot_efi, Path("/boot/efi_dir/EFI/BOOT/BOOTX64.EFI"))])])
         text = "title Display {}\nlinux /EFI/verity_squash_root/ArchEfi/{}\n"
         path = Path("/boot/efi_dir/loader/entries")
         self.assertEqual(
@@ -1,51 +1,75 @@
 import unittest
+from tests.unit.authenticode import AuthenticodeTest
+from tests.unit.bench import BenchTest
 from tests.unit.cmdline import CmdlineTest
 from tests.unit.config import ConfigTest
 from tests.unit.decrypt import DecryptTest
+from tests.unit.delta import DeltaTest
 from tests.unit.distributions.arch import ArchLinuxConfigTest
 from tests.unit.distributions.autodetect import DistributionDetectTest
 from tests.unit.distributions.base import BaseDistributionTest
 from tests.unit.distributions.debian import DebianConfigTest
 from tests.unit.efi import EfiTest
 from tests.unit.encrypt import EncryptTest
+from tests.unit.exclude import ExcludeTest
 from tests.unit.exec import ExecTest
 from tests.unit.file_names import FileNamesTest
 from tests.unit.file_op import FileOPTest
 from tests.unit.image import ImageTest
 from tests.unit.initramfs import InitramfsTest
 from tests.unit.initramfs.autodetect import InitramfsDetectTest
+from tests.unit.initramfs.cache import InitramfsCacheTest
 from tests.unit.initramfs.dracut import DracutTest
 from tests.unit.initramfs.mkinitcpio import MkinitcpioTest
+from tests.unit.integrity import IntegrityTest
 from tests.unit.main import MainTest
+from tests.unit.manifest import ManifestTest
 from tests.unit.mount import MountTest
 from tests.unit.parsing import ParsingTest
+from tests.unit.pe import PETest
 from tests.unit.pep_checker import Pep8Test
+from tests.unit.prescan import PrescanTest
 from tests.unit.setup import SetupTest
+from tests.unit.timing import TimingTest
+from tests.unit.verify import VerifyTest
+from tests.unit.verity import VerityTest
 
 
 def test_suite():
     suite = unittest.TestSuite([
         unittest.makeSuite(ArchLinuxConfigTest),
+        unittest.makeSuite(AuthenticodeTest),
         unittest.makeSuite(BaseDistributionTest),
+        unittest.makeSuite(BenchTest),
         unittest.makeSuite(CmdlineTest),
         unittest.makeSuite(ConfigTest),
         unittest.makeSuite(DebianConfigTest),
         unittest.makeSuite(DecryptTest),
+        unittest.makeSuite(DeltaTest),
         unittest.makeSuite(DistributionDetectTest),
         unittest.makeSuite(DracutTest),
         unittest.makeSuite(EfiTest),
         unittest.makeSuite(EncryptTest),
+        unittest.makeSuite(ExcludeTest),
         unittest.makeSuite(ExecTest),
         unittest.makeSuite(FileNamesTest),
         unittest.makeSuite(FileOPTest),
         unittest.makeSuite(ImageTest),
+        unittest.makeSuite(InitramfsCacheTest),
         unittest.makeSuite(InitramfsDetectTest),
         unittest.makeSuite(InitramfsTest),
+        unittest.makeSuite(IntegrityTest),
         unittest.makeSuite(MainTest),
+        unittest.makeSuite(ManifestTest),
         unittest.makeSuite(MkinitcpioTest),
         unittest.makeSuite(MountTest),
         unittest.makeSuite(ParsingTest),
+        unittest.makeSuite(PETest),
         unittest.makeSuite(Pep8Test),
+        unittest.makeSuite(PrescanTest),
         unittest.makeSuite(SetupTest),
+        unittest.makeSuite(TimingTest),
+        unittest.makeSuite(VerifyTest),
+        unittest.makeSuite(VerityTest),
     ])
     return suite
@@ -0,0 +1,89 @@
+import json
+import threading
+import unittest
+from .test_helper import wrap_tempdir
+from verity_squash_root.exec import exec_binary
+from verity_squash_root.timing import build_report, create_report, stage, \
+    start_report
+
+
+class TimingTest(unittest.TestCase):
+
+    def test__stage(self):
+        start_report()
+        with stage("outer", extra="info") as record:
+            self.assertEqual(record["depth"], 0)
+            with stage("inner") as inner:
+                self.assertEqual(inner["depth"], 1)
+            exec_binary(["dash", "-c", "printf 12345; printf 12 >&2; "
+                                       "exit 3"], 3)
+        report = create_report(False)
+        self.assertFalse(report["failed"])
+        self.assertEqual([s["name"] for s in report["stages"]],
+                         ["outer", "inner", "exec dash"])
+        outer, inner, cmd = report["stages"]
+        self.assertEqual(outer["extra"], "info")
+        self.assertEqual(cmd["depth"], 1)
+        self.assertEqual(cmd["returncode"], 3)
+        self.assertEqual(cmd["stdout_bytes"], 5)
+        self.assertEqual(cmd["stderr_bytes"], 2)
+        self.assertEqual(cmd["cmd"][0], "dash")
+        # The usage of children counts for all running stages
+        self.assertGreater(cmd["child_max_rss_kb"], 0)
+        self.assertEqual(outer["child_max_rss_kb"], cmd["child_max_rss_kb"])
+        self.assertEqual(outer["child_cpu"], cmd["child_cpu"])
+        self.assertEqual(inner["child_max_rss_kb"], 0)
+        for s in report["stages"]:
+            self.assertGreaterEqual(s["wall"], 0)
+            self.assertGreaterEqual(s["cpu"], 0)
+            self.assertGreater(s["max_rss_kb"], 0)
+
+        start_report()
+        self.assertEqual(create_report(True)["stages"], [])
+
+    def test__stage__threads(self):
+        start_report()
+        barrier = threading.Barrier(2)
+
+        def run(name):
+            with stage(name):
+                barrier.wait()
+
+        with stage("main"):
+            thread = threading.Thread(target=run, args=("thread",))
+            thread.start()
+            run("other")
+            thread.join()
+        report = create_report(False)
+        # Stages of other threads are not nested
+        self.assertEqual(sorted((s["name"], s["depth"])
+                                for s in report["stages"]),
+                         [("main", 0), ("other", 1), ("thread", 0)])
+
+    @wrap_tempdir
+    def test__build_report(self, tempdir):
+        path = tempdir / "report.json"
+        with build_report(path):
+            with stage("mksquashfs"):
+                pass
+        report = json.loads(path.read_text())
+        self.assertEqual(report["version"], 1)
+        self.assertFalse(report["failed"])
+        self.assertEqual([(s["name"], s["depth"]) for s in report["stages"]],
+                         [("build", 0), ("mksquashfs", 1)])
+
+        with self.assertRaises(RuntimeError):
+            with build_report(path):
+                with stage("initramfs"):
+                    raise RuntimeError("fail")
+        report = json.loads(path.read_text())
+        self.assertTrue(report["failed"])
+        self.assertEqual([s["name"] for s in report["stages"]],
+                         ["build", "initramfs"])
+
+        with self.assertLogs() as logs:
+            with build_report(tempdir / "not" / "existing.json"):
+                pass
+        self.assertEqual(len(logs.output), 1)
+        self.assertTrue(logs.output[0].startswith(
+            "WARNING:root:Could not write build report: "))
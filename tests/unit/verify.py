@@ -0,0 +1,172 @@
+import unittest
+from configparser import ConfigParser
+from pathlib import Path
+from unittest import mock
+from unittest.mock import call
+from .test_helper import wrap_tempdir
+from verity_squash_root.file_op import write_str_to
+from verity_squash_root.verify import compare_images, diff_contents, \
+    diff_listings, image_listing, verify_build
+
+LISTING = b"""Parallel unsquashfs: Using 8 processors
+3 inodes (2 blocks) to write
+
+drwxr-xr-x 0/0                76 2024-01-02 10:00 squashfs-root
+lrwxrwxrwx 0/0                 7 2024-01-02 10:00 squashfs-root/bin -> usr/bin
+crw-r--r-- 0/0            1,  3 2024-01-02 10:00 squashfs-root/dev null
+-rw-r--r-- 0/0              1234 2024-01-02 10:00 squashfs-root/etc/a b
+"""
+
+
+def verify_config(root_mount: Path) -> ConfigParser:
+    config = ConfigParser()
+    config.read_string("[DEFAULT]\n"
+                       "ROOT_MOUNT = {}\n"
+                       "EFI_PARTITION = /boot/efi\n"
+                       "EXCLUDE_DIRS = /home\n"
+                       "SQUASHFS_PROFILE = default\n"
+                       "[SQUASHFS_PROFILE:default]\n".format(root_mount))
+    return config
+
+
+class VerifyTest(unittest.TestCase):
+
+    @mock.patch("verity_squash_root.verify.exec_binary")
+    def test__image_listing(self, exec_mock):
+        exec_mock.return_value = (LISTING, b"")
+        self.assertEqual(
+            image_listing(Path("/image")),
+            {"/": "drwxr-xr-x 0/0                76 2024-01-02 10:00",
+             "/bin -> usr/bin":
+                 "lrwxrwxrwx 0/0                 7 2024-01-02 10:00",
+             "/dev null": "crw-r--r-- 0/0            1,  3 2024-01-02 10:00",
+             "/etc/a b": "-rw-r--r-- 0/0              1234 2024-01-02 10:00"})
+        exec_mock.assert_called_once_with(["unsquashfs", "-lln", "/image"])
+
+    def test__diff_listings(self):
+        expected = {"/": "d", "/a": "-rw 1", "/b": "-rw 2", "/c": "-rw 3",
+                    "/l -> a": "l", "/old": "-rw 4"}
+        actual = {"/": "d", "/a": "-rw 1", "/b": "-rw 5", "/c": "-rw 3",
+                  "/l -> a": "l", "/new": "-rw 4"}
+        self.assertEqual(
+            diff_listings(expected, actual),
+            (["metadata differs: /b: -rw 2 != -rw 5",
+              "new in rebuild: /new",
+              "missing in rebuild: /old"],
+             ["/a", "/c"]))
+
+    @wrap_tempdir
+    def test__diff_contents(self, tempdir):
+        for root, content in [("a", "1"), ("b", "2")]:
+            (tempdir / root / "etc").mkdir(parents=True)
+            write_str_to(tempdir / root / "etc" / "same", "same")
+            write_str_to(tempdir / root / "etc" / "other", content)
+        self.assertEqual(
+            diff_contents(tempdir / "a", tempdir / "b",
+                          ["/etc/other", "/etc/same"], 2),
+            ["content differs: /etc/other"])
+
+    def test__compare_images(self):
+        base = "verity_squash_root.verify"
+        all_mocks = mock.MagicMock()
+        image = Path("/mnt/root/image_a.squashfs")
+        rebuild = Path("/tmp/verity_squash_root/verify/image.squashfs")
+        verify_dir = Path("/tmp/verity_squash_root/verify")
+        all_mocks.image_listing.side_effect = [{"/": "d", "/a": "-rw"},
+                                               {"/": "d", "/a": "-rw"}]
+        all_mocks.diff_contents.return_value = ["content differs: /a"]
+        with (mock.patch("{}.image_listing".format(base),
+                         new=all_mocks.image_listing),
+              mock.patch("{}.VerityMount".format(base),
+                         new=all_mocks.VerityMount),
+              mock.patch("{}.diff_contents".format(base),
+                         new=all_mocks.diff_contents)):
+            self.assertEqual(
+                compare_images(image, "hash1", rebuild, "hash2", 3),
+                ["content differs: /a"])
+            all_mocks.image_listing.side_effect = [{"/": "d"}, {"/": "d"}]
+            all_mocks.diff_contents.return_value = []
+            self.assertEqual(
+                compare_images(image, "hash1", rebuild, "hash2", 3),
+                ["All files are equal, only the layout of the squashfs "
+                 "image differs"])
+        self.assertEqual(
+            [c for c in all_mocks.mock_calls
+             if c[0] in ["VerityMount", "diff_contents"]][:3],
+            [call.VerityMount(image, Path(str(image) + ".verity"), "hash1",
+                              "verity_squash_root_verify_slot",
+                              verify_dir / "slot"),
+             call.VerityMount(rebuild, Path(str(rebuild) + ".verity"),
+                              "hash2", "verity_squash_root_verify_rebuild",
+                              verify_dir / "rebuild"),
+             call.diff_contents(verify_dir / "slot", verify_dir / "rebuild",
+                                ["/a"], 3)])
+
+    @wrap_tempdir
+    def test__verify_build(self, tempdir):
+        base = "verity_squash_root.verify"
+        all_mocks = mock.Mock()
+        config = verify_config(tempdir)
+        image = tempdir / "image_a.squashfs"
+        rebuild = tempdir / "verify" / "image.squashfs"
+
+        def mksquashfs(exclude_dirs, image, root_mount, efi_partition,
+                       profile):
+            write_str_to(image, "image")
+
+        def verity_hash_file(image, verity, jobs, salt, verity_uuid):
+            write_str_to(verity, "verity")
+            return "rebuild_hash"
+
+        all_mocks.mksquashfs.side_effect = mksquashfs
+        all_mocks.verity_hash_file.side_effect = verity_hash_file
+        all_mocks.read_superblock.return_value = (b"salt", "uuid", 10)
+        all_mocks.verity_root_hash.return_value = "rebuild_hash"
+        all_mocks.compare_images.return_value = ["content differs: /a"]
+        with (mock.patch("{}.VERIFY_DIR".format(base),
+                         new=tempdir / "verify"),
+              mock.patch("{}.mksquashfs".format(base),
+                         new=all_mocks.mksquashfs),
+              mock.patch("{}.verity_hash_file".format(base),
+                         new=all_mocks.verity_hash_file),
+              mock.patch("{}.read_superblock".format(base),
+                         new=all_mocks.read_superblock),
+              mock.patch("{}.verity_root_hash".format(base),
+                         new=all_mocks.verity_root_hash),
+              mock.patch("{}.compare_images".format(base),
+                         new=all_mocks.compare_images)):
+            self.assertEqual(verify_build(config, "a", 4), [])
+            verity = tempdir / "image_a.squashfs.verity"
+            start = [
+                call.read_superblock(verity),
+                call.verity_root_hash(verity),
+                call.mksquashfs(["/home"], rebuild, tempdir,
+                                Path("/boot/efi"), mock.ANY),
+                call.verity_hash_file(rebuild,
+                                      tempdir / "verify" /
+                                      "image.squashfs.verity",
+                                      4, b"salt", "uuid")]
+            self.assertEqual(all_mocks.mock_calls, start)
+            # The rebuilt image is removed
+            self.assertEqual(list((tempdir / "verify").iterdir()), [])
+
+            all_mocks.reset_mock()
+            all_mocks.verity_root_hash.return_value = "slot_hash"
+            with self.assertLogs() as logs:
+                self.assertEqual(verify_build(config, "a", 4),
+                                 ["content differs: /a"])
+            self.assertEqual(logs.output,
+                             ["INFO:root:Rebuilding image of slot a...",
+                              "WARNING:root:Rebuilt image differs, "
+                              "comparing files..."])
+            self.assertEqual(
+                all_mocks.mock_calls,
+                start + [call.compare_images(image, "slot_hash", rebuild,
+                                             "rebuild_hash", 4)])
+
+            write_str_to(tempdir / "image_b.squashfs.base", "base_1")
+            with self.assertRaises(ValueError) as e_ctx:
+                verify_build(config, "b", 4)
+            self.assertEqual(str(e_ctx.exception),
+                             "Image of slot b is a delta image, only full "
+                             "images can be verified")
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+from .test_helper import wrap_tempdir
+from verity_squash_root.exec import exec_binary
+from verity_squash_root.file_op import read_from
+from verity_squash_root.parsing import info_to_dict
+from verity_squash_root.verity import VerityFormatError, VerityHashTree, \
+    hash_blocks, read_superblock, verity_hash_file, verity_root_hash
+
+SALT = bytes(range(32))
+UUID = uuid.UUID("12345678-1234-5678-1234-567812345678")
+
+
+def reference_tree(data: bytes, salt: bytes):
+    # Hash tree as calculated by cryptsetup (lib/verity/verity_hash.c)
+    bs = 4096
+    blocks = len(data) // bs
+    bits = 7
+    levels = 0
+    while (blocks - 1) >> (bits * levels):
+        levels += 1
+    position = 1
+    level_block = [0] * levels
+    level_size = [0] * levels
+    for i in range(levels - 1, -1, -1):
+        level_block[i] = position
+        shift = (i + 1) * bits
+        level_size[i] = (blocks + (1 << shift) - 1) >> shift
+        position += level_size[i]
+    tree = bytearray(position * bs)
+
+    def create(source: bytes, count: int, dest: int):
+        hashes = b"".join(
+            hashlib.sha256(salt + source[i * bs:(i + 1) * bs]).digest()
+            for i in range(count))
+        tree[dest * bs:dest * bs + len(hashes)] = hashes
+
+    for i in range(levels):
+        if i == 0:
+            create(data, blocks, level_block[0])
+        else:
+            start = level_block[i - 1] * bs
+            create(bytes(tree[start:]), level_size[i - 1], level_block[i])
+    if levels > 0:
+        top = level_block[levels - 1] * bs
+        root = hashlib.sha256(salt + tree[top:top + bs]).digest()
+    else:
+        root = hashlib.sha256(salt + data[:bs]).digest()
+    return bytes(tree[bs:]), root.hex()
+
+
+class VerityTest(unittest.TestCase):
+
+    def test__hash_blocks(self):
+        base = hashlib.sha256(b"salt")
+        data = os.urandom(3 * 4096)
+        self.assertEqual(
+            hash_blocks(base, data),
+            b"".join(hashlib.sha256(b"salt" + data[i:i + 4096]).digest()
+                     for i in range(0, len(data), 4096)))
+        self.assertEqual(base.digest(), hashlib.sha256(b"salt").digest())
+
+    def test__superblock(self):
+        tree = VerityHashTree(salt=SALT, verity_uuid=UUID)
+        tree.data_blocks = 0x10203
+        sb = tree.superblock()
+        self.assertEqual(len(sb), 512)
+        self.assertEqual(
+            sb[:92],
+            b"verity\0\0\1\0\0\0\1\0\0\0" + UUID.bytes +
+            b"sha256" + bytes(26) +
+            b"\0\x10\0\0\0\x10\0\0\3\2\1\0\0\0\0\0" +
+            b"\x20\0" + bytes(6) + SALT[:4])
+        self.assertEqual(sb[88:120], SALT)
+        self.assertEqual(sb[120:], bytes(392))
+
+    @wrap_tempdir
+    def test__verity_hash_file(self, tempdir):
+        image = tempdir / "image"
+        verity = tempdir / "image.verity"
+        # single block, one level, two levels, a partial last block and
+        # more than one chunk
+        for size, jobs in [(4096, 1), (5 * 4096, 1), (129 * 4096, 3),
+                           (300 * 4096 + 100, 2), (4097 * 4096, 2)]:
+            data = os.urandom(size)
+            image.write_bytes(data)
+            with mock.patch("verity_squash_root.verity.os.urandom",
+                            side_effect=lambda size: SALT[:size]):
+                root_hash = verity_hash_file(image, verity, jobs)
+            tree, expected_hash = reference_tree(data, SALT)
+            self.assertEqual(root_hash, expected_hash)
+            content = read_from(verity)
+            self.assertEqual(content[:8], b"verity\0\0")
+            self.assertEqual(content[512:4096], bytes(3584))
+            self.assertEqual(content[4096:], tree)
+
+        # The lowest level is written next to the hash tree, not kept
+        # in memory
+        with mock.patch("verity_squash_root.verity.tempfile.TemporaryFile",
+                        wraps=tempfile.TemporaryFile) as scratch_mock:
+            verity_hash_file(image, verity, 2)
+        scratch_mock.assert_called_once_with(dir=tempdir)
+
+        image.write_bytes(b"")
+        with self.assertRaises(ValueError) as e_ctx:
+            verity_hash_file(image, verity, 2)
+        self.assertEqual(str(e_ctx.exception),
+                         "No data to create a hash tree for")
+
+    @wrap_tempdir
+    def test__read_superblock(self, tempdir):
+        image = tempdir / "image"
+        verity = tempdir / "image.verity"
+        image.write_bytes(os.urandom(300 * 4096))
+        root_hash = verity_hash_file(image, verity, 2, SALT[:20], UUID)
+        self.assertEqual(read_superblock(verity), (SALT[:20], UUID, 300))
+        self.assertEqual(verity_root_hash(verity), root_hash)
+        # The same salt results in the same tree
+        self.assertEqual(verity_hash_file(image, tempdir / "other", 1,
+                                          SALT[:20], UUID), root_hash)
+        self.assertEqual(read_from(tempdir / "other"), read_from(verity))
+
+        content = read_from(verity)
+        verity.write_bytes(content[:4096])
+        with self.assertRaises(VerityFormatError) as e_ctx:
+            verity_root_hash(verity)
+        self.assertEqual(str(e_ctx.exception),
+                         "{} is truncated".format(verity))
+        verity.write_bytes(content[:100])
+        with self.assertRaises(VerityFormatError) as e_ctx:
+            read_superblock(verity)
+        self.assertEqual(str(e_ctx.exception),
+                         "{} is truncated".format(verity))
+        verity.write_bytes(b"verity\0\0\2" + content[9:])
+        with self.assertRaises(VerityFormatError) as e_ctx:
+            read_superblock(verity)
+        self.assertEqual(str(e_ctx.exception),
+                         "{} is not a supported hash tree".format(verity))
+
+        image.write_bytes(os.urandom(4096))
+        verity_hash_file(image, verity)
+        with self.assertRaises(VerityFormatError) as e_ctx:
+            verity_root_hash(verity)
+        self.assertEqual(str(e_ctx.exception),
+                         "{} has no hash blocks".format(verity))
+
+    def test__update(self):
+        data = os.urandom(9000 * 4096)
+        trees = []
+        for jobs, pieces in [(1, [len(data)]), (4, [1, 4095, 8 * 1024 ** 2,
+                                                    len(data)])]:
+            tree = VerityHashTree(jobs, SALT, UUID)
+            start = 0
+            for end in pieces:
+                tree.update(data[start:end])
+                start = end
+            tree._finish_data()
+            tree._level0.seek(0)
+            trees.append(tree._level0.read())
+            tree._close_level0()
+            self.assertEqual(tree.data_blocks, 9000)
+        self.assertEqual(trees[0], trees[1])
+
+    @wrap_tempdir
+    def test__finish__empty(self, tempdir):
+        with VerityHashTree() as tree:
+            tree.update(b"123")
+            with self.assertRaises(ValueError) as e_ctx:
+                tree.finish(tempdir / "verity")
+        self.assertEqual(str(e_ctx.exception),
+                         "No data to create a hash tree for")
+
+    @unittest.skipIf(shutil.which("veritysetup") is None,
+                     "veritysetup is not installed")
+    @wrap_tempdir
+    def test__veritysetup_compatibility(self, tempdir):
+        image = tempdir / "image"
+        image.write_bytes(os.urandom(1000 * 4096))
+        expected = tempdir / "expected.verity"
+        result = exec_binary(["veritysetup", "format", "--salt", SALT.hex(),
+                              "--uuid", str(UUID), str(image),
+                              str(expected)])
+        info = info_to_dict(result[0].decode())
+        with VerityHashTree(2, SALT, UUID) as tree:
+            tree.update(read_from(image))
+            root_hash = tree.finish(tempdir / "image.verity")
+        self.assertEqual(root_hash, info["Root hash"])
+        self.assertEqual(read_from(tempdir / "image.verity"),
+                         read_from(Path(expected)))
@@ -30,6 +30,8 @@ cmdline() {
 	echo "verity_squash_root_slot"
 	echo "verity_squash_root_hash"
 	echo "verity_squash_root_volatile"
+	echo "verity_squash_root_base"
+	echo "verity_squash_root_base_hash"
 }
 
 depends() {
@@ -53,6 +55,7 @@ install() {
 	mkdir -p "${initdir}"/moved_root
 	mkdir -p "${initdir}"/overlayroot
 	mkdir -p "${initdir}"/verity-squash-root-tmp/squashroot
+	mkdir -p "${initdir}"/verity-squash-root-tmp/squashbase
 	mkdir -p "${initdir}"/verity-squash-root-tmp/tmpfs
 	# shellcheck disable=SC2154
 	local ssud="${systemdsystemunitdir}"